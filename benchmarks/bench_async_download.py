@@ -0,0 +1,106 @@
+""" Compares the threaded and asyncio download engines on many small files.
+
+Usage: python benchmarks/bench_async_download.py [--files 2000] [--size-kb 16]
+
+Each engine runs in its own child process so its CPU time, peak thread
+count and peak RSS can be measured separately, while the local server runs
+in this process. Requires aiohttp for the asyncio engine.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import requests  # noqa: E402
+from async_download import AsyncDownloadTracker  # noqa: E402
+from download import DownloadTracker  # noqa: E402
+from local_server import LocalServer  # noqa: E402
+
+
+def run_engine(args):
+    logging.disable(logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if args.engine == 'asyncio':
+        tracker = AsyncDownloadTracker(None, max_downloads=args.concurrency)
+    else:
+        tracker = DownloadTracker(None, ThreadPoolExecutor(args.concurrency))
+    for i in range(args.files):
+        tracker.add_download(os.path.join(args.work_dir, 'file_%s' % i),
+                             '%s/file_%s' % (args.base_url, i),
+                             args.size_kb * 1024)
+
+    peak_threads = [threading.active_count()]
+
+    def sample_threads():
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+        loop.call_later(0.05, sample_threads)
+
+    loop.call_soon(sample_threads)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=args.concurrency)
+        session.mount('http://', adapter)
+        loop.run_until_complete(tracker.run_async(session))
+    print(json.dumps({
+        'seconds': time.perf_counter() - start,
+        'cpu': time.process_time() - start_cpu,
+        'threads': peak_threads[0],
+        # kilobytes on Linux, bytes on macOS
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size-kb', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--engine', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.engine:
+        run_engine(args)
+        return
+
+    server = LocalServer(latency=args.latency)
+    for i in range(args.files):
+        server.files['/file_%s' % i] = os.urandom(args.size_kb * 1024)
+    print('%-8s %9s %9s %8s %10s %9s' % (
+        'engine', 'seconds', 'cpu', 'threads', 'peak rss', 'requests'))
+    with server:
+        for engine in ('threads', 'asyncio'):
+            work_dir = tempfile.mkdtemp()
+            requests_before = server.request_count
+            try:
+                output = subprocess.check_output([
+                    sys.executable, __file__, '--engine', engine,
+                    '--files', str(args.files),
+                    '--size-kb', str(args.size_kb),
+                    '--concurrency', str(args.concurrency),
+                    '--base-url', server.url(''), '--work-dir', work_dir])
+                assert len(os.listdir(work_dir)) == args.files
+            finally:
+                shutil.rmtree(work_dir)
+            result = json.loads(output.decode('utf8'))
+            print('%-8s %9.2f %9.2f %8d %10d %9d' % (
+                engine, result['seconds'], result['cpu'], result['threads'],
+                result['rss'], server.request_count - requests_before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+""" Compares the memory held by a parsed remote index before and after the
+switch from response.json() to remote_index.parse_index.
+
+Usage: python benchmarks/bench_index_memory.py [--files 200000]
+
+A synthetic index of --files entries (SHA-256 hashes, sizes and nested
+paths, a few percent of them gzip encoded) is serialized once. It is then
+parsed as a whole body with json.loads, the way response.json() did, and
+streamed in INDEX_BLOCK_SIZE blocks through parse_index. For each, the
+bytes still allocated once the index is built and the peak while building
+it are measured with tracemalloc, along with the parse time. The whole
+body that response.json() needed in memory first is not counted.
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from remote_index import parse_index, INDEX_BLOCK_SIZE  # noqa: E402
+
+
+def make_index(count, rng):
+    files = {}
+    for i in range(count):
+        path = 'Fantasy Crescendo_Data/%s/%03d/asset_%06d.%s' % (
+            rng.choice(('Resources', 'StreamingAssets', 'Managed')),
+            i // 500, i, rng.choice(('assets', 'resS', 'dll', 'bundle')))
+        filedata = {'sha256': hashlib.sha256(b'%d' % i).hexdigest(),
+                    'size': rng.randint(1, 64 * 1024**2)}
+        if rng.random() < 0.05:
+            filedata.update(encoding='gzip',
+                            compressed_size=filedata['size'] // 3)
+        files[path] = filedata
+    return json.dumps({
+        'base_url': 'https://patch.houraiteahouse.net',
+        'project': 'fantasy-crescendo',
+        'branch': 'develop',
+        'platform': 'Windows',
+        'url_format': '{base_url}/{project}/{branch}/{platform}/'
+                      '{filename}_{filehash}',
+        'last_updated': 1500000000,
+        'files': files,
+    }).encode('utf8')
+
+
+def measure(parse, body):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        index = parse(body)
+        elapsed = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return index, retained, peak, elapsed
+
+
+def json_body(body):
+    # response.json() decodes the body it has already read in full
+    return json.loads(body.decode('utf8'))
+
+
+def streamed_body(body):
+    return parse_index(body[i:i + INDEX_BLOCK_SIZE]
+                       for i in range(0, len(body), INDEX_BLOCK_SIZE))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=200000)
+    args = parser.parse_args()
+
+    body = make_index(args.files, random.Random(1))
+    print('%d files, %.1f MB of JSON' % (args.files, len(body) / 1024**2))
+    print('%-10s %12s %12s %10s' % ('parser', 'retained MB', 'peak MB',
+                                    'seconds'))
+    results = {}
+    for name, parse in (('json', json_body), ('streamed', streamed_body)):
+        index, retained, peak, elapsed = measure(parse, body)
+        results[name] = index
+        del index
+        print('%-10s %12.1f %12.1f %10.2f' % (
+            name, retained / 1024**2, peak / 1024**2, elapsed))
+    expected = results['json']['files']
+    streamed = results['streamed']['files']
+    assert len(streamed) == len(expected)
+    for filename in list(expected)[::997]:
+        assert streamed[filename] == expected[filename]
+
+
+if __name__ == '__main__':
+    main()
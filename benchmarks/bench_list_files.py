@@ -0,0 +1,161 @@
+""" Compares util.scan_files against the original os.walk based scan.
+
+Usage: python benchmarks/bench_list_files.py [--files 100000] [--workers 8]
+
+Builds a synthetic tree of empty files and times three ways of listing it
+with sizes and modification times:
+
+  legacy   os.walk + os.path.relpath + str.replace, then os.stat per file
+           (what Branch.index_directory used to do)
+  scandir  util.scan_files on a single thread
+  parallel util.scan_files with one thread per top level directory
+
+A second, untimed pass counts the filesystem calls made from Python.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import util  # noqa: E402
+
+
+def legacy_scan(directory):
+    sep = os.path.sep
+    root = os.path.join(directory, '')
+    results = []
+    for path, _, files in os.walk(directory):
+        for name in files:
+            full_path = os.path.join(path, name)
+            relative_path = os.path.relpath(full_path, root).replace(sep, '/')
+            stat = os.stat(full_path)
+            results.append((relative_path, stat.st_size, stat.st_mtime_ns))
+    return results
+
+
+def scandir_scan(directory, workers=None):
+    return [(entry.relative_path, entry.stat.st_size, entry.stat.st_mtime_ns)
+            for entry in util.scan_files(directory, workers=workers)]
+
+
+def build_tree(root, file_count, top_dirs=20, files_per_dir=100):
+    created = 0
+    index = 0
+    while created < file_count:
+        directory = os.path.join(root, 'top%02d' % (index % top_dirs),
+                                 'dir%05d' % index)
+        os.makedirs(directory)
+        for i in range(min(files_per_dir, file_count - created)):
+            open(os.path.join(directory, 'file%03d.dat' % i), 'wb').close()
+            created += 1
+        index += 1
+
+
+class CallCounter(object):
+    """ Counts calls to os level functions while active.
+    DirEntry.stat can't be patched, so scandir is wrapped to hand out
+    entries whose stat calls are counted too.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._originals = {}
+
+    def _count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _wrap(self, name):
+        original = self._originals[name] = getattr(os, name)
+
+        def wrapper(*args, **kwargs):
+            self._count(name)
+            return original(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        for name in ('stat', 'lstat', 'getcwd'):
+            setattr(os, name, self._wrap(name))
+        original_scandir = self._originals['scandir'] = os.scandir
+        counter = self
+
+        class CountingEntry(object):
+            def __init__(self, entry):
+                self._entry = entry
+                self.name = entry.name
+                self.path = entry.path
+
+            def is_dir(self, **kwargs):
+                return self._entry.is_dir(**kwargs)
+
+            def is_symlink(self):
+                return self._entry.is_symlink()
+
+            def stat(self, **kwargs):
+                counter._count('DirEntry.stat')
+                return self._entry.stat(**kwargs)
+
+        class CountingScandir(object):
+            def __init__(self, path='.'):
+                counter._count('scandir')
+                self._iterator = original_scandir(path)
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                return CountingEntry(next(self._iterator))
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self._iterator.close()
+
+        os.scandir = CountingScandir
+        return self
+
+    def __exit__(self, *args):
+        for name, original in self._originals.items():
+            setattr(os, name, original)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        build_tree(root, args.files)
+        scans = (
+            ('legacy', lambda: legacy_scan(root)),
+            ('scandir', lambda: scandir_scan(root)),
+            ('parallel', lambda: scandir_scan(root, args.workers)),
+        )
+        expected = sorted(legacy_scan(root))
+        print('%-9s %9s  %s' % ('method', 'seconds', 'filesystem calls'))
+        for name, scan in scans:
+            assert sorted(scan()) == expected
+            best = None
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                scan()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            with CallCounter() as counter:
+                scan()
+            calls = ', '.join('%s=%s' % item
+                              for item in sorted(counter.counts.items()))
+            print('%-9s %9.3f  %s' % (name, best, calls))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+""" Compares per-file requests against packs for a build of tiny files.
+
+Usage: python benchmarks/bench_packs.py [--files 3000] [--latency-ms 30]
+           [--pack-mb 8] [--concurrency 16]
+
+The local server delays every response by --latency-ms to stand in for the
+time to first byte of a real CDN. The same files (1 to 16 KB each) are
+downloaded once as one request per file and once as tar packs of about
+--pack-mb MB, both through a DownloadTracker with --concurrency workers
+sharing one pooled HTTP client. Reports the wall time, the number of
+requests and the effective throughput of each.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from download import Download, DownloadTracker  # noqa: E402
+from http_client import HTTPClient  # noqa: E402
+from packs import PackDownload  # noqa: E402
+from local_server import LocalServer  # noqa: E402
+
+
+def make_files(count, rng):
+    return {'data/%04d/file_%s.cfg' % (i // 100, i):
+            os.urandom(rng.randint(1024, 16 * 1024)) for i in range(count)}
+
+
+def make_packs(files, pack_size):
+    packs, buffer, names = {}, None, []
+
+    def flush():
+        name = '/pack_%04d.tar' % len(packs)
+        packs[name] = (buffer.getvalue(), list(names))
+
+    for path in sorted(files):
+        if buffer is None:
+            buffer, names = io.BytesIO(), []
+            tar = tarfile.open(fileobj=buffer, mode='w')
+        info = tarfile.TarInfo(path)
+        info.size = len(files[path])
+        tar.addfile(info, io.BytesIO(files[path]))
+        names.append(path)
+        if buffer.tell() >= pack_size:
+            tar.close()
+            flush()
+            buffer = None
+    if buffer is not None:
+        tar.close()
+        flush()
+    return packs
+
+
+def run(tracker, client):
+    loop = asyncio.new_event_loop()
+    start = time.perf_counter()
+    loop.run_until_complete(tracker.run_async(client))
+    loop.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=3000)
+    parser.add_argument('--latency-ms', type=float, default=30)
+    parser.add_argument('--pack-mb', type=float, default=8)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    files = make_files(args.files, random.Random(1))
+    packs = make_packs(files, int(args.pack_mb * 1024**2))
+    total = sum(len(data) for data in files.values())
+    work_dir = tempfile.mkdtemp()
+    try:
+        with LocalServer(latency=args.latency_ms / 1000) as server:
+            server.files.update(('/' + path, data)
+                                for path, data in files.items())
+            server.files.update((name, pack) for name, (pack, _)
+                                in packs.items())
+
+            def member(path):
+                full_path = os.path.join(work_dir, path)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                return Download(full_path, server.url('/' + path),
+                                len(files[path]),
+                                hashlib.sha256(files[path]).hexdigest())
+
+            print('%d files, %.1f MB, %d packs, %.0f ms latency' % (
+                len(files), total / 1024**2, len(packs), args.latency_ms))
+            print('%-10s %10s %10s %10s' % (
+                'mode', 'seconds', 'requests', 'MB/s'))
+            for mode in ('files', 'packs'):
+                tracker = DownloadTracker(
+                    None, ThreadPoolExecutor(args.concurrency),
+                    max_downloads=args.concurrency)
+                if mode == 'files':
+                    for path in files:
+                        tracker.add(member(path))
+                else:
+                    for name, (pack, names) in packs.items():
+                        tracker.add(PackDownload(
+                            os.path.join(work_dir, name[1:]),
+                            server.url(name), len(pack),
+                            hashlib.sha256(pack).hexdigest(),
+                            {path: member(path) for path in names}))
+                server.request_count = 0
+                with HTTPClient(args.concurrency) as client:
+                    seconds = run(tracker, client)
+                print('%-10s %10.2f %10d %10.2f' % (
+                    mode, seconds, server.request_count,
+                    total / 1024**2 / seconds))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
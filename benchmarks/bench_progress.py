@@ -0,0 +1,60 @@
+""" Times one progress update for trackers with many files.
+
+Usage: python benchmarks/bench_progress.py [--files 50000]
+
+Compares DownloadTracker.update, which reads running totals, with summing
+every Download's size and progress the way update used to.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from download import DownloadTracker  # noqa: E402
+
+
+class ProgressBar(object):
+
+    def setMinimum(self, value):
+        pass
+
+    def setMaximum(self, value):
+        pass
+
+    def setValue(self, value):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, nargs='+',
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    print('%8s %14s %14s' % ('files', 'summed us', 'running us'))
+    for count in args.files:
+        tracker = DownloadTracker(ProgressBar())
+        for i in range(count):
+            tracker.add_download('file_%s' % i, '', 4096 + i)
+        block = b'x' * 1024
+
+        def summed():
+            sum(download.total_size for download in tracker)
+            sum(download.downloaded_bytes for download in tracker)
+
+        def running():
+            # make progress each time so the update is not coalesced away
+            tracker.downloads[0]._inc_download(block)
+            tracker.update()
+
+        print('%8d %14.1f %14.1f' % (
+            count,
+            min(timeit.repeat(summed, number=1, repeat=args.repeat)) * 1e6,
+            min(timeit.repeat(running, number=1, repeat=args.repeat)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
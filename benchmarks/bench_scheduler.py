@@ -0,0 +1,117 @@
+""" Simulates a full game update under each download order.
+
+Usage: python benchmarks/bench_scheduler.py [--workers 16] [--trials 20]
+
+The index mimics a Unity build: one multi-gigabyte asset bundle, a few
+hundred megabyte sized files and thousands of small ones, shuffled like
+the remote index dict (a new shuffle for each trial). Every transfer gets
+at most --connection-mb MB/s and all of them together share
+--bandwidth-mb MB/s. Reports the mean and worst makespan (time until the
+last file is done), when the game binary is ready and how long the first
+half of the files took, averaged over the trials.
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from download import Download  # noqa: E402
+from scheduler import DownloadQueue, POLICIES  # noqa: E402
+
+MB = 1024**2
+
+
+def realistic_index(rng):
+    files = [('fc_Data/sharedassets0.assets', 6 * 1024 * MB),
+             ('fc.exe', 20 * MB),
+             ('fc_Data/Managed/Assembly-CSharp.dll', 8 * MB)]
+    for i in range(12):
+        files.append(('fc_Data/resources%s.assets' % i,
+                      rng.randint(200, 900) * MB))
+    for i in range(3000):
+        files.append(('fc_Data/StreamingAssets/%s.bundle' % i,
+                      int(rng.lognormvariate(11, 1.5))))
+    return files
+
+
+class IndexOrderQueue(object):
+    """ The old behaviour: downloads start in the order they were added. """
+
+    def __init__(self):
+        self.downloads = collections.deque()
+
+    def push(self, download):
+        self.downloads.append(download)
+
+    def pop(self):
+        return self.downloads.popleft() if self.downloads else None
+
+
+def simulate(files, queue, workers, bandwidth, per_connection_rate):
+    """ Returns the finish time of every file when transfers share the link
+    equally, up to per_connection_rate each. """
+    for path, size in files:
+        queue.push(Download(path, '', size))
+    now = 0.0
+    finished = {}
+    active = {}
+    while True:
+        while len(active) < workers:
+            download = queue.pop()
+            if download is None:
+                break
+            active[download.file_path] = float(download.total_size)
+        if not active:
+            return finished
+        rate = min(per_connection_rate, bandwidth / len(active))
+        elapsed = min(active.values()) / rate
+        now += elapsed
+        for path in list(active):
+            active[path] -= elapsed * rate
+            if active[path] <= 1e-6:
+                del active[path]
+                finished[path] = now
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--bandwidth-mb', type=float, default=100)
+    parser.add_argument('--connection-mb', type=float, default=20)
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    files = realistic_index(rng)
+    print('%d files, %.1f GB total, %d trials' % (
+        len(files), sum(size for _, size in files) / 1024**3, args.trials))
+    print('%-16s %10s %10s %12s %14s' % (
+        'order', 'mean s', 'worst s', 'binary at s', 'half files s'))
+    orders = [('index order', IndexOrderQueue)]
+    orders += [(policy, lambda policy=policy: DownloadQueue(
+        policy, ['fc.exe'])) for policy in POLICIES]
+    shuffles = []
+    for _ in range(args.trials):
+        rng.shuffle(files)
+        shuffles.append(list(files))
+    for policy, create_queue in orders:
+        makespans, binary, half = [], 0, 0
+        for shuffled in shuffles:
+            finished = simulate(shuffled, create_queue(), args.workers,
+                                args.bandwidth_mb * MB,
+                                args.connection_mb * MB)
+            times = sorted(finished.values())
+            makespans.append(times[-1])
+            binary += finished['fc.exe'] / args.trials
+            half += times[len(times) // 2] / args.trials
+        print('%-16s %10.1f %10.1f %12.1f %14.1f' % (
+            policy, sum(makespans) / args.trials, max(makespans), binary,
+            half))
+
+
+if __name__ == '__main__':
+    main()
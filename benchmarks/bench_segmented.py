@@ -0,0 +1,73 @@
+""" Compares single stream and segmented downloads of one large file.
+
+Usage: python benchmarks/bench_segmented.py [--size-mb 256] [--rate-mb 16]
+
+The local server caps every connection at --rate-mb MB/s to stand in for a
+high latency link where a single TCP stream can't fill the pipe. The
+segmented download should scale with the number of connections until it
+hits the disk or the loopback interface.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import requests  # noqa: E402
+from download import download_file, download_segmented  # noqa: E402
+from local_server import LocalServer  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--rate-mb', type=float, default=16)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--segment-mb', type=int, default=16)
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[2, 4, 8])
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    data = os.urandom(args.size_mb * 1024**2)
+    filehash = hashlib.sha256(data).hexdigest()
+    work_dir = tempfile.mkdtemp()
+    server = LocalServer(latency=args.latency,
+                         per_connection_rate=args.rate_mb * 1024**2)
+    server.files['/asset.bin'] = data
+    try:
+        with server, requests.Session() as session:
+            url = server.url('/asset.bin')
+            path = os.path.join(work_dir, 'asset.bin')
+            runs = [('single stream', lambda: download_file(
+                url, path, session=session, filehash=filehash))]
+            for connections in args.connections:
+                runs.append(('%s connections' % connections,
+                             lambda connections=connections:
+                             download_segmented(
+                                 url, path, len(data), session=session,
+                                 filehash=filehash,
+                                 segment_size=args.segment_mb * 1024**2,
+                                 connections=connections)))
+            print('%-16s %9s %9s' % ('method', 'seconds', 'MB/s'))
+            for name, run in runs:
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                with open(path, 'rb') as downloaded:
+                    assert hashlib.sha256(
+                        downloaded.read()).hexdigest() == filehash
+                os.remove(path)
+                print('%-16s %9.2f %9.1f' % (
+                    name, elapsed, args.size_mb / elapsed))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
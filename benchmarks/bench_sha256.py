@@ -0,0 +1,117 @@
+""" Compares util.sha256_hash against the original read()-based hasher.
+
+Usage: python benchmarks/bench_sha256.py [--max-size 4G] [--dir PATH]
+
+Test files are filled with random data and written to --dir (defaults to a
+temporary directory). Each file is hashed once to warm the page cache and
+then timed over several rounds, so the numbers measure hashing and copying
+overhead rather than disk speed.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from util import sha256_hash, CHUNK_SIZE  # noqa: E402
+
+SIZES = (
+    ('1K', 1024),
+    ('64K', 64 * 1024),
+    ('1M', 1024**2),
+    ('64M', 64 * 1024**2),
+    ('1G', 1024**3),
+    ('4G', 4 * 1024**3),
+)
+
+
+def legacy_sha256_hash(filepath, block_size=CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as hash_file:
+        for block in iter(lambda: hash_file.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def parse_size(text):
+    for label, size in SIZES:
+        if label == text.upper():
+            return size
+    return int(text)
+
+
+def write_file(path, size):
+    with open(path, 'wb') as test_file:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 16 * CHUNK_SIZE))
+            test_file.write(block)
+            remaining -= len(block)
+
+
+def time_hash(function, path, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def allocated_bytes(function, path):
+    """ Peak bytes allocated by Python while hashing path once. """
+    tracemalloc.start()
+    try:
+        function(path)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--max-size', default='4G',
+                        help='largest test file to generate (e.g. 64M)')
+    parser.add_argument('--dir', default=None,
+                        help='directory to write test files to')
+    args = parser.parse_args()
+    max_size = parse_size(args.max_size)
+    logging.disable(logging.INFO)
+
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    print('%6s %12s %12s %9s %12s %12s' % (
+        'size', 'legacy MB/s', 'new MB/s', 'speedup', 'legacy peak',
+        'new peak'))
+    try:
+        for label, size in SIZES:
+            if size > max_size:
+                break
+            path = os.path.join(work_dir, label)
+            write_file(path, size)
+            # keep the total amount hashed per measurement roughly constant
+            rounds = max(3, min(1000, (256 * 1024**2) // size))
+            assert legacy_sha256_hash(path) == sha256_hash(path)
+            legacy = time_hash(legacy_sha256_hash, path, rounds)
+            new = time_hash(sha256_hash, path, rounds)
+            # warm the per-thread buffer before measuring allocations
+            sha256_hash(path)
+            legacy_peak = allocated_bytes(legacy_sha256_hash, path)
+            new_peak = allocated_bytes(sha256_hash, path)
+            megabytes = size / 1024**2
+            print('%6s %12.1f %12.1f %8.2fx %12d %12d' % (
+                label, megabytes / legacy, megabytes / new, legacy / new,
+                legacy_peak, new_peak))
+            os.remove(path)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
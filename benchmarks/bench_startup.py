@@ -0,0 +1,144 @@
+""" Compares the startup check done one step after the other with the
+overlapped one: the local scan running while the remote index downloads.
+
+Usage: python benchmarks/bench_startup.py [--files 20000] [--missing 2000]
+           [--index-seconds 1.0]
+
+Builds an install of --files small files whose hashes are already cached,
+and an index listing them plus --missing files in a folder the install
+doesn't have. The index is served in blocks spread evenly over
+--index-seconds, like a slow connection would. "sequential" scans the
+install and then fetches the index, the way the launcher's status and
+update checks used to run; "overlapped" starts both at once, as
+MainWindow.start_game_checks does now. For each, prints the time until the
+plan (and so the "Update Game" button) is ready and until the first missing
+file could start downloading with prefetch_missing_files.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import common  # noqa: E402
+from download import DownloadTracker  # noqa: E402
+from ui import Branch  # noqa: E402
+from util import namedtuple_from_mapping  # noqa: E402
+
+
+class SlowIndex(object):
+
+    def __init__(self, body, seconds):
+        self.body = body
+        self.seconds = seconds
+
+    def get(self, http_client, url, **kwargs):
+        return self
+
+    def iter_content(self, block_size):
+        blocks = range(0, len(self.body), block_size)
+        for start in blocks:
+            time.sleep(self.seconds / len(blocks))
+            yield self.body[start:start + block_size]
+
+
+class FirstStart(DownloadTracker):
+    """ Notes when the first missing file would have started downloading,
+    without downloading anything. """
+    first = None
+
+    def start(self, download, session=None):
+        if self.first is None:
+            self.first = time.perf_counter()
+
+
+def make_install(directory, count, missing):
+    files = {}
+    for i in range(count):
+        relative = 'Data/%03d/asset_%06d.bin' % (i // 200, i)
+        data = b'%d' % i
+        path = os.path.join(directory, 'install', relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as asset:
+            asset.write(data)
+        files[relative] = {'sha256': hashlib.sha256(data).hexdigest(),
+                           'size': len(data)}
+    for i in range(missing):
+        files['DLC/asset_%06d.bin' % i] = {'sha256': '%064x' % i, 'size': 1}
+    return json.dumps({
+        'base_url': 'https://patch.example.net', 'project': 'bench',
+        'branch': 'develop', 'platform': 'Windows',
+        'url_format': '{base_url}/{filename}_{filehash}', 'files': files,
+    }).encode('utf8')
+
+
+def make_branch(directory, body, seconds):
+    cfg = namedtuple_from_mapping(dict(index_endpoint='{branch}/index'))
+    branch = Branch('bench', 'develop', cfg,
+                    metadata_cache=SlowIndex(body, seconds))
+    branch.directory = os.path.join(directory, 'install')
+    branch.hash_cache.path = os.path.join(directory, 'hashes.json')
+    branch.journal.path = os.path.join(directory, 'journal.json')
+    branch.index_snapshot = os.path.join(directory, 'index.json')
+    branch.set_download_tracker(FirstStart(None))
+    branch.prefetch = True
+    # don't create the missing folder in the install
+    branch._start_prefetch = lambda matcher, context: matcher.watch_missing(
+        lambda *args: branch.download_tracker.start(None))
+    return branch
+
+
+def sequential(branch, executor):
+    branch.index_directory()
+    branch.fetch_remote_index(dict(common.GLOBAL_CONTEXT))
+
+
+def overlapped(branch, executor):
+    branch.begin_scan()
+    fetch = executor.submit(branch.fetch_remote_index,
+                            dict(common.GLOBAL_CONTEXT))
+    branch.index_directory()
+    fetch.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--missing', type=int, default=2000)
+    parser.add_argument('--index-seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    common.loop = asyncio.new_event_loop()
+    directory = tempfile.mkdtemp()
+    try:
+        body = make_install(directory, args.files, args.missing)
+        print('%d local files, %d missing, %.1f MB index over %.1fs' % (
+            args.files, args.missing, len(body) / 1024**2,
+            args.index_seconds))
+        # fill the hash cache, as any start after the first one would have
+        sequential(make_branch(directory, body, 0), None)
+        print('%-12s %14s %14s' % ('check', 'plan ready s',
+                                   'first start s'))
+        with ThreadPoolExecutor(1) as executor:
+            for name, check in (('sequential', sequential),
+                                ('overlapped', overlapped)):
+                branch = make_branch(directory, body, args.index_seconds)
+                start = time.perf_counter()
+                check(branch, executor)
+                elapsed = time.perf_counter() - start
+                assert len(branch.plan.missing) == args.missing
+                print('%-12s %14.2f %14.2f' % (
+                    name, elapsed, branch.download_tracker.first - start))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
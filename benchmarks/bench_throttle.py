@@ -0,0 +1,70 @@
+""" Checks how closely the shared bandwidth limit is held.
+
+Usage: python benchmarks/bench_throttle.py [--files 8] [--size-mb 4]
+
+Downloads --files files at once from a local server under several limits,
+and reports the achieved combined rate, its error against the limit, and
+the slowest and fastest per-file rates to show how fairly the limit is
+shared between concurrent downloads.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import requests  # noqa: E402
+from download import download_file  # noqa: E402
+from local_server import LocalServer  # noqa: E402
+from throttle import BandwidthSchedule, TokenBucket  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--size-mb', type=float, default=4)
+    parser.add_argument('--limits-mb', type=float, nargs='+',
+                        default=[2, 8, 32])
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    size = int(args.size_mb * 1024**2)
+    server = LocalServer()
+    for i in range(args.files):
+        server.files['/file_%s' % i] = os.urandom(size)
+    print('%10s %10s %8s %12s %12s' % (
+        'limit MB/s', 'got MB/s', 'error', 'slowest MB/s', 'fastest MB/s'))
+    with server, requests.Session() as session, \
+            ThreadPoolExecutor(args.files) as executor:
+        session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_maxsize=args.files))
+        for limit in args.limits_mb:
+            bucket = TokenBucket(BandwidthSchedule(limit * 1024**2))
+            work_dir = tempfile.mkdtemp()
+
+            def fetch(i):
+                started = time.perf_counter()
+                download_file(server.url('/file_%s' % i),
+                              os.path.join(work_dir, 'file_%s' % i),
+                              session=session, throttle=bucket)
+                return time.perf_counter() - started
+
+            try:
+                start = time.perf_counter()
+                durations = list(executor.map(fetch, range(args.files)))
+                elapsed = time.perf_counter() - start
+            finally:
+                shutil.rmtree(work_dir)
+            achieved = args.files * args.size_mb / elapsed
+            print('%10.1f %10.2f %7.1f%% %12.2f %12.2f' % (
+                limit, achieved, 100 * (achieved - limit) / limit,
+                args.size_mb / max(durations), args.size_mb / min(durations)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" Compares building download URLs with the old regex based
+inject_variables against compiled templates.
+
+Usage: python benchmarks/bench_url_templates.py [--urls 100000]
+
+Builds --urls download URLs from the default url_format the way
+Branch._diff_files does (updating a shared context with each file's name
+and hash): once with the original findall and str.replace implementation,
+once through inject_variables, which now looks the compiled template up in
+its cache on every call, and once with a template compiled ahead of the
+loop.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from common import inject_variables, compile_template  # noqa: E402
+from common import vars_regex, GLOBAL_CONTEXT  # noqa: E402
+
+URL_FORMAT = '{base_url}/{project}/{branch}/{platform}/{filename}_{filehash}'
+
+
+def legacy_inject_variables(path_format, vars_obj=GLOBAL_CONTEXT):
+    matches = vars_regex.findall(path_format)
+    path = path_format
+    vars_is_dict = isinstance(vars_obj, dict)
+    for match in matches:
+        if vars_is_dict:
+            replacement = vars_obj.get(match)
+        else:
+            replacement = getattr(vars_obj, match, None)
+        if replacement is None:
+            continue
+        path = path.replace('{%s}' % match, str(replacement))
+    return path
+
+
+def build_urls(files, inject):
+    context = dict(GLOBAL_CONTEXT, base_url='https://patch.example.net',
+                   project='fantasy-crescendo', branch='develop')
+    start = time.perf_counter()
+    urls = []
+    for filename, filehash in files:
+        context.update(filename=filename, filehash=filehash)
+        urls.append(inject(context))
+    return time.perf_counter() - start, urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--urls', type=int, default=100000)
+    args = parser.parse_args()
+
+    files = [('data/%03d/asset_%06d.assets' % (i // 1000, i),
+              hashlib.sha256(b'%d' % i).hexdigest())
+             for i in range(args.urls)]
+    template = compile_template(URL_FORMAT)
+    results = {}
+    print('%-18s %10s %12s' % ('method', 'seconds', 'urls/s'))
+    for name, inject in (
+            ('regex', lambda context: legacy_inject_variables(
+                URL_FORMAT, context)),
+            ('inject_variables', lambda context: inject_variables(
+                URL_FORMAT, context)),
+            ('compiled', template)):
+        seconds, results[name] = build_urls(files, inject)
+        print('%-18s %10.3f %12.0f' % (name, seconds, len(files) / seconds))
+    assert results['regex'] == results['inject_variables'] == \
+        results['compiled']
+
+
+if __name__ == '__main__':
+    main()
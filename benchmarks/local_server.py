@@ -0,0 +1,85 @@
+""" A local HTTP server for the download benchmarks.
+
+Serves in-memory files with support for single byte ranges, and can
+simulate a slow network by delaying every response (latency) and capping
+how fast each connection is sent data (per_connection_rate, in bytes/s).
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+SEND_BLOCK = 64 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        data = server.files.get(self.path.split('?')[0])
+        if server.latency:
+            time.sleep(server.latency)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+        if range_header:
+            first, last = range_header.split('=')[1].split('-')
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %s-%s/%s' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        self._send(memoryview(data)[start:end + 1])
+
+    def _send(self, body):
+        rate = self.server.per_connection_rate
+        started = time.perf_counter()
+        sent = 0
+        for offset in range(0, len(body), SEND_BLOCK):
+            block = body[offset:offset + SEND_BLOCK]
+            self.wfile.write(block)
+            sent += len(block)
+            if rate:
+                ahead = sent / rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0, per_connection_rate=None):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.files = {}
+        self.latency = latency
+        self.per_connection_rate = per_connection_rate
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server_address[1], path)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
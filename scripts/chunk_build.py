@@ -0,0 +1,73 @@
+""" Splits a build into content-defined chunks and indexes them.
+
+Usage: python scripts/chunk_build.py BUILD_DIR OUTPUT_DIR [--index index.json]
+           [--chunk-url-format "{base}/{project}/chunks/{chunkhash}"]
+
+Every file under BUILD_DIR is split with FastCDC and each distinct chunk is
+written once to OUTPUT_DIR/chunks/<sha256>. Keep OUTPUT_DIR between builds
+(and share it between platforms and branches) so chunks that already exist
+are not written or uploaded again. The index, merged into --index if given,
+is written to OUTPUT_DIR/index.json with each file's "chunks" list and the
+index's "chunk_url_format" set. Chunking runs at a few MB/s per build.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from chunks import chunk_file  # noqa: E402
+from util import scan_files, sha256_hash  # noqa: E402
+
+
+def chunk_build(build_dir, output_dir, index):
+    chunk_dir = os.path.join(output_dir, 'chunks')
+    os.makedirs(chunk_dir, exist_ok=True)
+    files = index.setdefault('files', {})
+    total = unique = new = 0
+    seen = set()
+    for entry in scan_files(build_dir):
+        chunks = chunk_file(entry.full_path)
+        files.setdefault(entry.relative_path, {}).update(
+            sha256=sha256_hash(entry.full_path), size=entry.stat.st_size,
+            chunks=chunks)
+        with open(entry.full_path, 'rb') as build_file:
+            for chunk_hash, size in chunks:
+                data = build_file.read(size)
+                total += size
+                if chunk_hash in seen:
+                    continue
+                seen.add(chunk_hash)
+                unique += size
+                path = os.path.join(chunk_dir, chunk_hash)
+                if not os.path.exists(path):
+                    new += size
+                    with open(path, 'wb') as chunk_out:
+                        chunk_out.write(data)
+    return total, unique, new
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('build_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--index')
+    parser.add_argument('--chunk-url-format',
+                        default='{base}/{project}/chunks/{chunkhash}')
+    args = parser.parse_args()
+
+    index = {}
+    if args.index:
+        with open(args.index) as index_file:
+            index = json.load(index_file)
+    total, unique, new = chunk_build(args.build_dir, args.output_dir, index)
+    index['chunk_url_format'] = args.chunk_url_format
+    with open(os.path.join(args.output_dir, 'index.json'), 'w') as out:
+        json.dump(index, out, indent=2, sort_keys=True)
+    print('%.1f MB in files, %.1f MB of distinct chunks, %.1f MB new' % (
+        total / 1024**2, unique / 1024**2, new / 1024**2))
+
+
+if __name__ == '__main__':
+    main()
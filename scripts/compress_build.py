@@ -0,0 +1,80 @@
+""" Publishes compressed copies of a build's files and indexes them.
+
+Usage: python scripts/compress_build.py BUILD_DIR OUTPUT_DIR
+           [--encoding zstd] [--level N] [--min-ratio 0.95]
+           [--name-format "{filename}_{filehash}"] [--index index.json]
+
+Every file under BUILD_DIR is hashed and compressed to OUTPUT_DIR, named by
+--name-format (the same variables as the index's url_format path) plus the
+encoding's suffix. The payload is only kept when it is at most --min-ratio
+of the raw size; already compressed assets are served as they are. The
+index, merged into --index if given, is written to OUTPUT_DIR/index.json
+with "encoding" and "compressed_size" set for the files that kept one.
+The raw files still have to be uploaded next to the payloads, for launchers
+that can't decode them.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from compression import compress_file, encoded_url, is_supported, \
+     GZIP, ZSTD  # noqa: E402
+from util import scan_files, sha256_hash  # noqa: E402
+
+
+def compress_build(build_dir, output_dir, encoding, index, level=None,
+                   min_ratio=0.95, name_format='{filename}_{filehash}'):
+    files = index.setdefault('files', {})
+    saved = 0
+    for entry in scan_files(build_dir):
+        size = entry.stat.st_size
+        filehash = sha256_hash(entry.full_path)
+        filedata = {'sha256': filehash, 'size': size}
+        name = name_format.format(filename=entry.relative_path,
+                                  filehash=filehash)
+        destination = encoded_url(os.path.join(output_dir, name), encoding)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        compress_file(entry.full_path, destination, encoding, level)
+        compressed_size = os.path.getsize(destination)
+        if size and compressed_size <= size * min_ratio:
+            filedata.update(encoding=encoding,
+                            compressed_size=compressed_size)
+            saved += size - compressed_size
+        else:
+            os.remove(destination)
+        files[entry.relative_path] = filedata
+        print('%-60s %12d -> %s' % (entry.relative_path, size,
+                                    filedata.get('compressed_size', 'raw')))
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('build_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--encoding', choices=(GZIP, ZSTD), default=ZSTD)
+    parser.add_argument('--level', type=int)
+    parser.add_argument('--min-ratio', type=float, default=0.95)
+    parser.add_argument('--name-format', default='{filename}_{filehash}')
+    parser.add_argument('--index')
+    args = parser.parse_args()
+
+    if not is_supported(args.encoding):
+        parser.error('%s needs the zstandard package' % args.encoding)
+    index = {}
+    if args.index:
+        with open(args.index) as index_file:
+            index = json.load(index_file)
+    saved = compress_build(args.build_dir, args.output_dir, args.encoding,
+                           index, args.level, args.min_ratio,
+                           args.name_format)
+    with open(os.path.join(args.output_dir, 'index.json'), 'w') as out:
+        json.dump(index, out, indent=2, sort_keys=True)
+    print('Saved %.1f MB' % (saved / 1024**2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+""" Builds deltas from a previous build to the current one.
+
+Usage: python scripts/make_deltas.py OLD_BUILD_DIR NEW_BUILD_DIR OUTPUT_DIR
+           [--index index.json] [--max-ratio 0.5] [--block-size 8192]
+           [--name-format "{filename}_{filehash}"]
+
+Every file of the new build whose contents changed since the old build gets
+a delta, written to OUTPUT_DIR as its --name-format name (the same
+variables as the index's url_format path) plus '.<old sha256>.delta'. Each
+delta is applied once to check it rebuilds the new file, and only kept
+when it is at most --max-ratio of the file's size. The index, merged into
+--index if given, is written to OUTPUT_DIR/index.json with the kept deltas
+listed under the file's "deltas", keyed by the old hash. Run it once per
+previous build that players should be able to patch from.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from delta import apply_delta, delta_url, make_delta, \
+     BLOCK_SIZE  # noqa: E402
+from util import scan_files, sha256_hash  # noqa: E402
+
+
+def _check_delta(source_path, delta_path, filehash):
+    hasher = hashlib.sha256()
+    with open(delta_path, 'rb') as delta_file, \
+            open(os.devnull, 'wb') as output:
+        apply_delta(source_path, delta_file, output, hasher.update)
+    return hasher.hexdigest() == filehash
+
+
+def make_deltas(old_dir, new_dir, output_dir, index, max_ratio=0.5,
+                block_size=BLOCK_SIZE, name_format='{filename}_{filehash}'):
+    files = index.setdefault('files', {})
+    saved = 0
+    for entry in scan_files(new_dir):
+        size = entry.stat.st_size
+        filehash = sha256_hash(entry.full_path)
+        filedata = files.setdefault(entry.relative_path, {})
+        filedata.update(sha256=filehash, size=size)
+        old_path = os.path.join(old_dir, entry.relative_path)
+        if not os.path.isfile(old_path):
+            continue
+        old_hash = sha256_hash(old_path)
+        if old_hash == filehash:
+            continue
+        name = name_format.format(filename=entry.relative_path,
+                                  filehash=filehash)
+        destination = delta_url(os.path.join(output_dir, name), old_hash)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'wb') as delta_file:
+            make_delta(old_path, entry.full_path, delta_file, block_size)
+        delta_size = os.path.getsize(destination)
+        if delta_size > size * max_ratio or \
+                not _check_delta(old_path, destination, filehash):
+            os.remove(destination)
+            print('%-60s %12d -> full' % (entry.relative_path, size))
+            continue
+        filedata.setdefault('deltas', {})[old_hash] = {'size': delta_size}
+        saved += size - delta_size
+        print('%-60s %12d -> %s' % (entry.relative_path, size, delta_size))
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old_dir')
+    parser.add_argument('new_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--index')
+    parser.add_argument('--max-ratio', type=float, default=0.5)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--name-format', default='{filename}_{filehash}')
+    args = parser.parse_args()
+
+    index = {}
+    if args.index:
+        with open(args.index) as index_file:
+            index = json.load(index_file)
+    saved = make_deltas(args.old_dir, args.new_dir, args.output_dir, index,
+                        args.max_ratio, args.block_size, args.name_format)
+    with open(os.path.join(args.output_dir, 'index.json'), 'w') as out:
+        json.dump(index, out, indent=2, sort_keys=True)
+    print('Saved %.1f MB for players updating from %s' % (
+        saved / 1024**2, args.old_dir))
+
+
+if __name__ == '__main__':
+    main()
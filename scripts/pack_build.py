@@ -0,0 +1,99 @@
+""" Bundles a build's small files into packs and indexes them.
+
+Usage: python scripts/pack_build.py BUILD_DIR OUTPUT_DIR [--index index.json]
+           [--max-file-size 65536] [--pack-size 8388608]
+           [--name-format "{filename}_{filehash}"]
+
+Files under BUILD_DIR of at most --max-file-size bytes are grouped, in path
+order so files from the same directory share packs, into uncompressed tar
+packs of about --pack-size bytes. Each pack is written to OUTPUT_DIR under
+its --name-format name, like any other file of the build, so it is served
+from the index's url_format. The index, merged into --index if given, is
+written to OUTPUT_DIR/index.json with "packs" listing every pack and each
+packed file naming its "pack". Packed files still have to be uploaded on
+their own as well: the launcher fetches a file by itself when it is the
+only one of its pack that needs updating, or when the pack is broken.
+"""
+import argparse
+import json
+import os
+import sys
+import tarfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from util import scan_files, sha256_hash  # noqa: E402
+
+
+def _write_pack(path, entries):
+    with tarfile.open(path, 'w', format=tarfile.PAX_FORMAT) as pack:
+        for entry in entries:
+            info = pack.gettarinfo(entry.full_path, entry.relative_path)
+            # reproducible packs: only the contents matter
+            info.mtime = info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            info.mode = 0o644
+            with open(entry.full_path, 'rb') as member:
+                pack.addfile(info, member)
+
+
+def pack_build(build_dir, output_dir, index, max_file_size=64 * 1024,
+               pack_size=8 * 1024**2, name_format='{filename}_{filehash}'):
+    files = index.setdefault('files', {})
+    packs = index['packs'] = {}
+    groups, group, group_size = [], [], 0
+    for entry in sorted(scan_files(build_dir),
+                        key=lambda entry: entry.relative_path):
+        size = entry.stat.st_size
+        filedata = files.setdefault(entry.relative_path, {})
+        filedata.update(sha256=sha256_hash(entry.full_path), size=size)
+        filedata.pop('pack', None)
+        if size > max_file_size:
+            continue
+        group.append(entry)
+        group_size += size
+        if group_size >= pack_size:
+            groups.append(group)
+            group, group_size = [], 0
+    if group:
+        groups.append(group)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for number, entries in enumerate(groups):
+        name = 'pack_%04d.tar' % number
+        temp_path = os.path.join(output_dir, name + '.tmp')
+        _write_pack(temp_path, entries)
+        filehash = sha256_hash(temp_path)
+        packs[name] = {'sha256': filehash,
+                       'size': os.path.getsize(temp_path)}
+        os.replace(temp_path, os.path.join(
+            output_dir, name_format.format(filename=name, filehash=filehash)))
+        for entry in entries:
+            files[entry.relative_path]['pack'] = name
+        print('%s: %d files, %d bytes' % (name, len(entries),
+                                          packs[name]['size']))
+    return len(groups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('build_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--index')
+    parser.add_argument('--max-file-size', type=int, default=64 * 1024)
+    parser.add_argument('--pack-size', type=int, default=8 * 1024**2)
+    parser.add_argument('--name-format', default='{filename}_{filehash}')
+    args = parser.parse_args()
+
+    index = {}
+    if args.index:
+        with open(args.index) as index_file:
+            index = json.load(index_file)
+    pack_build(args.build_dir, args.output_dir, index, args.max_file_size,
+               args.pack_size, args.name_format)
+    with open(os.path.join(args.output_dir, 'index.json'), 'w') as out:
+        json.dump(index, out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+""" Splits a flat index into a tree of per-directory shards.
+
+Usage: python scripts/shard_index.py INDEX OUTPUT_DIR
+           [--shard-url-format
+            "{base_url}/{project}/{branch}/{platform}/shards/{shardhash}"]
+
+INDEX is a flat index.json, as written by the other scripts. Every
+directory of the build gets a shard listing its own files and the hashes of
+its subdirectories' shards, so a shard's hash changes exactly when
+something below it does. Shards are written to OUTPUT_DIR/shards/<sha256>
+and OUTPUT_DIR/index.json gets everything from INDEX except "files", plus
+"shard_root" and "shard_url_format". INDEX itself is left as it is, so the
+flat format can still be served to launchers that don't read shards. Keep
+OUTPUT_DIR between builds: unchanged directories keep their shards.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from shards import encode_shard, hash_shard  # noqa: E402
+
+
+def _tree(files):
+    root = {'files': {}, 'dirs': {}}
+    for filename, filedata in files.items():
+        node = root
+        parts = filename.split('/')
+        for part in parts[:-1]:
+            node = node['dirs'].setdefault(part, {'files': {}, 'dirs': {}})
+        node['files'][parts[-1]] = filedata
+    return root
+
+
+def _write_shards(node, shard_dir, stats):
+    dirs = {name: _write_shards(child, shard_dir, stats)
+            for name, child in node['dirs'].items()}
+    data = encode_shard(node['files'], dirs)
+    shard_hash = hash_shard(data)
+    path = os.path.join(shard_dir, shard_hash)
+    stats['shards'] += 1
+    if not os.path.exists(path):
+        stats['new'] += 1
+        with open(path, 'wb') as shard_file:
+            shard_file.write(data)
+    return shard_hash
+
+
+def shard_index(index, output_dir):
+    shard_dir = os.path.join(output_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    stats = {'shards': 0, 'new': 0}
+    root = _write_shards(_tree(index.get('files', {})), shard_dir, stats)
+    return root, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('index')
+    parser.add_argument('output_dir')
+    parser.add_argument(
+        '--shard-url-format',
+        default='{base_url}/{project}/{branch}/{platform}/shards/{shardhash}')
+    args = parser.parse_args()
+
+    with open(args.index) as index_file:
+        index = json.load(index_file)
+    root, stats = shard_index(index, args.output_dir)
+    index.pop('files', None)
+    index.update(shard_root=root, shard_url_format=args.shard_url_format)
+    with open(os.path.join(args.output_dir, 'index.json'), 'w') as out:
+        json.dump(index, out, indent=2, sort_keys=True)
+    print('%d shards, %d new, root %s' % (stats['shards'], stats['new'],
+                                          root))
+
+
+if __name__ == '__main__':
+    main()
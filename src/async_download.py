@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from download import DownloadTracker, PART_SUFFIX, CHECKPOINT_SIZE,\
+     IDENTITY_HEADERS, _resume_offset, _save_progress,\
+     _clear_progress, _range_start, _hash_prefix
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# File writes (and hashing) are handed off to a small pool so they never
+# block the event loop, which is also the Qt UI thread.
+IO_WORKERS = 4
+READ_SIZE = 64 * 1024
+# Large files may take far longer than aiohttp's default five minute total
+# timeout; only a stalled read is treated as a failure.
+SOCK_READ_TIMEOUT = 60
+
+
+class AsyncDownloadTracker(DownloadTracker):
+    """ A DownloadTracker that fetches files with non-blocking sockets.
+    Instead of one executor thread per download, every transfer is a
+    coroutine on the event loop sharing one pooled aiohttp session, with at
+    most max_downloads transfers in flight, taken from the queue in the
+    tracker's policy order. Everything but plain downloads (segmented,
+    compressed, patched or chunked files) still goes through the executor.
+    Requires the optional aiohttp package.
+    """
+
+    def __init__(self, progress_bar, executor=None, io_workers=IO_WORKERS,
+                 **kwargs):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for AsyncDownloadTracker')
+        super().__init__(progress_bar, executor, **kwargs)
+        self.io_workers = io_workers
+        self.active_downloads = 0
+        self.peak_active_downloads = 0
+
+    def _execute_requests(self, loop, session=None):
+        return asyncio.ensure_future(
+            self._download_all(loop, session), loop=loop)
+
+    def run(self, session=None):
+        # Called from a worker thread: the transfers themselves have to run
+        # on the loop's own thread.
+        loop = asyncio.get_event_loop()
+        self._loop = loop
+        all_downloads = asyncio.run_coroutine_threadsafe(
+            self._download_all(loop, session), loop)
+        self._wait_from_thread(loop, all_downloads)
+        self._loop = None
+        loop.call_soon_threadsafe(self.update)
+
+    async def _download_all(self, loop, session=None):
+        queue, workers = self._create_queue()
+        connector = aiohttp.TCPConnector(limit=self.max_downloads)
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_read=SOCK_READ_TIMEOUT)
+        io_executor = ThreadPoolExecutor(self.io_workers)
+        try:
+            async with aiohttp.ClientSession(connector=connector,
+                                             timeout=timeout) as client:
+                await asyncio.gather(*[
+                    self._download_worker_async(
+                        loop, client, io_executor, session)
+                    for _ in range(workers)])
+        finally:
+            io_executor.shutdown(wait=True)
+        await asyncio.gather(*self._started_downloads(loop))
+
+    async def _download_worker_async(self, loop, client, io_executor,
+                                     session):
+        download = self._next_download()
+        while download is not None:
+            # a failure is reported once the rest have been tried
+            try:
+                await self._download(loop, client, io_executor, download,
+                                     session)
+            except Exception as error:
+                self._finished(download, error)
+            else:
+                self._finished(download)
+            download = self._next_download()
+
+    async def _download(self, loop, client, io_executor, download, session):
+        self.active_downloads += 1
+        self.peak_active_downloads = max(self.peak_active_downloads,
+                                         self.active_downloads)
+        try:
+            if not download.is_plain:
+                return await loop.run_in_executor(
+                    self.executor, download.download_file, session)
+            return await self._stream(loop, client, io_executor, download)
+        finally:
+            self.active_downloads -= 1
+
+    async def _stream(self, loop, client, io_executor, download):
+        path, url = download.file_path, download.url
+        filehash = download.filehash
+        logging.info('Downloading %s from %s...' % (path, url))
+        download.downloaded_bytes = 0
+        hasher = hashlib.sha256()
+        offset = await loop.run_in_executor(
+            io_executor, _resume_offset, path, url, filehash)
+        response = None
+        if offset > 0:
+            response = await client.get(
+                url, headers=dict(IDENTITY_HEADERS,
+                                  Range='bytes=%s-' % offset))
+            if response.status != 206 or _range_start(response) != offset:
+                logging.info('Server did not resume %s (%s), restarting' %
+                             (url, response.status))
+                response.release()
+                response = None
+                offset = 0
+        if response is None:
+            response = await client.get(url, headers=IDENTITY_HEADERS)
+        try:
+            # never write an error page to disk
+            response.raise_for_status()
+        except aiohttp.ClientResponseError:
+            response.release()
+            raise
+
+        part_file = await loop.run_in_executor(
+            io_executor, _open_part, path, offset, hasher,
+            download._inc_download)
+        try:
+            written = checkpoint = offset
+            throttle = download.throttle
+            read_size = throttle.block_size(READ_SIZE) if throttle else \
+                READ_SIZE
+            async for block in response.content.iter_chunked(read_size):
+                await loop.run_in_executor(
+                    io_executor, _write_block, part_file, hasher, block)
+                download._inc_download(block)
+                written += len(block)
+                if throttle is not None:
+                    delay = throttle.reserve(len(block))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if written - checkpoint >= CHECKPOINT_SIZE:
+                    await loop.run_in_executor(
+                        io_executor, _checkpoint, part_file, path, url,
+                        filehash, written)
+                    checkpoint = written
+        finally:
+            response.release()
+            await loop.run_in_executor(io_executor, part_file.close)
+
+        download_hash = hasher.hexdigest()
+        if filehash is not None and download_hash != filehash:
+            logging.error('File download hash mismatch: (%s) \n'
+                          '   Expected: %s \n'
+                          '   Actual: %s' % (path, filehash, download_hash))
+        await loop.run_in_executor(io_executor, _finish, path)
+        logging.info('Done downloading: %s' % path)
+        return response.status
+
+
+def _open_part(path, offset, hasher, block_fun):
+    part_file = open(path + PART_SUFFIX, 'r+b' if offset > 0 else 'wb')
+    if offset > 0:
+        _hash_prefix(part_file, hasher, offset, block_fun)
+        part_file.seek(offset)
+        part_file.truncate()
+    return part_file
+
+
+def _write_block(part_file, hasher, block):
+    part_file.write(block)
+    hasher.update(block)
+
+
+def _checkpoint(part_file, path, url, filehash, offset):
+    part_file.flush()
+    os.fsync(part_file.fileno())
+    _save_progress(path, url, filehash, offset=offset)
+
+
+def _finish(path):
+    os.replace(path + PART_SUFFIX, path)
+    _clear_progress(path)
@@ -0,0 +1,311 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+HASH_CACHE_VERSION = 1
+METADATA_CACHE_DIRNAME = 'http_cache'
+
+# Files modified this recently (relative to when they were hashed) are not
+# cached. Some filesystems (FAT, SMB shares) only store timestamps to the
+# nearest two seconds, so a file rewritten right after being hashed could
+# otherwise keep the same size and mtime and be served a stale digest.
+RACY_WINDOW_NS = 2 * 10**9
+
+
+def atomic_write_json(path, data):
+    """ Writes data as JSON to path without ever leaving a partial file.
+    The payload is written to a temporary sibling file, flushed to disk and
+    then moved over the destination in a single rename.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'w') as temp_file:
+            json.dump(data, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def stat_key(stat):
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class HashCache(object):
+    """ A persistent cache of file hashes for an installation directory.
+    Digests are keyed by the file's relative path and are only reused while
+    the file's size, modification time and inode all still match what was
+    recorded when the file was last hashed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        self.entries = {}
+        self.dirty = False
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError) as error:
+            logging.warning('Discarding unreadable hash cache %s: %s' %
+                            (self.path, error))
+            return
+        if not isinstance(data, dict) or \
+                data.get('version') != HASH_CACHE_VERSION:
+            logging.info('Discarding outdated hash cache: %s' % self.path)
+            return
+        entries = data.get('files', {})
+        # Drop anything malformed rather than trusting it later.
+        self.entries = {
+            path: entry for path, entry in entries.items()
+            if isinstance(entry, list) and len(entry) == 4}
+        logging.info('Loaded %s hash cache entries from %s' %
+                     (len(self.entries), self.path))
+
+    def save(self):
+        if not self.dirty:
+            return
+        atomic_write_json(self.path, {
+            'version': HASH_CACHE_VERSION,
+            'files': self.entries
+        })
+        self.dirty = False
+        logging.info('Saved %s hash cache entries to %s' %
+                     (len(self.entries), self.path))
+
+    def lookup(self, relative_path, stat):
+        entry = self.entries.get(relative_path)
+        if entry is not None and entry[:3] == stat_key(stat):
+            self.hits += 1
+            return entry[3]
+        if entry is not None:
+            # The file changed since it was hashed.
+            del self.entries[relative_path]
+            self.dirty = True
+        self.misses += 1
+        return None
+
+    def store(self, relative_path, stat, filehash, hashed_at=None):
+        if hashed_at is None:
+            hashed_at = int(time.time() * 10**9)
+        if hashed_at - stat.st_mtime_ns < RACY_WINDOW_NS:
+            # Too close to call; hash it again next time.
+            self.entries.pop(relative_path, None)
+            return
+        self.entries[relative_path] = stat_key(stat) + [filehash]
+        self.dirty = True
+
+    def prune(self, relative_paths):
+        stale = set(self.entries) - set(relative_paths)
+        for relative_path in stale:
+            del self.entries[relative_path]
+        if stale:
+            self.dirty = True
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+class CachedResponse(object):
+    """ A response body served from a MetadataCache after a 304. """
+    status_code = 304
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf8')
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+
+class _StoringResponse(object):
+    """ Wraps a streamed response, writing its body to a MetadataCache
+    entry as it is read. The entry is only saved once the whole body has
+    been read. """
+
+    def __init__(self, cache, url, response):
+        self._cache = cache
+        self._url = url
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_content(self, chunk_size=1):
+        meta_path, body_path = self._cache._paths(self._url)
+        os.makedirs(self._cache.directory, exist_ok=True)
+        temp_path = '%s.%s.tmp' % (body_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as body_file:
+                for block in self._response.iter_content(chunk_size):
+                    body_file.write(block)
+                    yield block
+            os.replace(temp_path, body_path)
+            self._cache._store_validators(self._url, self._response)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+class MetadataCache(object):
+    """ A disk cache of small HTTP resources (indexes, configs, feeds)
+    that revalidates them with conditional requests.
+    Responses carrying an ETag or Last-Modified validator are stored in
+    directory. The next request for the same URL sends them back as
+    If-None-Match and If-Modified-Since, and a 304 is answered with the
+    stored body instead.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path + '.json', path + '.body'
+
+    def _load(self, url):
+        try:
+            with open(self._paths(url)[0], 'r') as meta_file:
+                entry = json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            logging.warning('Ignoring unreadable cache entry for %s: %s' %
+                            (url, error))
+            return None
+        if not isinstance(entry, dict) or entry.get('url') != url:
+            return None
+        return entry
+
+    @staticmethod
+    def _is_storable(response):
+        return response.headers.get('ETag') is not None or \
+            response.headers.get('Last-Modified') is not None
+
+    def _store(self, url, response):
+        if not self._is_storable(response):
+            return
+        body_path = self._paths(url)[1]
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = '%s.%s.tmp' % (body_path, os.getpid())
+        with open(temp_path, 'wb') as body_file:
+            body_file.write(response.content)
+        os.replace(temp_path, body_path)
+        self._store_validators(url, response)
+
+    def _store_validators(self, url, response):
+        atomic_write_json(self._paths(url)[0], {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        })
+
+    def get(self, session, url, **kwargs):
+        """ GETs url through session (anything with a requests style get),
+        conditionally if a validated copy is cached. Returns a
+        CachedResponse on a 304, otherwise the session's response. With
+        stream=True, a new body is stored as it is read with iter_content.
+        """
+        entry = self._load(url)
+        original_headers = kwargs.pop('headers', None) or {}
+        headers = dict(original_headers)
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        response = session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            try:
+                with open(self._paths(url)[1], 'rb') as body_file:
+                    content = body_file.read()
+            except OSError:
+                # lost the body: ask again without validators
+                return session.get(url, headers=original_headers, **kwargs)
+            self.hits += 1
+            logging.info('Not modified, using cached copy of %s' % url)
+            return CachedResponse(url, content)
+        self.misses += 1
+        if response.status_code != 200:
+            return response
+        if not kwargs.get('stream'):
+            self._store(url, response)
+        elif self._is_storable(response):
+            return _StoringResponse(self, url, response)
+        return response
+
+
+class InstallJournal(object):
+    """ Records whether a branch's installation is known to match a given
+    remote index. An update marks it dirty before touching any file. It is
+    only marked clean again, with the index's hash, by the next check that
+    finds the installation matching the index, so a crash in between
+    leaves it dirty.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as journal_file:
+                data = json.load(journal_file)
+        except (OSError, ValueError) as error:
+            logging.warning('Ignoring unreadable install journal %s: %s' %
+                            (self.path, error))
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def is_clean(self, index_hash):
+        data = self._read()
+        return data.get('clean') is True and \
+            data.get('index_sha256') == index_hash
+
+    def mark_dirty(self):
+        atomic_write_json(self.path, {'clean': False})
+
+    def applied(self, key):
+        """ A detail (like last_updated) of the index the
+        installation is known to match, or None if it isn't clean. """
+        data = self._read()
+        return data.get(key) if data.get('clean') is True else None
+
+    def mark_clean(self, index_hash, **applied):
+        data = {key: value for key, value in applied.items()
+                if value is not None}
+        data.update(clean=True, index_sha256=index_hash)
+        atomic_write_json(self.path, data)
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import requests
+import threading
+from cache import atomic_write_json
+from download import Download, PART_SUFFIX, _clear_progress
+
+# FastCDC chunk size bounds. Cut points depend only on the bytes around
+# them, so an edit only changes the chunks it touches and data shared
+# between files or builds ends up in identical chunks.
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# How many bits harder (before the average size) or easier (after it) a cut
+# point is to hit, which pulls chunk sizes towards the average.
+NORMALIZATION = 2
+
+INSTALLED_FILE = 'installed.json'
+
+_MASK64 = 2**64 - 1
+# Both the build tools and the launcher must use this exact table.
+GEAR = tuple(int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], 'big')
+             for i in range(256))
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _mask(bits):
+    # the high bits of the gear hash depend on the most recent 64 bytes
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _cut_point(data, start, min_size, avg_size, max_size):
+    end = min(len(data), start + max_size)
+    if end - start <= min_size:
+        return end
+    normal = min(end, start + avg_size)
+    bits = avg_size.bit_length() - 1
+    fingerprint = 0
+    position = start + min_size
+    for limit, mask in ((normal, _mask(bits + NORMALIZATION)),
+                        (end, _mask(bits - NORMALIZATION))):
+        for byte in data[position:limit]:
+            position += 1
+            fingerprint = ((fingerprint << 1) + GEAR[byte]) & _MASK64
+            if not fingerprint & mask:
+                return position
+    return end
+
+
+def iter_chunks(data, min_size=MIN_CHUNK_SIZE, avg_size=AVG_CHUNK_SIZE,
+                max_size=MAX_CHUNK_SIZE):
+    """ Splits data into content-defined chunks with FastCDC, yielding the
+    (offset, size) of each one. """
+    start = 0
+    while start < len(data):
+        end = _cut_point(data, start, min_size, avg_size, max_size)
+        yield start, end - start
+        start = end
+
+
+def chunk_file(path, **kwargs):
+    """ Returns the [sha256, size] list of a file's chunks, in order. """
+    with open(path, 'rb') as chunked_file:
+        if os.fstat(chunked_file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(chunked_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            return [[chunk_hash(data[offset:offset + size]), size]
+                    for offset, size in iter_chunks(data, **kwargs)]
+
+
+class ChunkStore(object):
+    """ The chunks available locally, by hash.
+    Chunks fetched during an update are kept as loose files in directory,
+    so an interrupted update resumes chunk by chunk. Installed files built
+    from chunks are recorded too, so their chunks can be read straight out
+    of them by later updates instead of being fetched again. Every chunk is
+    checked against its hash when it is read.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.installed = {}
+        self._locations = {}
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def _chunk_path(self, chunk_hash):
+        return os.path.join(self.directory, chunk_hash[:2], chunk_hash)
+
+    def load(self):
+        self.installed = {}
+        self._locations = {}
+        self._claimed = set()
+        path = os.path.join(self.directory, INSTALLED_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as installed_file:
+                self.installed = json.load(installed_file)
+        except (OSError, ValueError) as error:
+            logging.warning('Discarding unreadable chunk list %s: %s' %
+                            (path, error))
+
+    def save(self):
+        atomic_write_json(os.path.join(self.directory, INSTALLED_FILE),
+                          self.installed)
+
+    def add_installed(self, directory, files):
+        """ Makes the chunks of installed files available. files maps the
+        relative paths of local files to their current hashes; files that
+        changed since they were installed are skipped.
+        """
+        for relative, filedata in self.installed.items():
+            if files.get(relative) != filedata['sha256']:
+                continue
+            path = os.path.join(directory, relative)
+            offset = 0
+            for chunk_hash, size in filedata['chunks']:
+                self._locations.setdefault(chunk_hash, []).append(
+                    (path, offset, size))
+                offset += size
+
+    def set_installed(self, relative, filehash, chunks):
+        self.installed[relative] = {'sha256': filehash, 'chunks': chunks}
+
+    def has(self, chunk_hash):
+        return chunk_hash in self._locations or \
+            os.path.exists(self._chunk_path(chunk_hash))
+
+    def claim(self, chunks):
+        """ Claims the chunks that are neither available nor claimed yet
+        for the caller, returning their hashes. """
+        claimed = set()
+        with self._lock:
+            for chunk_hash, _ in chunks:
+                if chunk_hash in self._claimed or self.has(chunk_hash):
+                    continue
+                self._claimed.add(chunk_hash)
+                claimed.add(chunk_hash)
+        return claimed
+
+    def read(self, expected):
+        """ Returns the chunk's data, or None if it isn't available. """
+        locations = [(self._chunk_path(expected), 0, None)]
+        locations += self._locations.get(expected, [])
+        for path, offset, size in locations:
+            try:
+                with open(path, 'rb') as chunk_file:
+                    chunk_file.seek(offset)
+                    data = chunk_file.read(-1 if size is None else size)
+            except OSError:
+                continue
+            if chunk_hash(data) == expected:
+                return data
+        return None
+
+    def put(self, chunk_hash, data):
+        path = self._chunk_path(chunk_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+        with open(temp_path, 'wb') as chunk_file:
+            chunk_file.write(data)
+        os.replace(temp_path, path)
+
+    def fetch(self, chunk_hash, fetch_fun):
+        """ Returns the chunk's data, calling fetch_fun to get (and then
+        store) it if it isn't available. Concurrent fetches of one chunk
+        wait for the first. """
+        with self._lock:
+            lock = self._fetch_locks.setdefault(chunk_hash, threading.Lock())
+        with lock:
+            data = self.read(chunk_hash)
+            if data is None:
+                data = fetch_fun()
+                self.put(chunk_hash, data)
+        return data
+
+    def prune(self):
+        """ Removes the loose chunks that installed files now provide. """
+        installed = set(chunk_hash for filedata in self.installed.values()
+                        for chunk_hash, _ in filedata['chunks'])
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            for chunk in os.scandir(entry.path):
+                if chunk.name in installed:
+                    os.remove(chunk.path)
+
+
+class ChunkedDownload(Download):
+    """ Rebuilds a file from its chunks, fetching only the ones that aren't
+    in the chunk store. chunk_url has a {chunkhash} placeholder. Progress
+    counts the chunks this download claimed in the store when it was
+    created, so chunks shared by several files are only counted once.
+    """
+
+    def __init__(self, path, chunk_url, download_size, filehash, chunks,
+                 store):
+        super().__init__(path, chunk_url, download_size, filehash)
+        self.chunks = chunks
+        self.store = store
+        self._claimed = store.claim(chunks)
+        # set once the file is in place with the expected hash
+        self.rebuilt = False
+        self.total_size = sum(dict(chunks)[chunk_hash]
+                              for chunk_hash in self._claimed)
+
+    @property
+    def is_segmented(self):
+        return False
+
+    @property
+    def is_plain(self):
+        return False
+
+    def download_file(self, session=None, filehash=None):
+        filehash = filehash or self.filehash
+        get = session.get if session else requests.get
+        self.downloaded_bytes = 0
+        logging.info('Rebuilding %s from %s chunks...' %
+                     (self.file_path, len(self.chunks)))
+        _clear_progress(self.file_path)
+        hasher = hashlib.sha256()
+        part_path = self.file_path + PART_SUFFIX
+        counted = set()
+        with open(part_path, 'wb') as part_file:
+            for expected, size in self.chunks:
+                data = self.store.fetch(
+                    expected, lambda: self._fetch_chunk(get, expected))
+                part_file.write(data)
+                hasher.update(data)
+                if expected in self._claimed and expected not in counted:
+                    counted.add(expected)
+                    self.downloaded_bytes += size
+        download_hash = hasher.hexdigest()
+        if filehash is not None and download_hash != filehash:
+            logging.error('File download hash mismatch: (%s) \n'
+                          '   Expected: %s \n'
+                          '   Actual: %s' % (self.file_path, filehash,
+                                             download_hash))
+        os.replace(part_path, self.file_path)
+        self.rebuilt = filehash is None or download_hash == filehash
+        logging.info('Done rebuilding: %s' % self.file_path)
+
+    def _fetch_chunk(self, get, expected):
+        url = self.url.replace('{chunkhash}', expected)
+        response = get(url)
+        response.raise_for_status()
+        data = response.content
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+        if chunk_hash(data) != expected:
+            raise ValueError('Chunk hash mismatch: %s' % url)
+        return data
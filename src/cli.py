@@ -0,0 +1,79 @@
+""" Checks and updates game installations without the launcher's window.
+
+Usage: python cli.py [--branch NAME] [--dry-run] [--full-verify]
+
+Compares every configured branch (or only --branch, by display name or
+source branch) against its remote index and prints what would be
+downloaded or deleted. Without --dry-run, out of date branches are then
+updated.
+"""
+import argparse
+import asyncio
+import common
+import config
+import multiprocessing
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from common import GLOBAL_CONTEXT, sanitize_url
+from download import DownloadError, DownloadTracker
+from http_client import HTTPClient
+from ui import Branch, THREAD_MULTIPLIER
+
+
+def select_branches(cfg, name=None):
+    return [(display_name, source_branch)
+            for source_branch, display_name in cfg.branches.items()
+            if name is None or name in (display_name, source_branch)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--branch')
+    parser.add_argument('--dry-run', action='store_true')
+    # read by Branch.verify_mode
+    parser.add_argument('--full-verify', action='store_true')
+    args = parser.parse_args()
+
+    cfg = config.load_config()
+    branches = select_branches(cfg, args.branch)
+    if not branches:
+        parser.error('no branch named %s' % args.branch)
+    # Branches run their downloads on the loop common.get_loop() returns,
+    # which would otherwise be a Qt one.
+    loop = common.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    context = dict(GLOBAL_CONTEXT, project=sanitize_url(cfg.project))
+    thread_count = multiprocessing.cpu_count() * THREAD_MULTIPLIER
+    outdated = False
+    with ThreadPoolExecutor(thread_count) as executor, \
+            HTTPClient(thread_count) as http_client:
+        for name, source_branch in branches:
+            branch = Branch(name, source_branch, cfg, http_client)
+            branch.set_download_tracker(DownloadTracker(None, executor))
+            branch.prefetch = not args.dry_run and \
+                getattr(cfg, 'prefetch_missing_files', False)
+            branch.index_directory()
+            branch.fetch_remote_index(context)
+            print('%s (%s)' % (name, branch.directory))
+            if branch.plan is None:
+                print('Up to date.')
+                continue
+            print(branch.plan.report())
+            if not branch.needs_update:
+                continue
+            outdated = True
+            if not args.dry_run:
+                try:
+                    loop.run_until_complete(
+                        loop.run_in_executor(executor, branch.update_game))
+                except DownloadError as error:
+                    print(error, file=sys.stderr)
+                    continue
+                outdated = False
+    loop.close()
+    return 1 if outdated else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
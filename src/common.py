@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import os
 import sys
 import re
@@ -66,16 +67,42 @@ def sanitize_url(url):
     return url.lower().replace(' ', '-')
 
 
-def inject_variables(path_format, vars_obj=GLOBAL_CONTEXT):
-    matches = vars_regex.findall(path_format)
-    path = path_format
-    vars_is_dict = isinstance(vars_obj, dict)
-    for match in matches:
-        if vars_is_dict:
-            replacement = vars_obj.get(match)
+class Template(object):
+    """ A format string with {name} placeholders, parsed once. Rendering
+    looks every name up in a dict, or as an attribute of any other object;
+    placeholders whose value is missing or None are left in the output as
+    they are.
+    """
+
+    def __init__(self, path_format):
+        parts = vars_regex.split(path_format)
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
+        # the same text with positional fields, for when every name is set
+        self._format = '{}'.join(
+            literal.replace('{', '{{').replace('}', '}}')
+            for literal in self.literals).format
+
+    def __call__(self, vars_obj=GLOBAL_CONTEXT):
+        if isinstance(vars_obj, dict):
+            values = [vars_obj.get(name) for name in self.names]
         else:
-            replacement = getattr(vars_obj, match, None)
-        if replacement is None:
-            continue
-        path = path.replace('{%s}' % match, str(replacement))
-    return path
+            values = [getattr(vars_obj, name, None) for name in self.names]
+        if None not in values:
+            return self._format(*values)
+        parts = [self.literals[0]]
+        for name, value, literal in zip(self.names, values,
+                                        self.literals[1:]):
+            parts.append('{%s}' % name if value is None else str(value))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(path_format):
+    """ The Template for path_format, parsed on first use only. """
+    return Template(path_format)
+
+
+def inject_variables(path_format, vars_obj=GLOBAL_CONTEXT):
+    return compile_template(path_format)(vars_obj)
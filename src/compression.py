@@ -0,0 +1,146 @@
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# Compressed payloads are published next to the raw file, at its URL plus
+# one of these suffixes. Launchers that can't decode them keep working.
+SUFFIXES = {
+    GZIP: '.gz',
+    ZSTD: '.zst',
+}
+
+# The most data decoded from a payload at a time, so a block that expands
+# enormously is still written out in bounded pieces.
+DECODE_BLOCK_SIZE = 1024**2
+
+
+def is_supported(encoding):
+    if encoding == GZIP:
+        return True
+    if encoding == ZSTD:
+        return zstandard is not None
+    return False
+
+
+def encoded_url(url, encoding):
+    return url + SUFFIXES[encoding]
+
+
+class _Decoder(object):
+    """ Counts the decoded output against the size of the file it should
+    rebuild, failing as soon as a payload decodes to more than that. """
+
+    name = None
+
+    def __init__(self, size):
+        self.size = size
+        self.decoded = 0
+
+    def _check(self, data):
+        self.decoded += len(data)
+        if self.decoded > self.size:
+            raise ValueError('%s stream decodes to more than %s bytes' %
+                             (self.name, self.size))
+        return data
+
+    def _check_complete(self):
+        if self.decoded != self.size:
+            raise ValueError('Truncated %s stream' % self.name)
+
+
+class _GzipDecoder(_Decoder):
+
+    name = GZIP
+
+    def __init__(self, size):
+        super().__init__(size)
+        # 16 + MAX_WBITS accepts the gzip header and trailer
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        while data:
+            block = self._decompressor.decompress(data, DECODE_BLOCK_SIZE)
+            data = self._decompressor.unconsumed_tail
+            yield self._check(block)
+
+    def flush(self):
+        data = self._check(self._decompressor.flush())
+        if not self._decompressor.eof:
+            raise ValueError('Truncated gzip stream')
+        self._check_complete()
+        return data
+
+
+class _ZstdDecoder(_Decoder):
+
+    name = ZSTD
+
+    def __init__(self, size):
+        super().__init__(size)
+        self._pieces = []
+        # zstandard's decompressobj takes no output bound, but a stream
+        # writer hands its output over in pieces as it is decoded
+        self._writer = zstandard.ZstdDecompressor().stream_writer(
+            self, write_size=DECODE_BLOCK_SIZE)
+
+    def write(self, data):
+        # the stream writer's output
+        self._pieces.append(self._check(data))
+        return len(data)
+
+    def decompress(self, data):
+        self._writer.write(data)
+        pieces, self._pieces = self._pieces, []
+        for piece in pieces:
+            yield piece
+
+    def flush(self):
+        self._check_complete()
+        return b''
+
+
+def get_decoder(encoding, size):
+    """ Returns a streaming decoder for encoding, with decompress(data) for
+    each block received, yielding the decoded data in pieces of at most
+    DECODE_BLOCK_SIZE, and flush() once the payload has ended. Both raise
+    ValueError once the payload decodes to more than size bytes, and
+    flush() if it decoded to less.
+    """
+    if not is_supported(encoding):
+        raise ValueError('Unsupported encoding: %s' % encoding)
+    if encoding == GZIP:
+        return _GzipDecoder(size)
+    return _ZstdDecoder(size)
+
+
+def compress_file(source, destination, encoding, level=None):
+    """ Writes a compressed copy of source to destination. """
+    with open(source, 'rb') as source_file, \
+            open(destination, 'wb') as destination_file:
+        if encoding == GZIP:
+            # mtime=0 keeps the payload reproducible between builds
+            with gzip.GzipFile(fileobj=destination_file, mode='wb',
+                               compresslevel=level or 9,
+                               mtime=0) as gzip_file:
+                _copy(source_file, gzip_file)
+        elif encoding == ZSTD and zstandard is not None:
+            compressor = zstandard.ZstdCompressor(level=level or 19)
+            with compressor.stream_writer(destination_file,
+                                          closefd=False) as writer:
+                _copy(source_file, writer)
+        else:
+            raise ValueError('Unsupported encoding: %s' % encoding)
+
+
+def _copy(source, destination, block_size=1024**2):
+    block = source.read(block_size)
+    while block:
+        destination.write(block)
+        block = source.read(block_size)
@@ -8,6 +8,7 @@ import logging
 from logging.handlers import RotatingFileHandler
 from requests.exceptions import HTTPError, Timeout, ConnectionError
 from util import namedtuple_from_mapping, get_platform
+from cache import MetadataCache, METADATA_CACHE_DIRNAME
 from collections import OrderedDict
 
 try:
@@ -85,12 +86,14 @@ def reload_config():
             config_json['project'])
         if 'config_endpoint' in config_json:
             url = common.inject_variables(config_json['config_endpoint'])
+            metadata_cache = MetadataCache(
+                os.path.join(CONFIG_DIR, METADATA_CACHE_DIRNAME))
             while old_url != url:
                 if '--test' in sys.argv:
                     break
                 logging.info('Loading remote config from %s' % url)
                 try:
-                    response = requests.get(url, timeout=5)
+                    response = metadata_cache.get(requests, url, timeout=5)
                     response.raise_for_status()
                     config_json = response.json()
                     logging.info('Fetched new config from %s.' % url)
@@ -0,0 +1,183 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+from util import CHUNK_SIZE
+
+# A delta rebuilds a target file from a source file, and is served at the
+# target file's URL plus '.<source sha256>' and this suffix.
+DELTA_SUFFIX = '.delta'
+MAGIC = b'HLDELTA1'
+# Matching granularity of the generator: smaller blocks find shorter common
+# runs at the cost of a bigger block index.
+BLOCK_SIZE = 8 * 1024
+# Longest literal written as a single insert, so applying never buffers
+# more than this.
+MAX_INSERT = CHUNK_SIZE
+
+_HEADER = struct.Struct('>QQ')
+_COPY = struct.Struct('>QQ')
+_INSERT = struct.Struct('>I')
+_END, _COPY_OP, _INSERT_OP = b'\x00', b'\x01', b'\x02'
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def delta_url(url, source_hash):
+    return '%s.%s%s' % (url, source_hash, DELTA_SUFFIX)
+
+
+def _weak_checksum(block):
+    """ The rsync rolling checksum, as its two 16 bit halves. """
+    a = sum(block) & 0xffff
+    b = sum(itertools.accumulate(block)) & 0xffff
+    return a, b
+
+
+def _strong_checksum(block):
+    return hashlib.md5(block).digest()
+
+
+class _DeltaWriter(object):
+    """ Writes delta operations, merging copies of adjacent source ranges.
+    """
+
+    def __init__(self, delta_file):
+        self.delta_file = delta_file
+        self._copy = None
+
+    def copy(self, offset, length):
+        if self._copy is not None and \
+                self._copy[0] + self._copy[1] == offset:
+            self._copy[1] += length
+            return
+        self._flush()
+        self._copy = [offset, length]
+
+    def insert(self, data, start, end):
+        if start >= end:
+            return
+        self._flush()
+        for start in range(start, end, MAX_INSERT):
+            block = data[start:min(start + MAX_INSERT, end)]
+            self.delta_file.write(_INSERT_OP + _INSERT.pack(len(block)))
+            self.delta_file.write(block)
+
+    def end(self):
+        self._flush()
+        self.delta_file.write(_END)
+
+    def _flush(self):
+        if self._copy is not None:
+            self.delta_file.write(_COPY_OP + _COPY.pack(*self._copy))
+            self._copy = None
+
+
+def _map(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def make_delta(source_path, target_path, delta_file, block_size=BLOCK_SIZE):
+    """ Writes a delta that rebuilds target_path from source_path.
+    Source blocks are indexed by a rolling checksum, and the target is
+    scanned for them at every byte offset, so inserted or removed data
+    doesn't hide the unchanged runs after it. Unchanged regions are skipped
+    a block at a time; only changed bytes are rolled over one by one.
+    """
+    with open(source_path, 'rb') as source_file, \
+            open(target_path, 'rb') as target_file:
+        source = _map(source_file)
+        target = _map(target_file)
+        delta_file.write(MAGIC + _HEADER.pack(len(source), len(target)))
+        signatures = {}
+        for offset in range(0, len(source) - block_size + 1, block_size):
+            block = source[offset:offset + block_size]
+            weak = _weak_checksum(block)
+            signatures.setdefault(weak, {}).setdefault(
+                _strong_checksum(block), offset)
+
+        writer = _DeltaWriter(delta_file)
+        size = len(target)
+        position = literal_start = 0
+        weak = None
+        while position + block_size <= size:
+            if weak is None:
+                weak = _weak_checksum(target[position:position + block_size])
+            candidates = signatures.get(weak)
+            if candidates is not None:
+                block = target[position:position + block_size]
+                offset = candidates.get(_strong_checksum(block))
+                if offset is not None:
+                    writer.insert(target, literal_start, position)
+                    writer.copy(offset, block_size)
+                    position += block_size
+                    literal_start = position
+                    weak = None
+                    continue
+            if position + block_size < size:
+                a, b = weak
+                removed = target[position]
+                a = (a - removed + target[position + block_size]) & 0xffff
+                b = (b - block_size * removed + a) & 0xffff
+                weak = (a, b)
+            position += 1
+        writer.insert(target, literal_start, size)
+        writer.end()
+
+
+def _read_exactly(delta_file, size):
+    data = delta_file.read(size)
+    if len(data) != size:
+        raise DeltaError('Truncated delta')
+    return data
+
+
+def apply_delta(source_path, delta_file, output_file, block_fun=None):
+    """ Rebuilds a file from source_path and a delta read from delta_file,
+    writing it to output_file. Works in a single pass over the delta with
+    at most CHUNK_SIZE bytes in memory. block_fun, if given, is called with
+    every block of output. Raises DeltaError if the delta is malformed or
+    was made for another source size.
+    """
+    header = _read_exactly(delta_file, len(MAGIC) + _HEADER.size)
+    if header[:len(MAGIC)] != MAGIC:
+        raise DeltaError('Not a delta file')
+    source_size, target_size = _HEADER.unpack(header[len(MAGIC):])
+    if os.path.getsize(source_path) != source_size:
+        raise DeltaError('Delta was made for a %s byte source' % source_size)
+    written = 0
+    with open(source_path, 'rb') as source_file:
+        while True:
+            op = _read_exactly(delta_file, 1)
+            if op == _END:
+                break
+            if op == _COPY_OP:
+                offset, length = _COPY.unpack(
+                    _read_exactly(delta_file, _COPY.size))
+                if offset + length > source_size:
+                    raise DeltaError('Copy past the end of the source')
+                source_file.seek(offset)
+                blocks = (_read_exactly(source_file,
+                                        min(CHUNK_SIZE, length - start))
+                          for start in range(0, length, CHUNK_SIZE))
+            elif op == _INSERT_OP:
+                length, = _INSERT.unpack(
+                    _read_exactly(delta_file, _INSERT.size))
+                if length > MAX_INSERT:
+                    raise DeltaError('Insert is too long')
+                blocks = (_read_exactly(delta_file, length),)
+            else:
+                raise DeltaError('Unknown delta operation: %r' % op)
+            for block in blocks:
+                output_file.write(block)
+                if block_fun is not None:
+                    block_fun(block)
+            written += length
+    if written != target_size:
+        raise DeltaError('Delta produced %s of %s bytes' %
+                         (written, target_size))
@@ -0,0 +1,183 @@
+import threading
+from delta import DELTA_SUFFIX
+from download import PART_SUFFIX, PROGRESS_SUFFIX
+from progress import format_size
+
+
+def is_indexed_file(filename, remote_files):
+    """ Whether a local file belongs to the remote index, counting the
+    partial downloads of indexed files so they can be resumed. """
+    for suffix in (PART_SUFFIX, PROGRESS_SUFFIX):
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+            if filename.endswith(DELTA_SUFFIX):
+                filename = filename[:-len(DELTA_SUFFIX)]
+            return filename in remote_files
+    return filename in remote_files
+
+
+class DiffPlan(object):
+    """ What it takes to bring a local installation in line with a remote
+    index: the files that are missing locally, the ones that changed, the
+    extra local files the index doesn't have and the unchanged ones, each
+    as a sorted list of relative paths.
+    """
+
+    def __init__(self, missing, changed, extra, unchanged, remote_files,
+                 local_files):
+        self.missing = sorted(missing)
+        self.changed = sorted(changed)
+        self.extra = sorted(extra)
+        self.unchanged = sorted(unchanged)
+        self.remote_files = remote_files
+        self.local_files = local_files
+
+    @classmethod
+    def compute(cls, remote_files, local_files, local_hashes):
+        """ remote_files is the index's "files", local_files maps the paths
+        found locally to their FileEntry and local_hashes the paths that
+        were hashed to their SHA-256. Files that weren't hashed (because
+        their size doesn't match) count as changed. """
+        remote = set(remote_files)
+        local = set(local_files) | set(local_hashes)
+        present = remote & local
+        unchanged = set(
+            filename for filename in present & set(local_hashes)
+            if local_hashes[filename] == remote_files[filename]['sha256'])
+        extra = set(filename for filename in local - remote
+                    if not is_indexed_file(filename, remote_files))
+        return cls(remote - local, present - unchanged, extra, unchanged,
+                   remote_files, local_files)
+
+    @property
+    def needs_update(self):
+        return bool(self.missing or self.changed)
+
+    @property
+    def downloads(self):
+        return self.missing + self.changed
+
+    def size(self, filename):
+        """ The remote size of an indexed file, the local one otherwise.
+        """
+        if filename in self.remote_files:
+            return self.remote_files[filename]['size']
+        entry = self.local_files.get(filename)
+        return entry.stat.st_size if entry is not None else 0
+
+    def total_size(self, filenames):
+        return sum(self.size(filename) for filename in filenames)
+
+    def summary(self):
+        counts = []
+        for label, filenames in (('missing', self.missing),
+                                 ('changed', self.changed),
+                                 ('extra', self.extra),
+                                 ('unchanged', self.unchanged)):
+            counts.append('%s %s (%s)' % (
+                len(filenames), label,
+                format_size(self.total_size(filenames))))
+        return ', '.join(counts)
+
+    def report(self):
+        """ A human readable listing of every file to download or delete.
+        """
+        lines = [self.summary()]
+        for mark, filenames in (('+', self.missing), ('~', self.changed),
+                                ('-', self.extra)):
+            lines.extend('%s %s (%s)' % (mark, filename,
+                                         format_size(self.size(filename)))
+                         for filename in filenames)
+        lines.append('Download size: %s' %
+                     format_size(self.total_size(self.downloads)))
+        return '\n'.join(lines)
+
+
+def _directory(filename):
+    return filename[:filename.rfind('/') + 1]
+
+
+class FileMatcher(object):
+    """ Pairs the files of a local scan with the entries of a remote index
+    while both are still arriving, from any thread. on_match(filename,
+    filedata, *args) is called as soon as an indexed file is found locally
+    and on_missing(filename, filedata, *args) as soon as it is known not to
+    exist: its directory, or the directory that should contain that one,
+    has been listed without it. Anything still unmatched is missing once
+    the scan finishes.
+    """
+
+    def __init__(self, on_match, on_missing=None):
+        self.on_match = on_match
+        self.on_missing = on_missing
+        self.local_files = {}
+        self.missing = []
+        self.scan_finished = threading.Event()
+        self._lock = threading.Lock()
+        self._directories = set([''])
+        self._listed = set()
+        # the remote entries that could still turn up, by directory
+        self._pending = {}
+
+    def add_local(self, entry):
+        filename = entry.relative_path
+        with self._lock:
+            self.local_files[filename] = entry
+            pending = self._pending.get(_directory(filename))
+            if pending is not None and filename in pending:
+                self.on_match(filename, *pending.pop(filename))
+
+    def directory_listed(self, prefix, subdirectories):
+        with self._lock:
+            self._directories.update(subdirectories)
+            self._listed.add(prefix)
+            for directory in list(self._pending):
+                if directory.startswith(prefix) and \
+                        self._is_absent(directory):
+                    self._report_missing(self._pending.pop(directory))
+
+    def add_remote(self, filename, filedata, *args):
+        with self._lock:
+            if filename in self.local_files:
+                self.on_match(filename, filedata, *args)
+                return
+            directory = _directory(filename)
+            if self.scan_finished.is_set() or self._is_absent(directory):
+                self._report_missing({filename: (filedata,) + args})
+                return
+            self._pending.setdefault(directory, {})[filename] = \
+                (filedata,) + args
+
+    def finish_scan(self):
+        with self._lock:
+            self.scan_finished.set()
+            for pending in self._pending.values():
+                self._report_missing(pending)
+            self._pending.clear()
+
+    def watch_missing(self, on_missing):
+        """ Calls on_missing for the files already found to be missing and
+        for those found from now on. """
+        with self._lock:
+            self.on_missing = on_missing
+            for filename, filedata, args in self.missing:
+                on_missing(filename, filedata, *args)
+
+    def _is_absent(self, directory):
+        # Whether a file in directory that hasn't been found yet never
+        # will be: the directory itself, or the closest parent that has no
+        # such subdirectory, has been listed already.
+        parent = ''
+        start = 0
+        while parent != directory:
+            child = directory[:directory.index('/', start) + 1]
+            if child not in self._directories:
+                return parent in self._listed
+            parent, start = child, len(child)
+        return directory in self._listed
+
+    def _report_missing(self, pending):
+        for filename, (filedata, *args) in pending.items():
+            self.missing.append((filename, filedata, args))
+            if self.on_missing is not None:
+                self.on_missing(filename, filedata, *args)
@@ -1,114 +1,817 @@
 import asyncio
 import hashlib
+import json
 import logging
+import os
 import requests
+import threading
 import time
+from cache import atomic_write_json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from util import CHUNK_SIZE
+from scheduler import DownloadQueue, POLICIES, DEFAULT_POLICY
+from compression import get_decoder, encoded_url
+from delta import apply_delta, delta_url, DELTA_SUFFIX
+from progress import ProgressCounter, ProgressEvent, ThroughputMeter,\
+     scale_to_qt
+
+
+PART_SUFFIX = '.part'
+PROGRESS_SUFFIX = '.part.json'
+# How much data is written between checkpoints of a partial download.
+CHECKPOINT_SIZE = 16 * CHUNK_SIZE
+# Files at least this large are fetched as several byte ranges in parallel.
+SEGMENTED_MIN_SIZE = 64 * CHUNK_SIZE
+SEGMENT_SIZE = 16 * CHUNK_SIZE
+SEGMENT_CONNECTIONS = 4
+# Upper bound on the number of files transferred at the same time.
+MAX_CONCURRENT_DOWNLOADS = 16
+# Progress is redrawn at most this often (in seconds) while bytes arrive.
+UPDATE_INTERVAL = 0.1
+# Files are hashed, resumed and split into ranges as the bytes they are
+# stored as, so servers are asked not to compress them on the way.
+IDENTITY_HEADERS = {'Accept-Encoding': 'identity'}
+
+
+def _load_progress(path, url, filehash):
+    """ Returns the saved progress record of a partial download of path.
+    Records that don't exactly match the current request (another URL or
+    another expected hash) are ignored so the download starts over.
+    """
+    part_path = path + PART_SUFFIX
+    progress_path = path + PROGRESS_SUFFIX
+    if not os.path.exists(part_path) or not os.path.exists(progress_path):
+        return None
+    try:
+        with open(progress_path, 'r') as progress_file:
+            progress = json.load(progress_file)
+    except (OSError, ValueError) as error:
+        logging.warning('Ignoring bad download progress for %s: %s' %
+                        (path, error))
+        return None
+    if not isinstance(progress, dict) or progress.get('url') != url or \
+            progress.get('sha256') != filehash:
+        return None
+    return progress
+
+
+def _resume_offset(path, url, filehash):
+    progress = _load_progress(path, url, filehash)
+    if progress is None:
+        return 0
+    offset = progress.get('offset')
+    if not isinstance(offset, int) or offset <= 0 or \
+            os.path.getsize(path + PART_SUFFIX) < offset:
+        return 0
+    return offset
+
+
+def _save_progress(path, url, filehash, **progress):
+    progress.update(url=url, sha256=filehash)
+    atomic_write_json(path + PROGRESS_SUFFIX, progress)
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _clear_progress(path):
+    _remove(path + PART_SUFFIX, path + PROGRESS_SUFFIX)
+
+
+def _range_start(response):
+    """ Returns the first byte offset of a 206 response's Content-Range. """
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        unit, byte_range = content_range.split(' ', 1)
+        return int(byte_range.split('-', 1)[0]) if unit == 'bytes' else None
+    except ValueError:
+        return None
+
+
+def _hash_prefix(part_file, hasher, length, block_fun=None):
+    """ Feeds the first length bytes of a partial download to the hasher. """
+    part_file.seek(0)
+    remaining = length
+    while remaining > 0:
+        block = part_file.read(min(CHUNK_SIZE, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        hasher.update(block)
+        if block_fun is not None:
+            block_fun(block)
 
 
 def download_file(url,
                   path,
                   block_fun=None,
                   session=None,
-                  filehash=None):
+                  filehash=None,
+                  throttle=None):
+    """ Streams url to path, resuming a previous partial download if any.
+    Data is written to a '.part' file next to path, with a small progress
+    record saved at every durable checkpoint. If the server honours a Range
+    request for the remaining bytes, the saved prefix is re-read to seed the
+    hash and the download continues from there. Otherwise it starts over.
+    throttle is an optional TokenBucket shared with other downloads.
+    """
     logging.info('Downloading %s from %s...' % (path, url))
     hasher = hashlib.sha256()
-    if session:
-        response = session.get(url, stream=True)
-    else:
-        response = requests.get(url, stream=True)
+    get = session.get if session else requests.get
+    offset = _resume_offset(path, url, filehash)
+    response = None
+    if offset > 0:
+        logging.info('Resuming download of %s at byte %s' % (path, offset))
+        response = get(url, stream=True,
+                       headers=dict(IDENTITY_HEADERS,
+                                    Range='bytes=%s-' % offset))
+        if response.status_code != requests.codes['partial_content'] or \
+                _range_start(response) != offset:
+            logging.info('Server did not resume %s (%s), restarting' %
+                         (url, response.status_code))
+            response.close()
+            response = None
+            offset = 0
+    if response is None:
+        response = get(url, stream=True, headers=IDENTITY_HEADERS)
 
-    with open(path, 'wb+') as downloaded_file:
+    part_path = path + PART_SUFFIX
+    with open(part_path, 'r+b' if offset > 0 else 'wb') as part_file:
         logging.info('Response: %s (%s)' %
                      (response.status_code, url))
-        for block in response.iter_content(CHUNK_SIZE):
+        if offset > 0:
+            _hash_prefix(part_file, hasher, offset, block_fun)
+            part_file.seek(offset)
+            part_file.truncate()
+        written = offset
+        checkpoint = offset
+        read_size = throttle.block_size(CHUNK_SIZE) if throttle else \
+            CHUNK_SIZE
+        for block in response.iter_content(read_size):
             logging.info('Downloaded chunk of (size: %s, %s)' %
                          (len(block), path))
             if block_fun is not None:
                 # give callback function the block
                 block_fun(block)
-            downloaded_file.write(block)
+            part_file.write(block)
             hasher.update(block)
+            written += len(block)
+            if throttle is not None:
+                throttle.consume(len(block))
+            if written - checkpoint >= CHECKPOINT_SIZE:
+                part_file.flush()
+                os.fsync(part_file.fileno())
+                _save_progress(path, url, filehash, offset=written)
+                checkpoint = written
+
+    download_hash = hasher.hexdigest()
+    if filehash is not None and download_hash != filehash:
+        logging.error('File download hash mismatch: (%s) \n'
+                      '   Expected: %s \n'
+                      '   Actual: %s' % (path, filehash, download_hash))
+    os.replace(part_path, path)
+    _clear_progress(path)
+    logging.info('Done downloading: %s' % path)
+    return response.status_code
+
+
+def download_encoded(url,
+                     path,
+                     encoding,
+                     size,
+                     block_fun=None,
+                     session=None,
+                     filehash=None,
+                     throttle=None):
+    """ Streams a compressed payload from url, decompressing it into path.
+    block_fun and throttle see the compressed bytes as they arrive, while
+    filehash is checked against the decompressed output, which has to be
+    size bytes long: a payload decoding to more is abandoned as soon as it
+    passes that. An interrupted encoded download starts over, as the
+    decoder state can't be restored.
+    """
+    logging.info('Downloading %s from %s (%s)...' % (path, url, encoding))
+    hasher = hashlib.sha256()
+    get = session.get if session else requests.get
+    decoder = get_decoder(encoding, size)
+    _clear_progress(path)
+    response = get(url, stream=True, headers=IDENTITY_HEADERS)
+    response.raise_for_status()
+    part_path = path + PART_SUFFIX
+    with open(part_path, 'wb') as part_file:
+        logging.info('Response: %s (%s)' %
+                     (response.status_code, url))
+        read_size = throttle.block_size(CHUNK_SIZE) if throttle else \
+            CHUNK_SIZE
+        # read as sent: a payload also served with a Content-Encoding
+        # would otherwise be decoded before it reaches the decoder
+        for block in response.raw.stream(read_size, decode_content=False):
+            if block_fun is not None:
+                block_fun(block)
+            for data in decoder.decompress(block):
+                part_file.write(data)
+                hasher.update(data)
+            if throttle is not None:
+                throttle.consume(len(block))
+        data = decoder.flush()
+        part_file.write(data)
+        hasher.update(data)
 
     download_hash = hasher.hexdigest()
     if filehash is not None and download_hash != filehash:
         logging.error('File download hash mismatch: (%s) \n'
                       '   Expected: %s \n'
                       '   Actual: %s' % (path, filehash, download_hash))
+    os.replace(part_path, path)
     logging.info('Done downloading: %s' % path)
     return response.status_code
 
 
+def _segment_ranges(size, segment_size):
+    return [(start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)]
+
+
+class _SegmentFile(object):
+    """ A preallocated file that can be written at arbitrary offsets from
+    several threads at once. Uses os.pwrite/os.pread where available and
+    falls back to serialized seek and write calls (e.g. on Windows).
+    """
+
+    def __init__(self, path, size, resume):
+        self.file = open(path, 'r+b' if resume else 'w+b')
+        if os.path.getsize(path) != size:
+            self.file.truncate(size)
+        self.lock = threading.Lock()
+        self.positional = hasattr(os, 'pwrite') and hasattr(os, 'pread')
+
+    def write(self, offset, data):
+        if self.positional:
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.file.fileno(), view, offset)
+                view = view[written:]
+                offset += written
+            return
+        with self.lock:
+            self.file.seek(offset)
+            self.file.write(data)
+
+    def read(self, offset, length):
+        if self.positional:
+            return os.pread(self.file.fileno(), length, offset)
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def download_segmented(url,
+                       path,
+                       size,
+                       block_fun=None,
+                       session=None,
+                       filehash=None,
+                       segment_size=None,
+                       connections=None,
+                       throttle=None):
+    """ Downloads url to path as byte ranges fetched over several connections.
+    Segments are written in place into a preallocated '.part' file. The
+    sha256 is computed in file order as contiguous segments complete, and
+    finished segments are recorded so an interrupted download only fetches
+    the missing ones. Falls back to download_file if the server does not
+    support ranges.
+    """
+    segment_size = segment_size or SEGMENT_SIZE
+    connections = connections or SEGMENT_CONNECTIONS
+    get = session.get if session else requests.get
+    ranges = _segment_ranges(size, segment_size)
+    progress = _load_progress(path, url, filehash) or {}
+    done = set()
+    if progress.get('size') == size and \
+            progress.get('segment_size') == segment_size:
+        done = set(progress.get('segments', ())) & set(range(len(ranges)))
+    pending = [index for index in range(len(ranges)) if index not in done]
+
+    first_response = None
+    if pending:
+        # probe range support with the first missing segment
+        start, end = ranges[pending[0]]
+        first_response = get(url, stream=True, headers=dict(
+            IDENTITY_HEADERS, Range='bytes=%s-%s' % (start, end)))
+        if first_response.status_code != \
+                requests.codes['partial_content'] or \
+                _range_start(first_response) != start:
+            logging.info('Server does not support ranges for %s (%s), '
+                         'downloading as a single stream' %
+                         (url, first_response.status_code))
+            first_response.close()
+            _clear_progress(path)
+            return download_file(url, path, block_fun, session, filehash,
+                                 throttle)
+
+    logging.info('Downloading %s from %s in %s segments (%s already done)'
+                 % (path, url, len(ranges), len(done)))
+    progress_lock = threading.Lock()
+
+    def report(block):
+        if block_fun is not None:
+            with progress_lock:
+                block_fun(block)
+
+    part_file = _SegmentFile(path + PART_SUFFIX, size, resume=bool(done))
+
+    def fetch(index, response=None):
+        start, end = ranges[index]
+        if response is None:
+            response = get(url, stream=True, headers=dict(
+                IDENTITY_HEADERS, Range='bytes=%s-%s' % (start, end)))
+        with response:
+            if response.status_code != requests.codes['partial_content'] \
+                    or _range_start(response) != start:
+                raise requests.exceptions.HTTPError(
+                    'Bad response for segment %s of %s: %s' %
+                    (index, url, response.status_code), response=response)
+            offset = start
+            read_size = throttle.block_size(CHUNK_SIZE) if throttle else \
+                CHUNK_SIZE
+            for block in response.iter_content(read_size):
+                if offset + len(block) > end + 1:
+                    block = block[:end + 1 - offset]
+                part_file.write(offset, block)
+                offset += len(block)
+                report(block)
+                if throttle is not None:
+                    throttle.consume(len(block))
+            if offset != end + 1:
+                raise requests.exceptions.ConnectionError(
+                    'Segment %s of %s ended early at byte %s' %
+                    (index, url, offset))
+        return index
+
+    hasher = hashlib.sha256()
+    resumed = set(done)
+    next_hashed = 0
+
+    def hash_ready_segments():
+        nonlocal next_hashed
+        while next_hashed < len(ranges) and next_hashed in done:
+            start, end = ranges[next_hashed]
+            for offset in range(start, end + 1, CHUNK_SIZE):
+                block = part_file.read(
+                    offset, min(CHUNK_SIZE, end + 1 - offset))
+                hasher.update(block)
+                if next_hashed in resumed:
+                    # segments saved by an earlier attempt count again
+                    report(block)
+            next_hashed += 1
+
+    error = None
+    try:
+        hash_ready_segments()
+        with ThreadPoolExecutor(min(connections, max(len(pending), 1))) \
+                as executor:
+            futures = []
+            if pending:
+                futures.append(executor.submit(
+                    fetch, pending[0], first_response))
+                futures.extend(executor.submit(fetch, index)
+                               for index in pending[1:])
+            for future in as_completed(futures):
+                try:
+                    index = future.result()
+                except Exception as segment_error:
+                    logging.error(segment_error)
+                    error = error or segment_error
+                    continue
+                done.add(index)
+                part_file.sync()
+                _save_progress(path, url, filehash, size=size,
+                               segment_size=segment_size,
+                               segments=sorted(done))
+                hash_ready_segments()
+    finally:
+        part_file.close()
+    if error is not None:
+        raise error
+
+    download_hash = hasher.hexdigest()
+    if filehash is not None and download_hash != filehash:
+        logging.error('File download hash mismatch: (%s) \n'
+                      '   Expected: %s \n'
+                      '   Actual: %s' % (path, filehash, download_hash))
+    os.replace(path + PART_SUFFIX, path)
+    _clear_progress(path)
+    logging.info('Done downloading: %s' % path)
+    return requests.codes['partial_content']
+
+
 class Download(object):
 
-    def __init__(self, path, url, download_size):
-        self.url = url
+    def __init__(self, path, url, download_size, filehash=None,
+                 encoding=None, compressed_size=None, delta_from=None,
+                 delta_size=None):
         self.file_path = path
-        self.total_size = download_size
-        self.downloaded_bytes = 0
+        self.filehash = filehash
+        self.file_size = download_size
+        # An encoded file is fetched (and its progress counted) as the
+        # compressed payload published next to the raw file.
+        self.encoding = encoding
+        if encoding is not None:
+            self.url = encoded_url(url, encoding)
+            self.total_size = compressed_size
+        else:
+            self.url = url
+            self.total_size = download_size
+        # A file with a delta from its current local version (delta_from
+        # being that version's hash) only downloads the patch, keeping the
+        # full file to fall back on.
+        self.delta_from = delta_from
+        self.full_size = self.total_size
+        if delta_from is not None:
+            self.delta_url = delta_url(url, delta_from)
+            self.total_size = delta_size
+        self.progress = None
+        self._downloaded_bytes = 0
+        self.segment_size = SEGMENT_SIZE
+        self.connections = SEGMENT_CONNECTIONS
+        self.throttle = None
+
+    @property
+    def downloaded_bytes(self):
+        return self._downloaded_bytes
+
+    @downloaded_bytes.setter
+    def downloaded_bytes(self, value):
+        # keep the tracker's running total in step with this download
+        if self.progress is not None:
+            self.progress.add(value - self._downloaded_bytes)
+        self._downloaded_bytes = value
+
+    @property
+    def is_segmented(self):
+        return (self.encoding is None and self.delta_from is None and
+                self.connections > 1 and
+                self.total_size >= max(SEGMENTED_MIN_SIZE,
+                                       2 * self.segment_size))
+
+    @property
+    def file_paths(self):
+        """ The local files this download writes. """
+        return [self.file_path]
+
+    @property
+    def is_plain(self):
+        """ Whether this is a single GET of the raw file, which the async
+        tracker streams itself. """
+        return self.encoding is None and self.delta_from is None and \
+            not self.is_segmented
 
     def download_file(self, session=None, filehash=None):
+        # a resumed download counts its saved prefix again as it is rehashed
+        self.downloaded_bytes = 0
+        if self.delta_from is not None:
+            if self._patch_file(session, filehash or self.filehash):
+                return
+            self._drop_delta()
+        if self.encoding is not None:
+            return download_encoded(self.url,
+                                    self.file_path,
+                                    self.encoding,
+                                    self.file_size,
+                                    block_fun=self._inc_download,
+                                    session=session,
+                                    filehash=filehash or self.filehash,
+                                    throttle=self.throttle)
+        if self.is_segmented:
+            return download_segmented(self.url,
+                                      self.file_path,
+                                      self.total_size,
+                                      block_fun=self._inc_download,
+                                      session=session,
+                                      filehash=filehash or self.filehash,
+                                      segment_size=self.segment_size,
+                                      connections=self.connections,
+                                      throttle=self.throttle)
         return download_file(self.url,
                              self.file_path,
                              block_fun=self._inc_download,
                              session=session,
-                             filehash=filehash)
+                             filehash=filehash or self.filehash,
+                             throttle=self.throttle)
+
+    def _patch_file(self, session, filehash):
+        """ Downloads the delta and applies it to the local file. Returns
+        False, leaving the local file as it was, if that fails or doesn't
+        produce the expected file.
+        """
+        patch_path = self.file_path + DELTA_SUFFIX
+        part_path = self.file_path + PART_SUFFIX
+        _clear_progress(self.file_path)
+        try:
+            download_file(self.delta_url,
+                          patch_path,
+                          block_fun=self._inc_download,
+                          session=session,
+                          throttle=self.throttle)
+            hasher = hashlib.sha256()
+            with open(patch_path, 'rb') as patch_file, \
+                    open(part_path, 'wb') as part_file:
+                apply_delta(self.file_path, patch_file, part_file,
+                            hasher.update)
+        except (requests.exceptions.RequestException, OSError,
+                ValueError) as error:
+            logging.warning('Failed to patch %s: %s' % (self.file_path,
+                                                        error))
+            return False
+        finally:
+            _remove(patch_path)
+        if filehash is not None and hasher.hexdigest() != filehash:
+            logging.warning('Patched %s has the wrong hash: %s' % (
+                self.file_path, hasher.hexdigest()))
+            _remove(part_path)
+            return False
+        os.replace(part_path, self.file_path)
+        logging.info('Done patching: %s' % self.file_path)
+        return True
+
+    def _drop_delta(self):
+        logging.info('Downloading all of %s instead' % self.file_path)
+        _clear_progress(self.file_path + DELTA_SUFFIX)
+        if self.progress is not None:
+            self.progress.add_total(self.full_size - self.total_size)
+        self.delta_from = None
+        self.total_size = self.full_size
+        self.downloaded_bytes = 0
 
     def _inc_download(self, block):
         self.downloaded_bytes += len(block)
 
 
+class DownloadError(Exception):
+    """ Raised once every download has been tried, if any of them failed.
+    failures lists the (download, error) pairs. """
+
+    def __init__(self, failures):
+        super().__init__('%s downloads failed: %s' % (
+            len(failures),
+            ', '.join(download.file_path for download, _ in failures)))
+        self.failures = failures
+
+
 class DownloadTracker(object):
 
-    def __init__(self, progress_bar, executor=None):
+    def __init__(self, progress_bar, executor=None, segment_size=None,
+                 connections=None, throttle=None, max_downloads=None,
+                 policy=None, critical_files=()):
         self.downloads = []
         self.download_futures = []
         self.progress_bar = progress_bar
         self.executor = executor
+        self.segment_size = segment_size or SEGMENT_SIZE
+        self.connections = connections or SEGMENT_CONNECTIONS
+        self.throttle = throttle
+        self.max_downloads = max_downloads or MAX_CONCURRENT_DOWNLOADS
+        if policy is not None and policy not in POLICIES:
+            # caught here rather than once an update has started
+            logging.warning('Unknown download order %s, using %s' %
+                            (policy, DEFAULT_POLICY))
+            policy = None
+        self.policy = policy
+        self.critical_files = critical_files
+        self.queue = None
+        self.progress = ProgressCounter(on_change=self._progress_changed)
+        self.throughput = ThroughputMeter()
+        self.listeners = []
+        self._last_progress = None
+        self._loop = None
+        self._update_lock = threading.Lock()
+        self._update_pending = False
+        self._started = set()
+        self._completed = set()
+        self.failures = []
+        self._start_queue = None
+        self._start_futures = []
+        # workers of start() and run() together, at most max_downloads
+        self._workers = 0
+        self._start_lock = threading.Lock()
 
     def __iter__(self):
         return self.downloads.__iter__()
 
     @property
     def total_size(self):
-        return sum(download.total_size for download in self)
+        return self.progress.total
 
     @property
     def downloaded_bytes(self):
-        return sum(download.downloaded_bytes for download in self)
+        return self.progress.downloaded
 
     def clear(self):
         self.downloads.clear()
         self.download_futures.clear()
+        self.queue = None
+        self._started.clear()
+        self._completed.clear()
+        self.failures = []
+        self._start_queue = None
+        self._start_futures = []
+        self.progress.reset()
+        self.throughput.reset()
+        self._last_progress = None
 
-    def add_download(self, *args):
-        self.downloads.append(Download(*args))
+    def add_download(self, *args, **kwargs):
+        self.add(Download(*args, **kwargs))
 
-    def update(self):
-        if self.progress_bar is None:
+    def add(self, download):
+        self._attach(download)
+        if self.queue is not None:
+            # picked up by the workers if they are still running
+            self.queue.push(download)
+
+    def _attach(self, download):
+        download.segment_size = self.segment_size
+        download.connections = self.connections
+        download.throttle = self.throttle
+        download.progress = self.progress
+        self.progress.add_total(download.total_size)
+        self.downloads.append(download)
+
+    def start(self, download, session=None):
+        """ Adds download and starts it on the executor right away, ahead
+        of run(), which then waits for it instead of starting it again. At
+        most max_downloads downloads run at once, counting those of run().
+        Thread-safe.
+        """
+        with self._start_lock:
+            self._attach(download)
+            self._started.add(download)
+            if self._start_queue is None:
+                self._start_queue = DownloadQueue(self.policy,
+                                                  self.critical_files)
+            self._start_queue.push(download)
+            if self._workers >= self.max_downloads:
+                return
+            self._workers += 1
+            self._start_futures.append(self.executor.submit(
+                self._download_worker, session))
+
+    def _claim_workers(self, wanted):
+        """ Reserves up to wanted of the worker slots left. """
+        with self._start_lock:
+            workers = max(0, min(wanted, self.max_downloads - self._workers))
+            self._workers += workers
+            return workers
+
+    def _next_download(self):
+        """ Pops the next download started early or queued by run(). A
+        worker that gets None has given up its slot. """
+        with self._start_lock:
+            for queue in (self._start_queue, self.queue):
+                download = queue.pop() if queue is not None else None
+                if download is not None:
+                    return download
+            self._workers -= 1
+            return None
+
+    def _download_one(self, download, session=None):
+        # a failure is reported once the rest have been tried
+        try:
+            download.download_file(session)
+        except Exception as error:
+            self._finished(download, error)
+        else:
+            self._finished(download)
+
+    def _finished(self, download, error=None):
+        if error is not None:
+            logging.error('Failed to download %s: %s' %
+                          (download.file_path, error))
+        with self._start_lock:
+            if error is None:
+                self._completed.add(download)
+            else:
+                self.failures.append((download, error))
+
+    def _raise_failures(self):
+        with self._start_lock:
+            failures, self.failures = self.failures, []
+            # queued again by the next run()
+            self._started.difference_update(
+                download for download, _ in failures)
+        if failures:
+            raise DownloadError(failures)
+
+    def _started_downloads(self, loop):
+        with self._start_lock:
+            return [asyncio.wrap_future(future, loop=loop)
+                    for future in self._start_futures]
+
+    def _create_queue(self):
+        """ Queues the downloads that weren't started early and haven't
+        completed yet. Returns the queue and the number of workers that
+        may take from it. """
+        queue = DownloadQueue(self.policy, self.critical_files)
+        for download in self.downloads:
+            if download not in self._started and \
+                    download not in self._completed:
+                queue.push(download)
+        with self._start_lock:
+            # workers started early take from it too once they are done
+            self.queue = queue
+        return queue, self._claim_workers(len(queue))
+
+    def _download_worker(self, session=None):
+        download = self._next_download()
+        while download is not None:
+            self._download_one(download, session)
+            download = self._next_download()
+
+    def _progress_changed(self):
+        # Runs on the download threads: schedules a single update on the
+        # loop, coalescing everything that arrives in the meantime. Nothing
+        # is scheduled (and nothing wakes up) while no bytes arrive.
+        loop = self._loop
+        if loop is None:
             return
-        download_size = self.total_size
-        if download_size <= 0:
+        with self._update_lock:
+            if self._update_pending:
+                return
+            self._update_pending = True
+        loop.call_soon_threadsafe(
+            loop.call_later, UPDATE_INTERVAL, self._scheduled_update)
+
+    def _scheduled_update(self):
+        with self._update_lock:
+            self._update_pending = False
+        self.update()
+
+    def add_listener(self, listener):
+        """ Registers listener to be called with a ProgressEvent whenever
+        update finds that progress has been made.
+        """
+        self.listeners.append(listener)
+
+    def update(self):
+        downloaded, total = self.progress.snapshot()
+        rate = self.throughput.update(downloaded, time.monotonic())
+        # coalesce: nothing to redraw if no bytes arrived since last time
+        if (downloaded, total) == self._last_progress or total <= 0:
             return
-        self.progress_bar.setMinimum(0)
-        self.progress_bar.setMaximum(download_size)
-        self.progress_bar.setValue(self.downloaded_bytes)
+        self._last_progress = downloaded, total
+        if self.progress_bar is not None:
+            value, maximum = scale_to_qt(downloaded, total)
+            self.progress_bar.setMinimum(0)
+            self.progress_bar.setMaximum(maximum)
+            self.progress_bar.setValue(value)
+        event = ProgressEvent(downloaded, total, rate,
+                              self.throughput.eta(total - downloaded))
+        for listener in self.listeners:
+            listener(event)
 
     def _execute_requests(self, loop, session=None):
+        # A fixed set of workers each take the next download in policy
+        # order as soon as they finish one.
+        queue, workers = self._create_queue()
         return asyncio.gather(*[loop.run_in_executor(
-            self.executor, download.download_file, session)
-            for download in self.downloads])
+            self.executor, self._download_worker, session)
+            for _ in range(workers)] + self._started_downloads(loop))
 
     def run(self, session=None):
+        """ Downloads everything, blocking the calling worker thread until
+        the last download completes. Raises DownloadError if any failed;
+        running again then only retries those. """
         loop = asyncio.get_event_loop()
+        self._loop = loop
         all_downloads = self._execute_requests(loop, session=session)
-        while not all_downloads.done():
-            loop.call_soon_threadsafe(self.update)
-            time.sleep(0.1)
+        self._wait_from_thread(loop, all_downloads)
+        self._loop = None
+        loop.call_soon_threadsafe(self.update)
+        self._raise_failures()
+
+    @staticmethod
+    def _wait_from_thread(loop, future):
+        finished = threading.Event()
+        # futures are only safe to touch from the loop's own thread
+        loop.call_soon_threadsafe(future.add_done_callback,
+                                  lambda future: finished.set())
+        finished.wait()
 
     async def run_async(self, session=None):
         loop = asyncio.get_event_loop()
+        self._loop = loop
         all_downloads = self._execute_requests(loop, session=session)
-        while not all_downloads.done():
-            loop.call_soon_threadsafe(self.update)
-            await asyncio.sleep(0.1)
+        await asyncio.wait([all_downloads])
+        self._loop = None
+        self.update()
+        self._raise_failures()
@@ -0,0 +1,72 @@
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor,\
+     as_completed
+from util import sha256_hash
+
+# Small files are grouped into batches so that a tree of tiny files does not
+# pay a task submission (or, with processes, a pickling round trip) per file.
+BATCH_FILE_COUNT = 64
+BATCH_BYTES = 64 * 1024**2
+
+
+def _hash_batch(batch):
+    results = []
+    for full_path, relative_path in batch:
+        try:
+            results.append((relative_path, sha256_hash(full_path)))
+        except OSError as error:
+            logging.warning('Could not hash %s: %s' % (full_path, error))
+            results.append((relative_path, None))
+    return results
+
+
+def make_batches(jobs):
+    """ Splits (full_path, relative_path, size) jobs into hashing batches.
+    Jobs are ordered largest first, so the biggest files start hashing
+    immediately instead of becoming the long tail at the end of a scan.
+    """
+    batch, batch_bytes = [], 0
+    for full_path, relative_path, size in sorted(
+            jobs, key=lambda job: job[2], reverse=True):
+        batch.append((full_path, relative_path))
+        batch_bytes += size
+        if len(batch) >= BATCH_FILE_COUNT or batch_bytes >= BATCH_BYTES:
+            yield batch
+            batch, batch_bytes = [], 0
+    if batch:
+        yield batch
+
+
+class HashingEngine(object):
+    """ Hashes many files concurrently on a pool of threads or processes.
+    hashlib releases the GIL while digesting large buffers, so threads are
+    usually enough to saturate a fast disk. Processes can be used instead on
+    machines where hashing turns out to be CPU bound.
+    """
+
+    def __init__(self, workers=None, use_processes=False):
+        if not workers or workers < 1:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.use_processes = use_processes
+
+    def hash_files(self, jobs):
+        """ Yields (relative_path, sha256) pairs as soon as they are ready.
+        The hash is None if the file could not be read.
+        """
+        batches = list(make_batches(jobs))
+        if not batches:
+            return
+        if self.workers == 1 or len(batches) == 1:
+            for batch in batches:
+                yield from _hash_batch(batch)
+            return
+        executor_type = ThreadPoolExecutor
+        if self.use_processes:
+            executor_type = ProcessPoolExecutor
+        with executor_type(min(self.workers, len(batches))) as executor:
+            futures = [executor.submit(_hash_batch, batch)
+                       for batch in batches]
+            for future in as_completed(futures):
+                yield from future.result()
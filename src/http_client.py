@@ -0,0 +1,88 @@
+import collections
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+
+ConnectionStats = collections.namedtuple(
+    'ConnectionStats', ('requests', 'opened', 'reused'))
+
+
+class _CountingAdapter(HTTPAdapter):
+    """ An HTTPAdapter that remembers how many connections its pools opened
+    and how many requests they served, even after a pool is evicted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._closed_requests = 0
+        self._closed_connections = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        pools = self.poolmanager.pools
+        # urllib3 1.x closes evicted pools here, 2.x leaves them to the GC.
+        dispose = pools.dispose_func
+
+        def dispose_counted(pool):
+            with self._lock:
+                self._closed_requests += pool.num_requests
+                self._closed_connections += pool.num_connections
+            if dispose is not None:
+                dispose(pool)
+        pools.dispose_func = dispose_counted
+
+    def stats(self):
+        pools = self.poolmanager.pools
+        with self._lock:
+            total_requests = self._closed_requests
+            opened = self._closed_connections
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    total_requests += pool.num_requests
+                    opened += pool.num_connections
+        return ConnectionStats(total_requests, opened,
+                               max(total_requests - opened, 0))
+
+
+class HTTPClient(object):
+    """ One keep-alive requests.Session shared by everything that talks to
+    the deployment servers: the index fetch, the launcher update check, the
+    news feed and the file downloads.
+    pool_size is how many idle connections are kept per host. It should be
+    at least the number of threads making requests at once, otherwise the
+    extra connections are thrown away after every request and each new
+    request pays for another TCP (and TLS) handshake.
+    """
+
+    def __init__(self, pool_size=None):
+        self.pool_size = max(pool_size or DEFAULT_POOLSIZE, 1)
+        self.adapter = _CountingAdapter(pool_maxsize=self.pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def stats(self):
+        """ Returns ConnectionStats for every request made so far. Requests
+        that did not need a new connection count as reused.
+        """
+        return self.adapter.stats()
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info('HTTP connections: %s requests, %s opened, %s reused' %
+                     stats)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,17 +1,18 @@
 import config
 import logging
+import multiprocessing
 import os
 from ui import MainWindow
 from common import get_app, get_loop, set_app_icon
 
-# call get_app and get_loop to have app and loop
-# be created in the globals of the common module
-app = get_app()
-loop = get_loop()
-set_app_icon()
-main_window = MainWindow(config.load_config())
 
-if __name__ == '__main__':
+def main():
+    # call get_app and get_loop to have app and loop
+    # be created in the globals of the common module
+    app = get_app()
+    loop = get_loop()
+    set_app_icon()
+    main_window = MainWindow(config.load_config())
     main_window.show()
     try:
         loop.run_until_complete(main_window.main_loop())
@@ -25,3 +26,10 @@ if __name__ == '__main__':
         raise
     finally:
         loop.close()
+
+
+if __name__ == '__main__':
+    # Must run before anything else so that hashing worker processes
+    # spawned from a frozen executable don't start a second launcher.
+    multiprocessing.freeze_support()
+    main()
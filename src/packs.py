@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import os
+import requests
+import tarfile
+from download import Download, PART_SUFFIX, _clear_progress
+from util import CHUNK_SIZE
+
+
+class _ResponseReader(object):
+    """ A file-like view of a streamed response for tarfile's stream mode,
+    reporting and throttling the bytes as they are read. """
+
+    def __init__(self, response, block_fun=None, throttle=None):
+        read_size = throttle.block_size(CHUNK_SIZE) if throttle else \
+            CHUNK_SIZE
+        self._blocks = response.iter_content(read_size)
+        self._block = b''
+        self._offset = 0
+        self.block_fun = block_fun
+        self.throttle = throttle
+        self.hasher = hashlib.sha256()
+
+    def _next_block(self):
+        block = next(self._blocks, None)
+        if block is None:
+            return False
+        self.hasher.update(block)
+        if self.block_fun is not None:
+            self.block_fun(block)
+        if self.throttle is not None:
+            self.throttle.consume(len(block))
+        self._block, self._offset = block, 0
+        return True
+
+    def read(self, size=-1):
+        data = []
+        while size != 0:
+            if self._offset >= len(self._block) and not self._next_block():
+                break
+            end = len(self._block)
+            if size > 0:
+                end = min(end, self._offset + size)
+                size -= end - self._offset
+            data.append(self._block[self._offset:end])
+            self._offset = end
+        return b''.join(data)
+
+
+class PackDownload(Download):
+    """ Fetches several small files with a single request for the pack (an
+    uncompressed tar) that contains them, extracting the members as the
+    pack streams in. members are the per-file Downloads being replaced,
+    keyed by their name in the pack. Each member is checked against its
+    own hash; a member that is missing from the pack or doesn't match is
+    downloaded on its own afterwards.
+    """
+
+    def __init__(self, path, url, download_size, filehash, members):
+        super().__init__(path, url, download_size, filehash)
+        self.members = members
+
+    @property
+    def file_paths(self):
+        return [member.file_path for member in self.members.values()]
+
+    @property
+    def is_segmented(self):
+        return False
+
+    @property
+    def is_plain(self):
+        return False
+
+    def download_file(self, session=None, filehash=None):
+        self.downloaded_bytes = 0
+        get = session.get if session else requests.get
+        logging.info('Downloading %s files from %s...' %
+                     (len(self.members), self.url))
+        remaining = dict(self.members)
+        try:
+            response = get(self.url, stream=True)
+            response.raise_for_status()
+            reader = _ResponseReader(response, self._inc_download,
+                                     self.throttle)
+            with tarfile.open(fileobj=reader, mode='r|') as pack:
+                for info in pack:
+                    member = remaining.get(info.name)
+                    if member is None or not info.isfile():
+                        continue
+                    if self._extract(pack.extractfile(info), member):
+                        del remaining[info.name]
+            # read to the end so the whole pack is hashed
+            reader.read()
+            if reader.hasher.hexdigest() != (filehash or self.filehash):
+                logging.warning('Pack hash mismatch: %s' % self.url)
+        except (requests.exceptions.RequestException, tarfile.TarError,
+                OSError) as error:
+            logging.warning('Failed to download pack %s: %s' %
+                            (self.url, error))
+        for member in remaining.values():
+            logging.info('Downloading %s on its own' % member.file_path)
+            member.throttle = self.throttle
+            member.progress = self.progress
+            if self.progress is not None:
+                self.progress.add_total(member.total_size)
+            member.download_file(session)
+        logging.info('Done downloading: %s' % self.url)
+
+    def _extract(self, source, member):
+        _clear_progress(member.file_path)
+        part_path = member.file_path + PART_SUFFIX
+        hasher = hashlib.sha256()
+        with open(part_path, 'wb') as part_file:
+            block = source.read(CHUNK_SIZE)
+            while block:
+                part_file.write(block)
+                hasher.update(block)
+                block = source.read(CHUNK_SIZE)
+        if hasher.hexdigest() != member.filehash:
+            logging.warning('Pack member hash mismatch: %s' %
+                            member.file_path)
+            os.remove(part_path)
+            return False
+        os.replace(part_path, member.file_path)
+        return True
@@ -0,0 +1,109 @@
+import collections
+import math
+import threading
+
+# QProgressBar stores its range in a C int.
+QT_MAX_VALUE = 2**31 - 1
+# Throughput is smoothed with an exponential moving average that forgets
+# older samples with this time constant, in seconds.
+SMOOTHING_TIME = 3.0
+
+ProgressEvent = collections.namedtuple(
+    'ProgressEvent', ('downloaded', 'total', 'rate', 'eta'))
+
+
+class ProgressCounter(object):
+    """ Thread-safe running totals of expected and received bytes.
+    Downloads report deltas as they go, so reading the totals costs the
+    same no matter how many files are being downloaded. on_change, if set,
+    is called (from the reporting thread) after every change in progress.
+    """
+
+    def __init__(self, on_change=None):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.downloaded = 0
+        self.on_change = on_change
+
+    def add_total(self, size):
+        with self._lock:
+            self.total += size
+
+    def add(self, size):
+        with self._lock:
+            self.downloaded += size
+        if self.on_change is not None:
+            self.on_change()
+
+    def reset(self):
+        with self._lock:
+            self.total = 0
+            self.downloaded = 0
+
+    def snapshot(self):
+        with self._lock:
+            return self.downloaded, self.total
+
+
+class ThroughputMeter(object):
+    """ Smoothed download rate and ETA from periodic byte counts. """
+
+    def __init__(self, smoothing_time=SMOOTHING_TIME):
+        self.smoothing_time = smoothing_time
+        self.rate = None
+        self._last = None
+
+    def reset(self):
+        self.rate = None
+        self._last = None
+
+    def update(self, downloaded, now):
+        if self._last is not None:
+            last_downloaded, last_time = self._last
+            elapsed = now - last_time
+            if elapsed <= 0:
+                return self.rate
+            sample = max(downloaded - last_downloaded, 0) / elapsed
+            if self.rate is None:
+                self.rate = sample
+            else:
+                # weight by elapsed time so uneven intervals smooth the same
+                weight = 1 - math.exp(-elapsed / self.smoothing_time)
+                self.rate += weight * (sample - self.rate)
+        self._last = (downloaded, now)
+        return self.rate
+
+    def eta(self, remaining):
+        if remaining <= 0:
+            return 0
+        if not self.rate:
+            return None
+        return remaining / self.rate
+
+
+def scale_to_qt(value, maximum):
+    """ Scales a progress value and maximum down by the same factor so both
+    fit in QProgressBar's 32 bit range.
+    """
+    if maximum <= QT_MAX_VALUE:
+        return value, maximum
+    scale = -(-maximum // QT_MAX_VALUE)
+    return value // scale, maximum // scale
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TB'
+    return '%.1f %s' % (size, unit) if unit != 'B' else '%d B' % size
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
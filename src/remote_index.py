@@ -0,0 +1,263 @@
+import binascii
+import codecs
+import json
+import os
+import re
+import sys
+from array import array
+from collections.abc import Mapping
+
+# Bytes read from the response at a time while parsing an index.
+INDEX_BLOCK_SIZE = 64 * 1024
+DIGEST_SIZE = 32
+EMPTY_DIGEST = bytes(DIGEST_SIZE)
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+COLON = re.compile(r'[ \t\n\r]*:[ \t\n\r]*')
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class FileIndex(Mapping):
+    """ The "files" map of a remote index, stored compactly: paths are
+    interned, SHA-256 digests are kept as 32 raw bytes in one bytearray and
+    sizes in an array. Only files with other keys (encoding, deltas, chunks,
+    pack...) keep a dict of their own. Looking a file up builds the same
+    dict the JSON index has, so it can be used wherever that dict was.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._digests = bytearray()
+        self._sizes = array('Q')
+        self._extras = {}
+
+    def add(self, filename, filedata):
+        filehash = filedata.get('sha256')
+        extras = None
+        digest = None
+        if isinstance(filehash, str) and len(filehash) == 2 * DIGEST_SIZE \
+                and filehash == filehash.lower():
+            try:
+                digest = binascii.unhexlify(filehash)
+            except ValueError:
+                pass
+        if digest is None:
+            # not a lowercase SHA-256 hex digest, keep it as it is
+            digest = EMPTY_DIGEST
+            extras = {'sha256': filehash}
+        if len(filedata) > 2:
+            extras = extras or {}
+            for key, value in filedata.items():
+                if key not in ('sha256', 'size'):
+                    extras[sys.intern(key)] = _intern(value)
+        row = self._rows.get(filename)
+        if row is None:
+            row = self._rows[sys.intern(filename)] = len(self._sizes)
+            self._digests += digest
+            self._sizes.append(filedata.get('size', 0))
+        else:
+            self._digests[row * DIGEST_SIZE:(row + 1) * DIGEST_SIZE] = digest
+            self._sizes[row] = filedata.get('size', 0)
+            self._extras.pop(row, None)
+        if extras:
+            self._extras[row] = extras
+
+    def discard(self, filename):
+        """ Removes a file. Its row is left unused rather than compacted.
+        """
+        row = self._rows.pop(filename, None)
+        if row is not None:
+            self._extras.pop(row, None)
+
+    def __getitem__(self, filename):
+        row = self._rows[filename]
+        filedata = {
+            'sha256': binascii.hexlify(self._digests[
+                row * DIGEST_SIZE:(row + 1) * DIGEST_SIZE]).decode('ascii'),
+            'size': self._sizes[row]
+        }
+        filedata.update(self._extras.get(row, ()))
+        return filedata
+
+    def __contains__(self, filename):
+        return filename in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class _StreamReader(object):
+    """ Decodes JSON values one at a time out of a stream of byte blocks,
+    holding only the part of the body that has not been parsed yet. """
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._decoder = codecs.getincrementaldecoder('utf8')()
+        self._scan = json.JSONDecoder().scan_once
+        self._buffer = ''
+        self._pos = 0
+        self._done = False
+
+    def _fill(self, wanted=1):
+        """ Reads blocks until wanted more characters are buffered. Returns
+        False if the body ended first. """
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        target = len(self._buffer) + wanted
+        while len(self._buffer) < target:
+            if self._done:
+                return False
+            block = next(self._blocks, None)
+            if block is None:
+                self._done = True
+                self._buffer += self._decoder.decode(b'', final=True)
+            else:
+                self._buffer += self._decoder.decode(block)
+        return True
+
+    def peek(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of index')
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('Expected %r at index offset %s, found %r' %
+                             (chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._scan(self._buffer, self._pos)
+            except (StopIteration, ValueError):
+                end = None
+            # A value running to the end of the buffer (a number, say) may
+            # continue in the next block. Nothing at the top level ends an
+            # index, so a complete value is always followed by something.
+            if end is not None and end < len(self._buffer):
+                self._pos = end
+                return value
+            # at least double what is buffered, so a long value is only
+            # parsed again a few times
+            pending = len(self._buffer) - self._pos
+            if not self._fill(max(pending, 1)) and \
+                    len(self._buffer) - self._pos == pending:
+                raise ValueError('Unexpected end of index')
+
+    def member(self):
+        """ Reads a "key": value pair of an object. """
+        # fast path for pairs that are already buffered in full
+        self.peek()
+        try:
+            key, end = self._scan(self._buffer, self._pos)
+            colon = COLON.match(self._buffer, end)
+            if colon is not None:
+                value, end = self._scan(self._buffer, colon.end())
+                if end < len(self._buffer):
+                    self._pos = end
+                    return key, value
+        except (StopIteration, ValueError):
+            pass
+        key = self.value()
+        self.expect(':')
+        return key, self.value()
+
+
+def parse_index(blocks, on_file=None):
+    """ Parses a remote index from an iterable of byte blocks (like a
+    response's iter_content) without holding the whole body. Returns the
+    index as a dict with "files" as a FileIndex. on_file(filename, filedata)
+    is called for every file as soon as its entry has been read.
+    """
+    reader = _StreamReader(blocks)
+    index = {}
+    reader.expect('{')
+    if reader.peek() == '}':
+        return index
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'files':
+            index['files'] = _parse_files(reader, on_file)
+        else:
+            index[key] = reader.value()
+        if reader.expect(',}') == '}':
+            return index
+
+
+def _parse_files(reader, on_file):
+    files = FileIndex()
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+        return files
+    while True:
+        filename, filedata = reader.member()
+        files.add(filename, filedata)
+        if on_file is not None:
+            on_file(filename, filedata)
+        if reader.expect(',}') == '}':
+            return files
+
+
+def load_index(path):
+    """ Parses an index saved with save_index. """
+    with open(path, 'rb') as index_file:
+        return parse_index(
+            iter(lambda: index_file.read(INDEX_BLOCK_SIZE), b''))
+
+
+def save_index(path, index):
+    """ Writes index to path as JSON, one file entry at a time, replacing
+    the old copy only once the new one is complete. """
+    temp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'w', encoding='utf8') as index_file:
+            index_file.write('{')
+            for key, value in index.items():
+                if key != 'files':
+                    index_file.write('%s: %s, ' % (json.dumps(key),
+                                                   json.dumps(value)))
+            index_file.write('"files": {')
+            separator = ''
+            for filename, filedata in index.get('files', {}).items():
+                index_file.write('%s%s: %s' % (separator, json.dumps(filename),
+                                               json.dumps(filedata)))
+                separator = ', '
+            index_file.write('}}')
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def apply_delta(index, delta):
+    """ Brings a parsed index up to date with a change list from the delta
+    index endpoint: the files it has "added" or "modified" (entries as in
+    "files") and "removed" (a list of paths). Every other key of the change
+    list replaces the index's. Returns the paths of the files that changed.
+    """
+    files = index['files']
+    changed = set()
+    for key in ('added', 'modified'):
+        for filename, filedata in delta.get(key, {}).items():
+            files.add(filename, filedata)
+            changed.add(filename)
+    for filename in delta.get('removed', []):
+        files.discard(filename)
+    for key, value in delta.items():
+        if key not in ('added', 'modified', 'removed', 'since', 'files'):
+            index[key] = value
+    return changed
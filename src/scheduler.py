@@ -0,0 +1,68 @@
+import fnmatch
+import heapq
+import itertools
+import os
+import threading
+
+# Longest processing time first: starting the biggest files early keeps one
+# huge file from running alone at the end of an update.
+LARGEST_FIRST = 'largest_first'
+# Many small files finish quickly, so visible progress starts right away.
+SMALLEST_FIRST = 'smallest_first'
+# Files matching the critical patterns (the game binary by default) first,
+# the rest largest first.
+CRITICAL_FIRST = 'critical_first'
+
+POLICIES = (LARGEST_FIRST, SMALLEST_FIRST, CRITICAL_FIRST)
+DEFAULT_POLICY = LARGEST_FIRST
+
+
+def is_critical(path, patterns):
+    path = path.replace(os.sep, '/')
+    return any(fnmatch.fnmatch(path, pattern) or
+               fnmatch.fnmatch(path, '*/' + pattern)
+               for pattern in patterns)
+
+
+def policy_key(policy=None, critical_files=()):
+    """ Returns a sort key for downloads under the named policy. """
+    policy = policy or DEFAULT_POLICY
+    if policy == LARGEST_FIRST:
+        return lambda download: -download.total_size
+    if policy == SMALLEST_FIRST:
+        return lambda download: download.total_size
+    if policy == CRITICAL_FIRST:
+        return lambda download: (
+            not is_critical(download.file_path, critical_files),
+            -download.total_size)
+    raise ValueError('Unknown download order: %s' % policy)
+
+
+class DownloadQueue(object):
+    """ A thread-safe priority queue of pending downloads.
+    Workers pop the next download as soon as they go idle, so a slot never
+    waits for a whole batch to finish. Downloads pushed while workers are
+    still draining the queue are picked up by them in priority order; ties
+    keep the order they were added in.
+    """
+
+    def __init__(self, policy=None, critical_files=()):
+        self.key = policy_key(policy, critical_files)
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, download):
+        with self._lock:
+            heapq.heappush(self._heap, (self.key(download),
+                                        next(self._counter), download))
+
+    def pop(self):
+        """ Returns the next download, or None once the queue is empty. """
+        with self._lock:
+            if not self._heap:
+                return None
+            return heapq.heappop(self._heap)[-1]
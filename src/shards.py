@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import os
+from remote_index import FileIndex
+
+SHARD_SUFFIX = '.json'
+
+
+def encode_shard(files, dirs):
+    """ The canonical bytes of the shard for one directory: files maps the
+    names of the files directly in it to their index entries and dirs the
+    names of its subdirectories to their shard hashes. """
+    return json.dumps({'files': files, 'dirs': dirs}, sort_keys=True,
+                      separators=(',', ':')).encode('utf8')
+
+
+def hash_shard(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ShardStore(object):
+    """ The shards of a sharded remote index seen so far, by hash.
+    A shard lists the files of one directory and the hashes of the shards
+    of its subdirectories, so a shard's hash covers its whole subtree and
+    a shard that is already here never has to be fetched again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, shard_hash):
+        return os.path.join(self.directory, shard_hash + SHARD_SUFFIX)
+
+    def get(self, shard_hash):
+        """ Returns the parsed shard, or None if it isn't stored (or is
+        damaged). """
+        try:
+            with open(self._path(shard_hash), 'rb') as shard_file:
+                data = shard_file.read()
+        except OSError:
+            return None
+        if hash_shard(data) != shard_hash:
+            logging.warning('Discarding damaged index shard %s' % shard_hash)
+            os.remove(self._path(shard_hash))
+            return None
+        return json.loads(data.decode('utf8'))
+
+    def put(self, shard_hash, data):
+        """ Stores the bytes of a fetched shard and returns it parsed.
+        Raises ValueError if they don't match the hash. """
+        if hash_shard(data) != shard_hash:
+            raise ValueError('Index shard hash mismatch: %s' % shard_hash)
+        shard = json.loads(data.decode('utf8'))
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = '%s.%s.tmp' % (self._path(shard_hash), os.getpid())
+        with open(temp_path, 'wb') as shard_file:
+            shard_file.write(data)
+        os.replace(temp_path, self._path(shard_hash))
+        return shard
+
+    def prune(self, keep):
+        """ Deletes the stored shards whose hashes are not in keep. """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(SHARD_SUFFIX) and \
+                    name[:-len(SHARD_SUFFIX)] not in keep:
+                os.remove(os.path.join(self.directory, name))
+
+
+def load_sharded_files(root, fetch, store):
+    """ Builds the flat file index of the tree of shards below root.
+    Shards missing from store are fetched with fetch(shard_hash), which
+    returns their bytes.
+    Returns the FileIndex and the set of shard hashes in the tree.
+    """
+    files = FileIndex()
+    reachable = set()
+    fetched = 0
+    pending = [(root, '')]
+    while pending:
+        current, prefix = pending.pop()
+        reachable.add(current)
+        shard = store.get(current)
+        if shard is None:
+            shard = store.put(current, fetch(current))
+            fetched += 1
+        for name, filedata in shard['files'].items():
+            files.add(prefix + name, filedata)
+        for name, child in shard['dirs'].items():
+            pending.append((child, prefix + name + '/'))
+    logging.info('Index shards: %s in the tree, %s fetched' %
+                 (len(reachable), fetched))
+    return files, reachable
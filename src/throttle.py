@@ -0,0 +1,100 @@
+import datetime
+import threading
+import time
+
+# Smallest read size used while throttled, so slow limits still get
+# reasonably sized socket reads.
+MIN_BLOCK_SIZE = 16 * 1024
+# Throttled reads are sized to take about this long at the current limit,
+# which keeps the transfer smooth instead of bursting a whole chunk.
+BLOCK_DURATION = 0.1
+
+
+def _parse_time(value):
+    hours, minutes = value.split(':')
+    return datetime.time(int(hours), int(minutes))
+
+
+class BandwidthSchedule(object):
+    """ A default bandwidth limit with optional time of day overrides.
+    Each profile is a mapping with 'start' and 'end' times ("HH:MM", local
+    time) and a 'limit' in bytes/sec. A profile whose end is before its
+    start wraps around midnight. The first matching profile wins. A limit
+    of 0 or None means unlimited.
+    """
+
+    def __init__(self, limit=None, profiles=()):
+        self.limit = limit or None
+        self.profiles = [(_parse_time(profile['start']),
+                          _parse_time(profile['end']),
+                          profile.get('limit') or None)
+                         for profile in profiles]
+
+    def limit_at(self, when):
+        now = when.time()
+        for start, end, limit in self.profiles:
+            if start <= end:
+                active = start <= now < end
+            else:
+                active = now >= start or now < end
+            if active:
+                return limit
+        return self.limit
+
+
+class TokenBucket(object):
+    """ A thread-safe token bucket shared by every concurrent download.
+    Callers account for bytes after they have received them. Each call
+    reserves its bytes against the bucket (which may go into debt) and is
+    told how long to wait until the bucket is back in credit. Reservations
+    are served strictly in call order, so concurrent files take turns block
+    by block and share the limit fairly. Unused credit is capped at burst
+    bytes.
+    """
+
+    def __init__(self, schedule, burst=0, clock=time.monotonic,
+                 now=datetime.datetime.now):
+        self.schedule = schedule
+        self.burst = burst
+        self.clock = clock
+        self.now = now
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._rate = None
+        self._updated = clock()
+
+    @property
+    def rate(self):
+        return self.schedule.limit_at(self.now())
+
+    def block_size(self, default):
+        rate = self.rate
+        if rate is None:
+            return default
+        return max(MIN_BLOCK_SIZE, min(default, int(rate * BLOCK_DURATION)))
+
+    def reserve(self, amount):
+        """ Accounts for amount bytes and returns how many seconds the
+        caller should wait before receiving any more.
+        """
+        rate = self.rate
+        with self._lock:
+            now = self.clock()
+            # refill at the rate that applied since the last reservation
+            previous_rate, self._rate = self._rate, rate
+            if rate is None:
+                self._tokens = 0
+                self._updated = now
+                return 0
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * (previous_rate or rate))
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / rate
+
+    def consume(self, amount):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
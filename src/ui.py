@@ -1,5 +1,7 @@
 import asyncio
 import config
+import functools
+import hashlib
 import logging
 import os
 import shutil
@@ -7,7 +9,6 @@ import subprocess
 import sys
 import time
 import multiprocessing
-import requests
 import feedparser
 import json
 from babel.dates import format_date
@@ -15,9 +16,25 @@ from datetime import datetime
 from time import mktime
 from enum import Enum
 from config import CONFIG_DIR
-from common import inject_variables, get_loop, sanitize_url, GLOBAL_CONTEXT
-from util import get_platform, sha256_hash, list_files
-from download import DownloadTracker
+from common import inject_variables, compile_template, get_loop,\
+     sanitize_url, GLOBAL_CONTEXT
+from util import get_platform, sha256_hash, scan_files
+from cache import HashCache, InstallJournal, MetadataCache,\
+     METADATA_CACHE_DIRNAME
+from hashing import HashingEngine
+from download import Download, DownloadError, DownloadTracker,\
+     MAX_CONCURRENT_DOWNLOADS
+from async_download import AsyncDownloadTracker, aiohttp
+from http_client import HTTPClient
+from throttle import BandwidthSchedule, TokenBucket
+from progress import format_size, format_duration
+from compression import is_supported
+from chunks import ChunkStore, ChunkedDownload
+from packs import PackDownload
+from remote_index import parse_index, load_index, save_index, apply_delta,\
+     INDEX_BLOCK_SIZE
+from shards import ShardStore, load_sharded_files
+from diff_plan import DiffPlan, FileMatcher
 from quamash import QThreadExecutor
 from requests.exceptions import HTTPError, Timeout, ConnectionError
 from PyQt5.QtWidgets import *
@@ -30,11 +47,32 @@ HEIGHT = 480
 
 THREAD_MULTIPLIER = 5
 DATA_FILE = 'data.json'
+HASH_CACHE_FILE = 'hashes_%s.json'
+CHUNK_STORE_DIR = 'chunks_%s'
+JOURNAL_FILE = 'journal_%s.json'
+SHARD_STORE_DIR = 'shards_%s'
+INDEX_SNAPSHOT_FILE = 'index_%s.json'
+
+# Reuse cached hashes for files whose size and mtime have not changed.
+VERIFY_QUICK = 'quick'
+# Rehash every local file whose size matches the remote index.
+VERIFY_FULL = 'full'
+
+# A pack is fetched only while it is at most this many times the size of
+# the files it replaces.
+PACK_MAX_OVERHEAD = 2
+
+
+def metadata_cache_dir():
+    if CONFIG_DIR:
+        return os.path.join(CONFIG_DIR, METADATA_CACHE_DIRNAME)
+    return METADATA_CACHE_DIRNAME
 
 
 class Branch(object):
 
-    def __init__(self, name, source_branch, cfg):
+    def __init__(self, name, source_branch, cfg, http_client=None,
+                 metadata_cache=None):
         self.name = name
         self.source_branch = source_branch
         self.directory = os.path.join(config.BASE_DIR, name)
@@ -43,8 +81,41 @@ class Branch(object):
         self.needs_update = False
         self.config = cfg
         self.files = {}
+        self.local_files = {}
         self.remote_index = {}
+        self.plan = None
         self.download_tracker = None
+        # whether missing files are downloaded as soon as they are found
+        self.prefetch = False
+        # checked in the background: scanned and hashed on one thread
+        self.low_priority = False
+        self.prefetched = set()
+        self._scan_matcher = None
+        self._fetch_matcher = None
+        self.http_client = http_client or HTTPClient()
+        cache_file = HASH_CACHE_FILE % sanitize_url(name)
+        if CONFIG_DIR:
+            cache_file = os.path.join(CONFIG_DIR, cache_file)
+        self.hash_cache = HashCache(cache_file)
+        chunk_dir = CHUNK_STORE_DIR % sanitize_url(name)
+        if CONFIG_DIR:
+            chunk_dir = os.path.join(CONFIG_DIR, chunk_dir)
+        self.chunk_store = ChunkStore(chunk_dir)
+        journal_file = JOURNAL_FILE % sanitize_url(name)
+        if CONFIG_DIR:
+            journal_file = os.path.join(CONFIG_DIR, journal_file)
+        self.journal = InstallJournal(journal_file)
+        shard_dir = SHARD_STORE_DIR % sanitize_url(name)
+        if CONFIG_DIR:
+            shard_dir = os.path.join(CONFIG_DIR, shard_dir)
+        self.shard_store = ShardStore(shard_dir)
+        index_snapshot = INDEX_SNAPSHOT_FILE % sanitize_url(name)
+        if CONFIG_DIR:
+            index_snapshot = os.path.join(CONFIG_DIR, index_snapshot)
+        self.index_snapshot = index_snapshot
+        self.index_hash = None
+        self.metadata_cache = metadata_cache or \
+            MetadataCache(metadata_cache_dir())
 
     def set_download_tracker(self, download_tracker):
         self.download_tracker = download_tracker
@@ -52,13 +123,103 @@ class Branch(object):
     def __str__(self):
         return str((self.name, self.source_branch))
 
+    def begin_scan(self):
+        """ Starts comparing the local installation with the remote index.
+        index_directory and fetch_remote_index may then run at the same
+        time on different threads: each file is matched, and queued for
+        hashing, as soon as both have seen it. """
+        matcher = FileMatcher(self._queue_verify)
+        self._scan_matcher = self._fetch_matcher = matcher
+        self.local_files = matcher.local_files
+        self.prefetched = set()
+        self.is_indexed = False
+        return matcher
+
     def index_directory(self):
-        if not os.path.exists(self.directory):
+        matcher = self._scan_matcher or self.begin_scan()
+        self._scan_matcher = None
+        try:
+            if not os.path.exists(self.directory):
+                return
+            workers = None
+            if not self.low_priority:
+                workers = getattr(self.config, 'scan_workers', None)
+            for entry in scan_files(self.directory, workers=workers,
+                                    on_directory=matcher.directory_listed):
+                matcher.add_local(entry)
+            logging.info('Found %s local files in %s' %
+                         (len(self.local_files), self.directory))
+        finally:
+            matcher.finish_scan()
             self.is_indexed = True
+
+    def verify_files(self, verify_mode=None):
+        """ Hashes the local files that could match the remote index.
+        Files that are missing or whose size differs from the remote index
+        are already known to need downloading and are not hashed, unless
+        the index lists deltas or chunks that can reuse their current
+        version. In
+        quick mode, cached hashes are reused for files whose stat has not
+        changed; in full mode every remaining file is hashed again.
+        """
+        self._start_verify(verify_mode)
+        for relative, filedata in self.remote_index.get('files', {}).items():
+            self._queue_verify(relative, filedata)
+        self._finish_verify()
+
+    def _start_verify(self, verify_mode=None):
+        self._verify_mode = verify_mode or self.verify_mode
+        self._verify_jobs = []
+        self.hash_cache.load()
+        self.hash_cache.reset_stats()
+        self.files = {}
+
+    def _queue_verify(self, relative, filedata):
+        entry = self.local_files.get(relative)
+        if entry is None:
             return
-        self.files = {relative: sha256_hash(full) for full, relative, in
-                      list_files(self.directory)}
-        self.is_indexed = True
+        if filedata['size'] != entry.stat.st_size:
+            # needs downloading, but a delta is picked by its current hash
+            # and its chunks are only reused while that hash is recorded
+            if 'deltas' not in filedata and 'chunks' not in filedata:
+                return
+        if self._verify_mode == VERIFY_QUICK:
+            filehash = self.hash_cache.lookup(relative, entry.stat)
+            if filehash is not None:
+                self.files[relative] = filehash
+                return
+        self._verify_jobs.append(
+            (entry.full_path, relative, entry.stat.st_size))
+
+    def _finish_verify(self):
+        jobs, self._verify_jobs = self._verify_jobs, []
+        logging.info('Hashing %s of %s local files in %s (%s mode)...' %
+                     (len(jobs), len(self.local_files), self.directory,
+                      self._verify_mode))
+        for relative, filehash in self._hashing_engine().hash_files(jobs):
+            if filehash is None:
+                continue
+            self.files[relative] = filehash
+            self.hash_cache.store(
+                relative, self.local_files[relative].stat, filehash)
+        self.hash_cache.prune(self.local_files)
+        self.hash_cache.save()
+        logging.info('Hash cache for %s: %s hits, %s misses' %
+                     (self.name, self.hash_cache.hits, self.hash_cache.misses))
+
+    @property
+    def verify_mode(self):
+        if '--full-verify' in sys.argv:
+            return VERIFY_FULL
+        return getattr(self.config, 'verify_mode', VERIFY_QUICK)
+
+    def _hashing_engine(self):
+        workers = 1
+        if not self.low_priority:
+            workers = getattr(self.config, 'hash_workers', None)
+        return HashingEngine(
+            workers=workers,
+            use_processes=getattr(self.config, 'hash_processes', False))
 
     def launch_game(self, game_binary, command_args):
         binary_path = os.path.join(self.directory, game_binary)
@@ -73,34 +234,96 @@ class Branch(object):
         sys.exit()
 
     def _diff_files(self, context):
-        url_format = self.remote_index['url_format']
-        for filename, filedata in self.remote_index['files'].items():
+        remote_files = self.remote_index['files']
+        self.plan = DiffPlan.compute(remote_files, self.local_files,
+                                     self.files)
+        logging.info('Compared %s against the remote index: %s' %
+                     (self.name, self.plan.summary()))
+        if not self.plan.needs_update:
+            return
+        self.needs_update = True
+        url_template = compile_template(self.remote_index['url_format'])
+        chunk_url = None
+        if 'chunk_url_format' in self.remote_index:
+            chunk_url = inject_variables(
+                self.remote_index['chunk_url_format'], context)
+            self.chunk_store.load()
+            self.chunk_store.add_installed(self.directory, self.files)
+        packs = self.remote_index.get('packs', {})
+        packed = {}
+        for filename in self.plan.downloads:
+            filedata = remote_files[filename]
             filehash = filedata['sha256']
             filesize = filedata['size']
-            context.update(filename=filename, filehash=filehash)
-            url = inject_variables(url_format, context)
-
             file_path = os.path.join(self.directory, filename)
-            if filename not in self.files:
-                logging.info('Missing file: %s (%s)' % (filehash, filename))
-            elif self.files[filename] != filehash:
+            if filename in self.files:
                 logging.info('Hash mismatch: %s (%s vs %s)' % (filename,
                              filehash, self.files[filename]))
+            elif filename in self.local_files:
+                logging.info('Size mismatch: %s (%s vs %s)' % (
+                    filename, filesize,
+                    self.local_files[filename].stat.st_size))
             else:
-                logging.info('Matched File: %s (%s)' % (filehash, filename))
+                logging.info('Missing file: %s (%s)' % (filehash, filename))
+            if filename in self.prefetched:
                 continue
-            self.needs_update = True
-            self.download_tracker.add_download(file_path, url, filesize)
+            context.update(filename=filename, filehash=filehash)
+            url = url_template(context)
+            if filedata.get('pack') in packs:
+                packed.setdefault(filedata['pack'], {})[filename] = Download(
+                    file_path, url, filesize, filehash,
+                    **self._download_options(filename, filedata))
+                continue
+            if chunk_url is not None and 'chunks' in filedata:
+                self.download_tracker.add(ChunkedDownload(
+                    file_path, chunk_url, filesize, filehash,
+                    filedata['chunks'], self.chunk_store))
+                continue
+            self.download_tracker.add_download(
+                file_path, url, filesize, filehash,
+                **self._download_options(filename, filedata))
+        for name, members in packed.items():
+            self._add_pack(name, packs[name], members, context)
+
+    def _download_options(self, filename, filedata):
+        options = {}
+        encoding = filedata.get('encoding')
+        if is_supported(encoding):
+            options = {'encoding': encoding,
+                       'compressed_size': filedata['compressed_size']}
+        elif encoding is not None:
+            logging.info('Unsupported encoding %s for %s, downloading '
+                         'it uncompressed.' % (encoding, filename))
+        delta = filedata.get('deltas', {}).get(self.files.get(filename))
+        if delta is not None:
+            options.update(delta_from=self.files[filename],
+                           delta_size=delta['size'])
+        return options
+
+    def _add_pack(self, name, packdata, members, context):
+        # A pack only pays off when it replaces more than one request
+        # without fetching much more than the files would on their own.
+        needed = sum(member.total_size for member in members.values())
+        if len(members) == 1 or \
+                needed * PACK_MAX_OVERHEAD < packdata['size']:
+            for member in members.values():
+                self.download_tracker.add(member)
+            return
+        context.update(filename=name, filehash=packdata['sha256'])
+        url = inject_variables(self.remote_index['url_format'], context)
+        self.download_tracker.add(PackDownload(
+            os.path.join(self.directory, name), url, packdata['size'],
+            packdata['sha256'], members))
 
     def _preclean_branch_directory(self):
-        directories = set(os.path.dirname(download.file_path)
-                          for download in self.download_tracker)
+        paths = [path for download in self.download_tracker
+                 for path in download.file_paths]
+        directories = set(os.path.dirname(path) for path in paths)
         for directory in directories:
             if not os.path.exists(directory):
                 logging.info('Creating new directory: %s' % directory)
                 os.makedirs(directory)
-        for download in self.download_tracker:
-            path = download.file_path
+        for path in paths:
             if os.path.isdir(path):
                 logging.info('Delete conflicting directory: %s' % path)
                 shutil.rmtree(path)
@@ -109,32 +332,228 @@ class Branch(object):
         asyncio.set_event_loop(get_loop())
         branch_context = dict(context)
         branch_context["branch"] = self.source_branch
-        url = inject_variables(self.config.index_endpoint, branch_context)
-        logging.info('Fetching remote index from %s...' % url)
-        response = requests.get(url)
-
-        # TODO(james7132): Do proper error checking
-        self.remote_index = response.json()
-        logging.info('Fetched remote index from %s...' % url)
+        # nothing is matched before the remote index arrives
+        self._start_verify()
+        matcher = self._fetch_matcher
+        self._fetch_matcher = None
+        if matcher is None:
+            # compare against the files found by the last scan
+            matcher = FileMatcher(self._queue_verify)
+            matcher.local_files.update(self.local_files)
+            matcher.finish_scan()
+        from_delta = self._fetch_index_delta(branch_context, matcher)
+        if not from_delta:
+            self._fetch_full_index(branch_context, matcher)
         branch_context['base_url'] = self.remote_index['base_url']
+        shard_tree = None
+        # the shards are only walked for full indexes
+        if 'shard_root' in self.remote_index and not from_delta:
+            shard_tree = self._load_shards(branch_context, matcher)
+        if self.prefetch:
+            self._start_prefetch(matcher, branch_context)
+        matcher.scan_finished.wait()
+        # only while every file still has the size, mtime and inode it had
+        # when it was hashed: an edit that keeps the size is hashed again
+        if self._verify_mode != VERIFY_FULL and not self._verify_jobs and \
+                self.journal.is_clean(self.index_hash) and \
+                self._sizes_match():
+            logging.info('Remote index unchanged since the installation '
+                         'was last verified, skipping the comparison.')
+            self._verify_jobs = []
+            self.plan = None
+            self.needs_update = False
+            self.last_fetched = time.time()
+            return
         logging.info(
             'Comparing local installation against remote index...')
+        self._finish_verify()
         self._diff_files(branch_context)
+        if not self.needs_update:
+            self._mark_clean()
+            if shard_tree is not None:
+                self.shard_store.prune(shard_tree)
+        self.last_fetched = time.time()
+
+    def _fetch_full_index(self, context, matcher):
+        url = inject_variables(self.config.index_endpoint, context)
+        logging.info('Fetching remote index from %s...' % url)
+        response = self.metadata_cache.get(self.http_client, url,
+                                           stream=True)
+
+        # TODO(james7132): Do proper error checking
+        # Local files are matched against each entry as it arrives, so
+        # only the hashing itself waits for the whole index.
+        hasher = hashlib.sha256()
+        self.remote_index = parse_index(
+            self._hashed_blocks(response, hasher), matcher.add_remote)
+        self.index_hash = hasher.hexdigest()
+        logging.info('Fetched remote index from %s...' % url)
+
+    def _fetch_index_delta(self, context, matcher):
+        """ Brings the index the installation was last verified against up
+        to date with the changes published since its last_updated, so only
+        those changes are downloaded. Returns False if the full
+        index has to be fetched instead: no delta endpoint is configured,
+        the installation wasn't verified, or the endpoint has no changes
+        since then.
+
+        An empty change list keeps the identity (hash and shard root) of
+        the full index the installation was verified against. Once changes
+        are applied no full index with the same content has been seen, so
+        the hash of the change list stands in for it, and the next full
+        fetch compares the installation again before marking it clean.
+        """
+        endpoint = getattr(self.config, 'index_delta_endpoint', None)
+        since = self.journal.applied('last_updated')
+        if endpoint is None or since is None or \
+                not os.path.exists(self.index_snapshot):
+            return False
+        url = inject_variables(endpoint, dict(context, since=since))
+        logging.info('Fetching index changes from %s...' % url)
+        try:
+            response = self.http_client.get(url)
+            response.raise_for_status()
+            delta = response.json()
+            if delta.get('since') != since:
+                raise ValueError('the changes are since %s, not %s' %
+                                 (delta.get('since'), since))
+            index = load_index(self.index_snapshot)
+        except (HTTPError, Timeout, ConnectionError, OSError,
+                ValueError) as error:
+            logging.info('Fetching the full index instead: %s' % error)
+            return False
+        changed = apply_delta(index, delta)
+        if changed or delta.get('removed') or \
+                index.get('last_updated') != since:
+            # the shards no longer describe the files
+            index.pop('shard_root', None)
+            self.index_hash = hashlib.sha256(response.content).hexdigest()
+        else:
+            self.index_hash = self.journal.applied('index_sha256')
+        self.remote_index = index
+        logging.info('%s files changed since %s' % (len(changed), since))
+        for filename, filedata in index['files'].items():
+            matcher.add_remote(filename, filedata)
+        return True
+
+    def _mark_clean(self):
+        last_updated = self.remote_index.get('last_updated')
+        # the next update check applies the delta endpoint's changes to it
+        if getattr(self.config, 'index_delta_endpoint', None) and \
+                last_updated is not None and \
+                (last_updated != self.journal.applied('last_updated') or
+                 not os.path.exists(self.index_snapshot)):
+            save_index(self.index_snapshot, self.remote_index)
+        self.journal.mark_clean(self.index_hash, last_updated=last_updated)
+
+    def _load_shards(self, context, matcher):
+        """ Fills in the files of a sharded index. Only shards that are not
+        stored locally are fetched. Returns the hashes of the shards in the
+        tree. """
+        shard_context = dict(context)
+        shard_url_format = self.remote_index['shard_url_format']
+
+        def fetch(shard_hash):
+            shard_context['shardhash'] = shard_hash
+            response = self.http_client.get(
+                inject_variables(shard_url_format, shard_context))
+            response.raise_for_status()
+            return response.content
+
+        files, shard_tree = load_sharded_files(
+            self.remote_index['shard_root'], fetch, self.shard_store)
+        self.remote_index['files'] = files
+        for filename, filedata in files.items():
+            matcher.add_remote(filename, filedata)
+        return shard_tree
+
+    def _start_prefetch(self, matcher, context):
+        """ Starts downloading the files found to be missing, now and for
+        the rest of the scan, without waiting for the scan or the hashing
+        to finish. update_game then only waits for them. """
+        url_template = compile_template(self.remote_index['url_format'])
+        context = dict(context)
+
+        def prefetch(filename, filedata, *args):
+            # packed and chunked files are fetched along with their peers
+            if 'pack' in filedata or 'chunks' in filedata:
+                return
+            file_path = os.path.join(self.directory, filename)
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            except OSError as error:
+                logging.warning('Cannot prefetch %s: %s' % (filename, error))
+                return
+            if os.path.isdir(file_path):
+                return
+            if not self.prefetched:
+                # verified again (and only then marked clean) on next start
+                self.journal.mark_dirty()
+            context.update(filename=filename, filehash=filedata['sha256'])
+            self.prefetched.add(filename)
+            self.download_tracker.start(
+                Download(file_path, url_template(context), filedata['size'],
+                         filedata['sha256'],
+                         **self._download_options(filename, filedata)),
+                session=self.http_client)
+
+        matcher.watch_missing(prefetch)
+
+    @staticmethod
+    def _hashed_blocks(response, hasher):
+        for block in response.iter_content(INDEX_BLOCK_SIZE):
+            hasher.update(block)
+            yield block
+
+    def _sizes_match(self):
+        # catches files deleted or truncated since the last verification
+        for filename, filedata in self.remote_index['files'].items():
+            entry = self.local_files.get(filename)
+            if entry is None or entry.stat.st_size != filedata['size']:
+                return False
+        return True
 
     def update_game(self):
         asyncio.set_event_loop(get_loop())
-        with requests.Session() as session:
-            logging.info(
-                'Total download size: %s' % self.download_tracker.total_size)
-            self._preclean_branch_directory()
-            self.download_tracker.run(session=session)
-        files = filter(lambda f: f[1] not in self.remote_index['files'],
-                       list_files(self.directory))
-        for fullpath, filename in files:
+        logging.info(
+            'Total download size: %s' % self.download_tracker.total_size)
+        # verified again (and only then marked clean) on the next start
+        self.journal.mark_dirty()
+        self._preclean_branch_directory()
+        self.download_tracker.run(session=self.http_client)
+        self.http_client.log_stats()
+        self._record_chunked_files()
+        for filename in self.plan.extra:
             logging.info('Removing extra file: %s' % filename)
-            os.remove(fullpath)
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
         self.needs_update = False
 
+    def _record_chunked_files(self):
+        # Later updates read unchanged chunks out of the installed files, so
+        # only the files that were already intact or were rebuilt are listed.
+        if 'chunk_url_format' not in self.remote_index:
+            return
+        downloads = set(self.plan.downloads)
+        rebuilt = set(download.file_path for download in self.download_tracker
+                      if isinstance(download, ChunkedDownload) and
+                      download.rebuilt)
+        self.chunk_store.installed.clear()
+        for filename, filedata in self.remote_index['files'].items():
+            if 'chunks' not in filedata:
+                continue
+            if filename in downloads and \
+                    os.path.join(self.directory, filename) not in rebuilt:
+                logging.info('Not recording the chunks of %s: it was not '
+                             'rebuilt.' % filename)
+                continue
+            self.chunk_store.set_installed(
+                filename, filedata['sha256'], filedata['chunks'])
+        self.chunk_store.save()
+        self.chunk_store.prune()
+
 
 class ClientState(Enum):
     # Game is ready to play and launch
@@ -157,18 +576,31 @@ class ClientState(Enum):
 
 class MainWindow(QWidget):
     news_row_count = 0
+    _client_state = None
+    _state_changed = None
+    index_fetches = None
+    time_to_ready = None
+    background_checks = None
 
     def __init__(self, cfg):
         super().__init__()
+        self.started_at = time.monotonic()
         self.config = cfg
+        self.thread_count = multiprocessing.cpu_count() * THREAD_MULTIPLIER
+        self.http_client = HTTPClient(self.connection_pool_size())
+        self.metadata_cache = MetadataCache(metadata_cache_dir())
+        self.throttle = self.create_throttle()
         branches = self.config.branches
         self.branches = {
-            name: Branch(name, branch, cfg)
+            name: Branch(name, branch, cfg, self.http_client,
+                         self.metadata_cache)
             for branch, name in branches.items()
         }
         self.persistent_data = {}
         self.load_persistent_data()
         self.branch = self.branches[self.persistent_data['branch']]
+        # the (scan, index fetch) futures of each branch checked so far
+        self.checks = {}
         self.context = dict(GLOBAL_CONTEXT)
         self.context.update({
             'project': sanitize_url(self.config.project),
@@ -177,6 +609,53 @@ class MainWindow(QWidget):
         self.client_state = ClientState.LAUNCHER_UPDATE_CHECK
         self.init_ui()
 
+    def connection_pool_size(self):
+        # Every concurrent download may be a segmented file fetched over
+        # several connections to the same host at once.
+        pool_size = getattr(self.config, 'http_pool_size', None)
+        if pool_size:
+            return pool_size
+        max_downloads = getattr(self.config, 'max_concurrent_downloads',
+                                None) or MAX_CONCURRENT_DOWNLOADS
+        connections = getattr(self.config, 'download_connections', None)
+        return max_downloads * max(connections or 1, 1)
+
+    def critical_files(self):
+        critical_files = getattr(self.config, 'critical_files', None)
+        if critical_files is not None:
+            return critical_files
+        game_binary = getattr(self.config, 'game_binary', {})
+        binary = game_binary.get(get_platform())
+        return [binary] if binary else []
+
+    def create_throttle(self):
+        limit = getattr(self.config, 'bandwidth_limit', None)
+        profiles = getattr(self.config, 'bandwidth_schedule', None) or ()
+        if not limit and not profiles:
+            return None
+        # one bucket for every download, so the limit covers all of them
+        return TokenBucket(BandwidthSchedule(limit, profiles))
+
+    @property
+    def client_state(self):
+        return self._client_state
+
+    @client_state.setter
+    def client_state(self, state):
+        self._client_state = state
+        if self._state_changed is not None:
+            self._state_changed.set()
+
+    async def wait_for_state_change(self):
+        """ Sleeps until client_state is set to a different state. """
+        state = self.client_state
+        if self._state_changed is None:
+            # created lazily so it belongs to the loop running main_loop
+            self._state_changed = asyncio.Event()
+        while self.client_state == state:
+            self._state_changed.clear()
+            await self._state_changed.wait()
+
     def load_persistent_data(self):
         if CONFIG_DIR:
             data_path = os.path.join(CONFIG_DIR, DATA_FILE)
@@ -202,25 +681,29 @@ class MainWindow(QWidget):
 
     async def main_loop(self):
         state_mapping = {
-            ClientState.LAUNCHER_UPDATE_CHECK: self.launcher_update_check,
+            ClientState.LAUNCHER_UPDATE_CHECK: self.startup_checks,
             ClientState.GAME_STATUS_CHECK: self.game_status_check,
             ClientState.GAME_UPDATE_CHECK: self.game_update_check,
             ClientState.PENDING_GAME_UPDATE: self.pending_game_update,
             ClientState.GAME_UPDATE: self.game_update,
             ClientState.READY: self.ready
         }
-        thread_count = multiprocessing.cpu_count() * THREAD_MULTIPLIER
-        with QThreadExecutor(thread_count) as self.executor:
+        with QThreadExecutor(self.thread_count) as self.executor:
             self.download_tracker.executor = self.executor
             for branch in self.branches.values():
                 branch.download_tracker.executor = self.executor
             asyncio.ensure_future(self.fetch_news())
             while True:
                 if self.client_state in state_mapping:
-                    state = self.client_state
                     await state_mapping[self.client_state]()
                 else:
-                    await asyncio.sleep(0.1)
+                    await self.wait_for_state_change()
+
+    async def startup_checks(self):
+        # The launcher is checked in the background, alongside the game
+        # checks it hands over to right away.
+        asyncio.ensure_future(self.launcher_update_check())
+        await self.wait_for_state_change()
 
     async def fetch_news(self):
         logging.info('Fetching news!')
@@ -230,10 +713,10 @@ class MainWindow(QWidget):
         feed_url = self.build_path(self.config.news_rss_feed)
         # TODO(james7132): Do proper error checking
         try:
-            rss_response = requests.get(
-                feed_url, headers={
-                    'User-Agent': 'HouraiLauncher 0.1.0'
-                    })
+            rss_response = await get_loop().run_in_executor(
+                self.executor, functools.partial(
+                    self.metadata_cache.get, self.http_client, feed_url,
+                    headers={'User-Agent': 'HouraiLauncher 0.1.0'}))
             error_occurred = False
         except HTTPError as http_error:
             logging.error(http_error)
@@ -291,7 +774,7 @@ class MainWindow(QWidget):
         self.launch_game_btn.setEnabled(True)
         self.launch_game_btn.show()
         self.progress_bar.hide()
-        await asyncio.sleep(0.1)
+        await self.wait_for_state_change()
 
     async def ready(self):
         self.branch_box.setEnabled(True)
@@ -299,7 +782,7 @@ class MainWindow(QWidget):
         self.launch_game_btn.setEnabled(True)
         self.launch_game_btn.show()
         self.progress_bar.hide()
-        await asyncio.sleep(0.1)
+        await self.wait_for_state_change()
 
     async def launcher_update_check(self):
         self.branch_box.setEnabled(False)
@@ -310,16 +793,18 @@ class MainWindow(QWidget):
         if '--test' in sys.argv or not hasattr(self.config,
                                                'launcher_endpoint'):
             return
-        launcher_hash = sha256_hash(sys.executable).strip()
+        launcher_hash = await get_loop().run_in_executor(
+            self.executor, sha256_hash, sys.executable)
+        launcher_hash = launcher_hash.strip()
         logging.info('Launcher Hash: "%s"' % launcher_hash)
         url = self.build_path(self.config.launcher_endpoint)
         hash_url = url + '.hash'
         logging.info('Fetching remote hash from: %s' % hash_url)
         # TODO(james7132): Do proper error checking
         try:
-            response = await get_loop().run_in_executor(self.executor,
-                                                        requests.get,
-                                                        hash_url)
+            response = await get_loop().run_in_executor(
+                self.executor, self.metadata_cache.get, self.http_client,
+                hash_url)
             error_occurred = False
         except HTTPError as http_error:
             logging.error(http_error)
@@ -347,13 +832,29 @@ class MainWindow(QWidget):
         temp_file = sys.executable + '.new'
         logging.info('Saving new launcher to: %s' % temp_file)
         old_file = sys.executable + '.old'
+        # keeps the game checks still running from taking over the UI
+        self.client_state = ClientState.LAUNCHER_UPDATE
+        self.launch_game_btn.setEnabled(False)
+        self.branch_box.setEnabled(False)
         self.download_tracker.clear()
         self.download_tracker.add_download(
-            temp_file, url, os.path.getsize(sys.executable))
+            temp_file, url, os.path.getsize(sys.executable),
+            remote_launcher_hash)
         self.launch_game_btn.setText(_('Updating Launcher'))
         self.launch_game_btn.show()
         self.progress_bar.show()
-        await self.download_tracker.run_async()
+        try:
+            await self.download_tracker.run_async(session=self.http_client)
+        except DownloadError as error:
+            logging.error(error)
+            if self.news_row_count < 10:
+                self.news_row_count += 1
+                self.news_view.addRow(QLabel(
+                    "Could not update the launcher. "
+                    "Check the log for details."))
+            # carry on with the game checks
+            self.client_state = ClientState.GAME_STATUS_CHECK
+            return
         if remote_launcher_hash != sha256_hash(temp_file):
             logging.error('Downloaded launcher does not match one'
                           ' described by remote hash file.')
@@ -374,20 +875,84 @@ class MainWindow(QWidget):
         self.launch_game_btn.setText(_('Checking local installation...'))
         self.launch_game_btn.setEnabled(False)
         start = time.time()
-        await asyncio.gather(*[
-            get_loop().run_in_executor(self.executor, branch.index_directory)
-            for branch in self.branches.values()])
+        await asyncio.gather(*self.start_game_checks())
         logging.info('Local installation check completed.')
         logging.info('Game status check took %s seconds.' % (time.time() -
                                                              start))
-        self.client_state = ClientState.GAME_UPDATE_CHECK
+        if self.client_state != ClientState.LAUNCHER_UPDATE:
+            self.client_state = ClientState.GAME_UPDATE_CHECK
+
+    def start_game_checks(self):
+        """ Starts checking the selected branch. Returns its scan; the
+        index fetch is left to game_update_check. The other branches are
+        only checked once it is ready, or when they are selected. """
+        scan, fetch = self.start_branch_check(self.branch)
+        self.index_fetches = [fetch]
+        return [scan]
+
+    def start_branch_check(self, branch):
+        """ Starts scanning branch's installation and, at the same time,
+        fetching its remote index: each file is compared as soon as both
+        sides have it. Returns the (scan, fetch) futures, reusing those of
+        a check that is still running or has succeeded. """
+        check = self.checks.get(branch.name)
+        if check is not None and not any(
+                future.done() and (future.cancelled() or
+                                   future.exception() is not None)
+                for future in check):
+            return check
+        loop = get_loop()
+        branch.prefetch = branch is self.branch and \
+            getattr(self.config, 'prefetch_missing_files', False)
+        branch.begin_scan()
+        # the scan is queued first, as the fetch waits for it
+        check = self.checks[branch.name] = (
+            loop.run_in_executor(self.executor, branch.index_directory),
+            loop.run_in_executor(self.executor, branch.fetch_remote_index,
+                                 self.context))
+        return check
+
+    def branch_checked(self, branch):
+        """ Whether a check of branch has finished without failing. """
+        check = self.checks.get(branch.name)
+        return check is not None and all(
+            future.done() and not future.cancelled() and
+            future.exception() is None for future in check)
+
+    def start_background_checks(self):
+        unchecked = [branch for name, branch in self.branches.items()
+                     if name not in self.checks]
+        if unchecked and self.background_checks is None:
+            self.background_checks = asyncio.ensure_future(
+                self.check_in_background(unchecked))
+
+    async def check_in_background(self, branches):
+        """ Checks branches one at a time, on a single thread each and
+        never while the game is updating, so that selecting one of them
+        later shows its state right away. """
+        for branch in branches:
+            while self.client_state == ClientState.GAME_UPDATE:
+                await self.wait_for_state_change()
+            if branch.name in self.checks:
+                # selected in the meantime
+                continue
+            logging.info('Checking %s in the background...' % branch.name)
+            branch.low_priority = True
+            try:
+                await asyncio.gather(*self.start_branch_check(branch))
+            except Exception as error:
+                # checked again when selected; the rest still go ahead
+                logging.exception(error)
+            finally:
+                branch.low_priority = False
 
     async def game_update_check(self):
         self.branch_box.setEnabled(False)
         logging.info('Checking for remote game updates...')
-        downloads = [get_loop().run_in_executor(
-            self.executor, branch.fetch_remote_index,
-            self.context) for branch in self.branches.values()]
+        downloads = self.index_fetches
+        self.index_fetches = None
+        if downloads is None:
+            downloads = self.start_branch_check(self.branch)
         try:
             await asyncio.gather(*downloads)
             error_occurred = False
@@ -410,16 +975,33 @@ class MainWindow(QWidget):
 
         logging.info('Remote game update check completed.')
         self.set_idle_state()
+        self.start_background_checks()
 
     async def game_update(self):
         self.launch_game_btn.hide()
         self.progress_bar.show()
         self.branch_box.setEnabled(False)
-        await get_loop().run_in_executor(self.executor,
-                                         self.branch.update_game)
+        try:
+            await get_loop().run_in_executor(self.executor,
+                                             self.branch.update_game)
+        except DownloadError as error:
+            # still pending: updating again retries the failed files
+            logging.error(error)
+            if self.news_row_count < 10:
+                self.news_row_count += 1
+                self.news_view.addRow(QLabel(
+                    "Could not download every file of the update. "
+                    "Check the log for details."))
         self.set_idle_state()
 
     def set_idle_state(self):
+        if self.client_state == ClientState.LAUNCHER_UPDATE:
+            return
+        if self.time_to_ready is None:
+            self.time_to_ready = time.monotonic() - self.started_at
+            logging.info('%s button ready %.2f seconds after startup.' % (
+                'Update Game' if self.branch.needs_update else 'Launch Game',
+                self.time_to_ready))
         if self.branch.needs_update:
             self.client_state = ClientState.PENDING_GAME_UPDATE
         else:
@@ -448,10 +1030,13 @@ class MainWindow(QWidget):
 
         self.progress_bar = QProgressBar()
         self.progress_bar.hide()
-        self.download_tracker = DownloadTracker(self.progress_bar)
+        self.download_tracker = self.create_download_tracker()
+        self.download_tracker.add_listener(self.show_download_progress)
 
         for branch in self.branches.values():
-            branch.set_download_tracker(DownloadTracker(self.progress_bar))
+            tracker = self.create_download_tracker()
+            tracker.add_listener(self.show_download_progress)
+            branch.set_download_tracker(tracker)
 
         self.launch_game_btn.clicked.connect(self.button_clicked)
 
@@ -472,17 +1057,51 @@ class MainWindow(QWidget):
 
         self.setLayout(default_layout)
 
+    def show_download_progress(self, event):
+        if event.rate is None:
+            return
+        text = '%s/s' % format_size(event.rate)
+        if event.eta is not None:
+            text = _('%s, %s left') % (text, format_duration(event.eta))
+        self.progress_bar.setFormat('%p% (' + text + ')')
+
+    def create_download_tracker(self):
+        options = dict(
+            segment_size=getattr(self.config, 'download_segment_size', None),
+            connections=getattr(self.config, 'download_connections', None),
+            throttle=self.throttle,
+            max_downloads=getattr(
+                self.config, 'max_concurrent_downloads', None),
+            policy=getattr(self.config, 'download_order', None),
+            critical_files=self.critical_files())
+        engine = getattr(self.config, 'download_engine', 'threads')
+        if engine == 'asyncio':
+            if aiohttp is not None:
+                return AsyncDownloadTracker(self.progress_bar, **options)
+            logging.warning('aiohttp is not installed, falling back to '
+                            'the threaded download engine')
+        return DownloadTracker(self.progress_bar, **options)
+
     def on_branch_change(self, selection):
+        if self.client_state == ClientState.LAUNCHER_UPDATE:
+            return
         self.branch = self.branches[selection]
         self.persistent_data['branch'] = self.branch.name
         self.save_persistent_data()
         logging.info("Changed to branch: %s" % self.branch)
-        self.set_idle_state()
+        self.branch.low_priority = False
+        if self.branch_checked(self.branch):
+            self.set_idle_state()
+        else:
+            # not checked yet, still being checked in the background or
+            # failed: game_status_check waits for or restarts the check
+            self.client_state = ClientState.GAME_STATUS_CHECK
 
     def button_clicked(self):
+        # a click queued while the launcher updates itself is dropped
         if self.client_state == ClientState.READY:
             self.launch_game()
-        else:
+        elif self.client_state == ClientState.PENDING_GAME_UPDATE:
             self.client_state = ClientState.GAME_UPDATE
 
     def launch_game(self):
@@ -3,8 +3,18 @@ import logging
 import hashlib
 import platform
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 CHUNK_SIZE = 1024**2
+# Files at least this large are read in bigger blocks to cut down on syscalls.
+LARGE_FILE_SIZE = 1024**3
+LARGE_FILE_BLOCK_SIZE = 4 * CHUNK_SIZE
+DEFAULT_FS_BLOCK_SIZE = 4096
+
+# hashlib.file_digest was added in Python 3.11.
+_file_digest = getattr(hashlib, 'file_digest', None)
+_hash_buffers = threading.local()
 
 
 def get_platform():
@@ -14,26 +24,144 @@ def get_platform():
     return plat
 
 
-def sha256_hash(filepath, block_size=CHUNK_SIZE):
-    hasher = hashlib.sha256()
-    assert block_size > 0, ("hash block size must be greater than zero.")
-    with open(filepath, 'rb') as hash_file:
-        for block in iter(lambda: hash_file.read(block_size), b''):
-            hasher.update(block)
-    logging.info('File hash: %s (%s)' % (hasher.hexdigest(), filepath))
-    return hasher.hexdigest()
+def pick_block_size(file_size, fs_block_size=None):
+    """ Picks how much of a file to read at a time when hashing it.
+    Small files are read whole (rounded up to the filesystem block size),
+    large ones in CHUNK_SIZE blocks and very large ones in even larger
+    blocks.
+    """
+    fs_block_size = fs_block_size or DEFAULT_FS_BLOCK_SIZE
+    if file_size >= LARGE_FILE_SIZE:
+        return LARGE_FILE_BLOCK_SIZE
+    if file_size >= CHUNK_SIZE:
+        return CHUNK_SIZE
+    # one extra byte so the whole file is consumed by the first read
+    blocks = (file_size + fs_block_size) // fs_block_size
+    return max(blocks, 1) * fs_block_size
+
+
+def _get_hash_buffer(size):
+    """ Returns a per-thread buffer of at least size bytes.
+    Reusing it keeps hashing from allocating a new block for every read.
+    """
+    buffer = getattr(_hash_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = _hash_buffers.buffer = bytearray(size)
+    return buffer
+
+
+def sha256_hash(filepath, block_size=None):
+    assert block_size is None or block_size > 0, (
+        "hash block size must be greater than zero.")
+    # Unbuffered: every read lands straight in our own reusable buffer.
+    with open(filepath, 'rb', buffering=0) as hash_file:
+        if block_size is None:
+            stat = os.fstat(hash_file.fileno())
+            block_size = pick_block_size(
+                stat.st_size, getattr(stat, 'st_blksize', None))
+            use_file_digest = (_file_digest is not None and
+                               stat.st_size >= CHUNK_SIZE)
+        else:
+            use_file_digest = False
+        if use_file_digest:
+            hasher = _file_digest(hash_file, 'sha256')
+        else:
+            hasher = hashlib.sha256()
+            view = memoryview(_get_hash_buffer(block_size))[:block_size]
+            while True:
+                read_size = hash_file.readinto(view)
+                if not read_size:
+                    break
+                hasher.update(view[:read_size])
+    filehash = hasher.hexdigest()
+    logging.info('File hash: %s (%s)' % (filehash, filepath))
+    return filehash
+
+
+FileEntry = collections.namedtuple(
+    'FileEntry', ('full_path', 'relative_path', 'stat'))
+
+
+def _file_entry(entry, relative_path, with_stat):
+    stat = None
+    if with_stat:
+        try:
+            # Free on Windows; a single stat call elsewhere.
+            stat = entry.stat()
+        except OSError as error:
+            logging.warning('Cannot stat %s: %s' % (entry.path, error))
+            return None
+    return FileEntry(entry.path, relative_path, stat)
+
+
+def _scan_tree(directory, prefix='', with_stat=True, on_directory=None):
+    pending = [(directory, prefix)]
+    while pending:
+        path, prefix = pending.pop()
+        subdirectories = []
+        for entry in os.scandir(path):
+            relative_path = prefix + entry.name
+            # is_dir and is_symlink are answered from the directory listing
+            # itself on all major platforms, so they cost no extra syscalls.
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirectories.append((entry.path, relative_path + '/'))
+                continue
+            file_entry = _file_entry(entry, relative_path, with_stat)
+            if file_entry is not None:
+                yield file_entry
+        if on_directory is not None:
+            on_directory(prefix, [child for _, child in subdirectories])
+        pending.extend(subdirectories)
+
+
+def _scan_subtree(path, prefix, with_stat):
+    directories = []
+    entries = list(_scan_tree(path, prefix, with_stat,
+                              lambda *listed: directories.append(listed)))
+    return entries, directories
+
+
+def scan_files(directory, workers=None, with_stat=True, on_directory=None):
+    """ Recursively lists the files under directory with one stat per file.
+    Yields FileEntry tuples whose relative paths always use '/' separators.
+    Like os.walk, symlinked directories are not descended into.
+    With more than one worker, each top level subdirectory is scanned on
+    its own thread, which helps with very wide trees and network drives.
+    on_directory(prefix, subdirectories) is called once all the files of a
+    directory have been yielded, with the relative prefixes ('' for the
+    root, 'a/b/' otherwise) of the directory and of its subdirectories.
+    """
+    if not workers or workers <= 1:
+        yield from _scan_tree(directory, with_stat=with_stat,
+                              on_directory=on_directory)
+        return
+    subdirectories = []
+    for entry in os.scandir(directory):
+        if entry.is_dir():
+            if not entry.is_symlink():
+                subdirectories.append(entry)
+            continue
+        file_entry = _file_entry(entry, entry.name, with_stat)
+        if file_entry is not None:
+            yield file_entry
+    if on_directory is not None:
+        on_directory('', [entry.name + '/' for entry in subdirectories])
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(_scan_subtree, entry.path,
+                                   entry.name + '/', with_stat)
+                   for entry in subdirectories]
+        for future in as_completed(futures):
+            entries, directories = future.result()
+            yield from entries
+            if on_directory is not None:
+                for listed in directories:
+                    on_directory(*listed)
 
 
 def list_files(directory):
-    sep = os.path.sep
-    # using os.path.join to prevent an additional
-    # os.path.sep if directory already ends with it
-    root = os.path.join(directory, '')
-    for directory, _, files in os.walk(directory):
-        for file in files:
-            full_path = os.path.join(directory, file)
-            relative_path = os.path.relpath(full_path, root).replace(sep, '/')
-            yield full_path, relative_path
+    for entry in _scan_tree(directory, with_stat=False):
+        yield entry.full_path, entry.relative_path
 
 
 def tupperware(mapping):
@@ -55,3 +55,15 @@ class AsyncTestCase(TestCase):
 
     def run_async(self, coroutine, *args, **kwargs):
         return self.loop.run_until_complete(coroutine(*args, **kwargs))
+
+
+class WakeupCountingLoop(asyncio.SelectorEventLoop):
+    '''
+    An event loop that counts how many times it wakes up to run callbacks,
+    so tests can check that idle code is not polling.
+    '''
+    wakeups = 0
+
+    def _run_once(self):
+        self.wakeups += 1
+        super()._run_once()
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import os
+import unittest
+from unittest import mock
+from async_download import AsyncDownloadTracker, aiohttp
+from download import DownloadError, PART_SUFFIX
+from test_download import LocalServerTestCase, ProgressBarMock,\
+     assert_downloaded
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncDownloadTrackerTest(LocalServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.progress_bar = ProgressBarMock()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super().tearDown()
+
+    def _run(self, tracker):
+        self.loop.run_until_complete(tracker.run_async())
+
+    def test_async_tracker_downloads_many_files(self):
+        tracker = AsyncDownloadTracker(self.progress_bar, max_downloads=3)
+        files = {}
+        for i in range(20):
+            data = os.urandom(1024 * (i + 1))
+            self.server.files['/file_%s.bin' % i] = data
+            path = os.path.join(self.temp_dir, 'file_%s.bin' % i)
+            files[path] = data
+            tracker.add_download(path, self.server.url('/file_%s.bin' % i),
+                                 len(data), hashlib.sha256(data).hexdigest())
+        self._run(tracker)
+
+        for path, data in files.items():
+            assert_downloaded(self, path, data)
+        self.assertEqual(tracker.downloaded_bytes, tracker.total_size)
+        self.assertLessEqual(tracker.peak_active_downloads, 3)
+        self.assertGreater(tracker.peak_active_downloads, 1)
+        self.assertEqual(tracker.active_downloads, 0)
+
+    def test_async_tracker_resumes_interrupted_download(self):
+        self._interrupted_download(3 * 1024**2 + 100)
+        tracker = AsyncDownloadTracker(self.progress_bar)
+        tracker.add_download(self.path, self.url, len(self.data),
+                             self.filehash)
+        self._run(tracker)
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests[-1],
+                         ('/asset.bin', 'bytes=%s-' % (3 * 1024**2)))
+        self.assertEqual(tracker.downloaded_bytes, len(self.data))
+
+    def test_async_tracker_restarts_when_ranges_are_ignored(self):
+        self._interrupted_download(2 * 1024**2 + 100)
+        self.server.ignore_ranges = True
+        tracker = AsyncDownloadTracker(self.progress_bar)
+        tracker.add_download(self.path, self.url, len(self.data),
+                             self.filehash)
+        self._run(tracker)
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(tracker.downloaded_bytes, len(self.data))
+
+    def test_async_tracker_requests_identity_encoding(self):
+        tracker = AsyncDownloadTracker(self.progress_bar)
+        tracker.add_download(self.path, self.url, len(self.data),
+                             self.filehash)
+        self._run(tracker)
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.accept_encoding, 'identity')
+
+    def test_async_tracker_never_saves_error_pages(self):
+        path = os.path.join(self.temp_dir, 'missing.bin')
+        tracker = AsyncDownloadTracker(self.progress_bar)
+        tracker.add_download(path, self.server.url('/missing.bin'), 10,
+                             None)
+        with self.assertRaises(DownloadError) as raised:
+            self._run(tracker)
+
+        self.assertEqual(len(raised.exception.failures), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + PART_SUFFIX))
+
+    @mock.patch('download.SEGMENTED_MIN_SIZE', 1024**2)
+    def test_async_tracker_sends_segmented_files_to_executor(self):
+        tracker = AsyncDownloadTracker(self.progress_bar,
+                                       segment_size=1024**2, connections=2)
+        tracker.add_download(self.path, self.url, len(self.data),
+                             self.filehash)
+        self.assertTrue(tracker.downloads[0].is_segmented)
+        self._run(tracker)
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertGreater(len(self.server.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
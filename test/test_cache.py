@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from cache import HashCache, atomic_write_json, RACY_WINDOW_NS,\
+     CachedResponse, InstallJournal, MetadataCache
+
+
+class HashCacheTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'hashes.json')
+        self.file_path = os.path.join(self.temp_dir, 'test_file.bin')
+        with open(self.file_path, 'wb') as test_file:
+            test_file.write(b'\xff' * 1024)
+        # backdate the file so it is outside the racy window
+        old_time = os.stat(self.file_path).st_mtime - 60
+        os.utime(self.file_path, (old_time, old_time))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_hash_cache_hits_after_store(self):
+        cache = HashCache(self.cache_path)
+        stat = os.stat(self.file_path)
+        self.assertIsNone(cache.lookup('test_file.bin', stat))
+        cache.store('test_file.bin', stat, 'HASH')
+        self.assertEqual(cache.lookup('test_file.bin', stat), 'HASH')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_hash_cache_persists_across_loads(self):
+        cache = HashCache(self.cache_path)
+        stat = os.stat(self.file_path)
+        cache.store('test_file.bin', stat, 'HASH')
+        cache.save()
+        self.assertFalse(cache.dirty)
+
+        reloaded = HashCache(self.cache_path)
+        reloaded.load()
+        self.assertEqual(reloaded.lookup('test_file.bin', stat), 'HASH')
+        self.assertEqual(reloaded.hits, 1)
+
+    def test_hash_cache_misses_on_modified_file(self):
+        cache = HashCache(self.cache_path)
+        cache.store('test_file.bin', os.stat(self.file_path), 'HASH')
+        with open(self.file_path, 'ab') as test_file:
+            test_file.write(b'\x00')
+
+        self.assertIsNone(
+            cache.lookup('test_file.bin', os.stat(self.file_path)))
+        self.assertNotIn('test_file.bin', cache.entries)
+        self.assertTrue(cache.dirty)
+
+    def test_hash_cache_skips_racy_entries(self):
+        cache = HashCache(self.cache_path)
+        stat = os.stat(self.file_path)
+        cache.store('test_file.bin', stat, 'HASH',
+                    hashed_at=stat.st_mtime_ns + RACY_WINDOW_NS // 2)
+        self.assertNotIn('test_file.bin', cache.entries)
+
+    def test_hash_cache_prunes_missing_files(self):
+        cache = HashCache(self.cache_path)
+        stat = os.stat(self.file_path)
+        cache.store('test_file.bin', stat, 'HASH')
+        cache.store('deleted.bin', stat, 'HASH')
+        cache.prune(['test_file.bin'])
+        self.assertEqual(set(cache.entries), {'test_file.bin'})
+
+    def test_hash_cache_discards_corrupt_file(self):
+        with open(self.cache_path, 'w') as cache_file:
+            cache_file.write('{"version": 1, "files": ')
+        cache = HashCache(self.cache_path)
+        cache.load()
+        self.assertEqual(len(cache), 0)
+
+    def test_hash_cache_discards_other_versions(self):
+        with open(self.cache_path, 'w') as cache_file:
+            json.dump({'version': -1, 'files': {'a': [0, 0, 0, 'x']}},
+                      cache_file)
+        cache = HashCache(self.cache_path)
+        cache.load()
+        self.assertEqual(len(cache), 0)
+
+    def test_atomic_write_json_leaves_no_temp_files(self):
+        atomic_write_json(self.cache_path, {'test': 1})
+        atomic_write_json(self.cache_path, {'test': 2})
+        with open(self.cache_path, 'r') as cache_file:
+            self.assertEqual(json.load(cache_file), {'test': 2})
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         ['hashes.json', 'test_file.bin'])
+
+
+class ValidatingResponse(object):
+
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class ValidatingServerMock(object):
+    """ Serves one resource, answering 304 while the client's validators
+    still match. """
+
+    def __init__(self, content, etag=None, last_modified=None):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append(headers)
+        validators = {}
+        if self.etag:
+            validators['ETag'] = self.etag
+        if self.last_modified:
+            validators['Last-Modified'] = self.last_modified
+        if (self.etag and headers.get('If-None-Match') == self.etag) or \
+                (self.last_modified and headers.get('If-Modified-Since') ==
+                 self.last_modified):
+            return ValidatingResponse(304, headers=validators)
+        return ValidatingResponse(200, self.content, validators)
+
+
+class MetadataCacheTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = MetadataCache(os.path.join(self.temp_dir, 'http'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_metadata_cache_serves_not_modified_from_disk(self):
+        server = ValidatingServerMock(b'{"files": {}}', etag='"v1"')
+        first = self.cache.get(server, 'http://host/index.json')
+        second = self.cache.get(server, 'http://host/index.json',
+                                headers={'User-Agent': 'test'})
+
+        self.assertIs(first.status_code, 200)
+        self.assertIsInstance(second, CachedResponse)
+        self.assertEqual(second.json(), {'files': {}})
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(server.requests[1], {'If-None-Match': '"v1"',
+                                              'User-Agent': 'test'})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_metadata_cache_uses_last_modified(self):
+        date = 'Sat, 17 Oct 2026 10:00:00 GMT'
+        server = ValidatingServerMock(b'hash', last_modified=date)
+        self.cache.get(server, 'http://host/launcher.hash')
+        self.assertEqual(
+            self.cache.get(server, 'http://host/launcher.hash').text, 'hash')
+        self.assertEqual(server.requests[1], {'If-Modified-Since': date})
+
+    def test_metadata_cache_refreshes_changed_resources(self):
+        server = ValidatingServerMock(b'old', etag='"v1"')
+        self.cache.get(server, 'http://host/feed.rss')
+        server.content, server.etag = b'new', '"v2"'
+        self.assertEqual(
+            self.cache.get(server, 'http://host/feed.rss').content, b'new')
+        self.assertEqual(
+            self.cache.get(server, 'http://host/feed.rss').content, b'new')
+        self.assertEqual(server.requests[2], {'If-None-Match': '"v2"'})
+
+    def test_metadata_cache_skips_responses_without_validators(self):
+        server = ValidatingServerMock(b'data')
+        self.cache.get(server, 'http://host/config.json')
+        self.cache.get(server, 'http://host/config.json')
+        self.assertEqual(server.requests, [{}, {}])
+        self.assertFalse(os.path.exists(self.cache.directory))
+
+    def test_metadata_cache_stores_streamed_bodies_once_read(self):
+        server = ValidatingServerMock(b'0123456789', etag='"v1"')
+        url = 'http://host/index.json'
+        response = self.cache.get(server, url, stream=True)
+        blocks = response.iter_content(4)
+        next(blocks)
+        # a body that was only partly read is not cached
+        self.assertIsNone(self.cache._load(url))
+        self.assertEqual(b''.join(blocks), b'456789')
+
+        cached = self.cache.get(server, url, stream=True)
+        self.assertIsInstance(cached, CachedResponse)
+        self.assertEqual(list(cached.iter_content(4)),
+                         [b'0123', b'4567', b'89'])
+
+
+class InstallJournalTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.journal = InstallJournal(os.path.join(self.temp_dir, 'j.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_install_journal_is_clean_for_the_recorded_index(self):
+        self.assertFalse(self.journal.is_clean('hash'))
+        self.journal.mark_clean('hash')
+        self.assertTrue(self.journal.is_clean('hash'))
+        self.assertFalse(self.journal.is_clean('other hash'))
+        self.journal.mark_dirty()
+        self.assertFalse(self.journal.is_clean('hash'))
+
+    def test_install_journal_records_the_applied_index(self):
+        self.journal.mark_clean('hash', last_updated=5, shard_root=None)
+        self.assertEqual(self.journal.applied('last_updated'), 5)
+        self.assertIsNone(self.journal.applied('shard_root'))
+        self.journal.mark_dirty()
+        self.assertIsNone(self.journal.applied('last_updated'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+from unittest import TestCase, main
+from chunks import chunk_file, chunk_hash, iter_chunks, ChunkStore,\
+     ChunkedDownload
+from download import DownloadTracker, PART_SUFFIX
+
+SIZES = dict(min_size=256, avg_size=1024, max_size=4096)
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'big')
+
+
+def split(data):
+    return [[chunk_hash(data[offset:offset + size]), size]
+            for offset, size in iter_chunks(data, **SIZES)]
+
+
+class ChunkerTest(TestCase):
+
+    def test_chunks_cover_the_data_within_bounds(self):
+        data = random_bytes(200000, 1)
+        chunks = list(iter_chunks(data, **SIZES))
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(sum(size for _, size in chunks), len(data))
+        for offset, size in chunks[:-1]:
+            self.assertGreater(size, SIZES['min_size'])
+            self.assertLessEqual(size, SIZES['max_size'])
+        average = len(data) / len(chunks)
+        self.assertTrue(512 < average < 2048, average)
+
+    def test_chunks_survive_insertions(self):
+        data = random_bytes(200000, 2)
+        edited = data[:50000] + b'new level data' + data[50000:]
+        before = set(chunk for chunk, _ in split(data))
+        after = [chunk for chunk, _ in split(edited)]
+        changed = [chunk for chunk in after if chunk not in before]
+        self.assertLessEqual(len(changed), 3)
+
+    def test_chunk_file(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'file')
+        data = random_bytes(10000, 3)
+        with open(path, 'wb') as chunked_file:
+            chunked_file.write(data)
+        self.assertEqual(chunk_file(path, **SIZES), split(data))
+        open(path, 'wb').close()
+        self.assertEqual(chunk_file(path), [])
+
+
+class ResponseMock(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        if self.content is None:
+            raise ValueError('404')
+
+
+class ChunkServerMock(object):
+
+    def __init__(self):
+        self.chunks = {}
+        self.requests = []
+
+    def add(self, data):
+        for offset, size in iter_chunks(data, **SIZES):
+            chunk = data[offset:offset + size]
+            self.chunks['/chunks/' + chunk_hash(chunk)] = chunk
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        return ResponseMock(self.chunks.get(url))
+
+
+class ChunkedDownloadTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = ChunkStore(os.path.join(self.temp_dir, 'chunks'))
+        self.install_dir = os.path.join(self.temp_dir, 'install')
+        os.makedirs(self.install_dir)
+        self.server = ChunkServerMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _install(self, files):
+        tracker = DownloadTracker(None)
+        for name, data in files.items():
+            self.server.add(data)
+            tracker.add(ChunkedDownload(
+                os.path.join(self.install_dir, name), '/chunks/{chunkhash}',
+                len(data), hashlib.sha256(data).hexdigest(), split(data),
+                self.store))
+        for download in tracker:
+            download.download_file(self.server)
+        for name, data in files.items():
+            path = os.path.join(self.install_dir, name)
+            with open(path, 'rb') as installed_file:
+                self.assertEqual(installed_file.read(), data)
+            self.assertFalse(os.path.exists(path + PART_SUFFIX))
+        self.assertTrue(all(download.rebuilt for download in tracker))
+        return tracker
+
+    def test_shared_chunks_are_fetched_once(self):
+        data = random_bytes(50000, 4)
+        tracker = self._install({'a.bin': data, 'b.bin': data + b'tail'})
+
+        self.assertEqual(len(self.server.requests),
+                         len(set(self.server.requests)))
+        self.assertEqual(tracker.progress.snapshot()[0],
+                         tracker.progress.snapshot()[1])
+        self.assertLess(tracker.total_size, len(data) + 4096)
+
+    def test_installed_files_provide_chunks_for_the_next_update(self):
+        old = random_bytes(50000, 5)
+        self._install({'a.bin': old})
+        self.store.set_installed('a.bin', hashlib.sha256(old).hexdigest(),
+                                 split(old))
+        self.store.save()
+        self.store.prune()
+        loose = [name for _, _, names in os.walk(self.store.directory)
+                 for name in names if name != 'installed.json']
+        self.assertEqual(loose, [])
+
+        new = old[:20000] + b'patched' + old[20000:]
+        self.store.load()
+        self.store.add_installed(self.install_dir, {
+            'a.bin': hashlib.sha256(old).hexdigest()})
+        self.server.requests = []
+        tracker = self._install({'a.bin': new})
+
+        self.assertLessEqual(len(self.server.requests), 3)
+        self.assertLess(tracker.total_size, 3 * SIZES['max_size'])
+
+    def test_changed_installed_files_are_not_trusted(self):
+        old = random_bytes(20000, 6)
+        self.store.set_installed('a.bin', 'old hash', split(old))
+        self.store.add_installed(self.install_dir, {'a.bin': 'other hash'})
+        self.assertFalse(any(self.store.has(chunk)
+                             for chunk, _ in split(old)))
+
+    def test_corrupt_chunks_are_refetched(self):
+        data = random_bytes(20000, 7)
+        chunks = split(data)
+        self.store.put(chunks[0][0], b'corrupt')
+        self._install({'a.bin': data})
+        self.assertIn('/chunks/' + chunks[0][0], self.server.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import os
 import sys
 from unittest import TestCase, main
 from common import get_app, get_loop, set_app_icon, ICON_SIZES, sanitize_url,\
-     inject_variables, GLOBAL_CONTEXT
+     inject_variables, compile_template, GLOBAL_CONTEXT
 from PyQt5.QtWidgets import QApplication
 from quamash import QEventLoop
 from util import tupperware, get_platform
@@ -87,6 +87,23 @@ class CommonTest(TestCase):
     def test_inject_variables_using_global_context(self):
         self._inject_variables_using_custom_context()
 
+    def test_inject_variables_keeps_unknown_placeholders(self):
+        self.assertEqual(
+            inject_variables('{base}/{a}/{b}/{a}_{c}{}',
+                             dict(base='x', a=1, b=None)),
+            'x/1/{b}/1_{c}{}')
+        self.assertEqual(inject_variables('no placeholders', {}),
+                         'no placeholders')
+
+    def test_compile_template_parses_each_format_once(self):
+        template = compile_template('{base_url}/{filename}_{filehash}')
+        self.assertIs(compile_template('{base_url}/{filename}_{filehash}'),
+                      template)
+        self.assertEqual(template.names, ['base_url', 'filename', 'filehash'])
+        self.assertEqual(template(tupperware(dict(
+            base_url='https://host', filename='a.bin', filehash='f00'))),
+            'https://host/a.bin_f00')
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,103 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main, skipIf
+from compression import compress_file, encoded_url, get_decoder,\
+     is_supported, zstandard, GZIP, ZSTD, DECODE_BLOCK_SIZE
+
+
+def decode(encoding, payload, size, block_size=1000):
+    decoder = get_decoder(encoding, size)
+    data = b''.join(data for i in range(0, len(payload), block_size)
+                    for data in decoder.decompress(payload[i:i + block_size]))
+    return data + decoder.flush()
+
+
+class CompressionTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.temp_dir, 'asset.bin')
+        self.data = os.urandom(16 * 1024) * 32
+        with open(self.source, 'wb') as source_file:
+            source_file.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _compress(self, encoding):
+        destination = encoded_url(self.source, encoding)
+        compress_file(self.source, destination, encoding)
+        with open(destination, 'rb') as payload_file:
+            return payload_file.read()
+
+    def test_encoded_url(self):
+        self.assertEqual(encoded_url('http://a/b_1', GZIP), 'http://a/b_1.gz')
+        self.assertEqual(encoded_url('http://a/b_1', ZSTD),
+                         'http://a/b_1.zst')
+
+    def test_gzip_round_trip(self):
+        payload = self._compress(GZIP)
+        self.assertLess(len(payload), len(self.data))
+        self.assertEqual(gzip.decompress(payload), self.data)
+        self.assertEqual(decode(GZIP, payload, len(self.data)), self.data)
+
+    def test_gzip_decodes_in_bounded_pieces(self):
+        payload = gzip.compress(bytes(3 * DECODE_BLOCK_SIZE + 1))
+        decoder = get_decoder(GZIP, 3 * DECODE_BLOCK_SIZE + 1)
+        pieces = list(decoder.decompress(payload))
+        self.assertLessEqual(max(len(piece) for piece in pieces),
+                             DECODE_BLOCK_SIZE)
+        self.assertEqual(b''.join(pieces) + decoder.flush(),
+                         bytes(3 * DECODE_BLOCK_SIZE + 1))
+
+    def test_gzip_is_reproducible(self):
+        self.assertEqual(self._compress(GZIP), self._compress(GZIP))
+
+    def test_gzip_rejects_truncated_stream(self):
+        payload = self._compress(GZIP)
+        with self.assertRaises(ValueError):
+            decode(GZIP, payload[:-10], len(self.data))
+
+    def test_gzip_rejects_stream_larger_than_the_file(self):
+        payload = gzip.compress(bytes(3 * DECODE_BLOCK_SIZE))
+        decoder = get_decoder(GZIP, DECODE_BLOCK_SIZE + 1)
+        pieces = decoder.decompress(payload)
+        self.assertEqual(len(next(pieces)), DECODE_BLOCK_SIZE)
+        # fails before the rest of the payload is decoded
+        with self.assertRaises(ValueError):
+            next(pieces)
+        self.assertEqual(decoder.decoded, 2 * DECODE_BLOCK_SIZE)
+        with self.assertRaises(ValueError):
+            decode(GZIP, gzip.compress(self.data), len(self.data) - 1)
+        with self.assertRaises(ValueError):
+            decode(GZIP, gzip.compress(self.data), len(self.data) + 1)
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_round_trip(self):
+        payload = self._compress(ZSTD)
+        self.assertLess(len(payload), len(self.data))
+        self.assertEqual(decode(ZSTD, payload, len(self.data)), self.data)
+        with self.assertRaises(ValueError):
+            decode(ZSTD, payload[:-10], len(self.data))
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_rejects_stream_larger_than_the_file(self):
+        payload = zstandard.ZstdCompressor().compress(
+            bytes(3 * DECODE_BLOCK_SIZE))
+        decoder = get_decoder(ZSTD, DECODE_BLOCK_SIZE + 1)
+        with self.assertRaises(ValueError):
+            list(decoder.decompress(payload))
+        self.assertLessEqual(decoder.decoded, 2 * DECODE_BLOCK_SIZE)
+
+    def test_unknown_encoding_is_unsupported(self):
+        self.assertFalse(is_supported(None))
+        self.assertFalse(is_supported('brotli'))
+        self.assertTrue(is_supported(GZIP))
+        with self.assertRaises(ValueError):
+            get_decoder('brotli', 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main, mock
+from delta import apply_delta, delta_url, make_delta, DeltaError
+
+
+class DeltaTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.temp_dir, 'source')
+        self.target_path = os.path.join(self.temp_dir, 'target')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _round_trip(self, source, target, block_size=1024):
+        with open(self.source_path, 'wb') as source_file:
+            source_file.write(source)
+        with open(self.target_path, 'wb') as target_file:
+            target_file.write(target)
+        delta_file = io.BytesIO()
+        make_delta(self.source_path, self.target_path, delta_file,
+                   block_size)
+        delta_file.seek(0)
+        output = io.BytesIO()
+        apply_delta(self.source_path, delta_file, output)
+        self.assertEqual(output.getvalue(), target)
+        return delta_file.getvalue()
+
+    def test_delta_url(self):
+        self.assertEqual(delta_url('http://a/b_1', 'abc'),
+                         'http://a/b_1.abc.delta')
+
+    def test_delta_of_identical_files_is_one_copy(self):
+        data = os.urandom(64 * 1024)
+        self.assertLess(len(self._round_trip(data, data)), 50)
+
+    def test_delta_finds_shifted_runs(self):
+        source = os.urandom(256 * 1024)
+        target = source[:1000] + b'inserted' + source[1000:100000] + \
+            source[120000:] + b'appended'
+        delta = self._round_trip(source, target)
+        self.assertLess(len(delta), 5000)
+
+    def test_delta_between_unrelated_files(self):
+        self._round_trip(os.urandom(10000), os.urandom(12345))
+
+    def test_delta_from_and_to_empty_files(self):
+        self._round_trip(b'', os.urandom(5000))
+        self._round_trip(os.urandom(5000), b'')
+
+    def test_delta_splits_long_inserts(self):
+        with mock.patch('delta.MAX_INSERT', 1000):
+            self._round_trip(b'', os.urandom(5500))
+
+    def test_apply_rejects_other_source(self):
+        delta = self._round_trip(os.urandom(5000), os.urandom(5000))
+        with open(self.source_path, 'wb') as source_file:
+            source_file.write(b'shorter')
+        with self.assertRaises(DeltaError):
+            apply_delta(self.source_path, io.BytesIO(delta), io.BytesIO())
+
+    def test_apply_rejects_truncated_delta(self):
+        source = os.urandom(5000)
+        delta = self._round_trip(source, source[:3000] + b'changed')
+        with self.assertRaises(DeltaError):
+            apply_delta(self.source_path, io.BytesIO(delta[:-5]),
+                        io.BytesIO())
+        with self.assertRaises(DeltaError):
+            apply_delta(self.source_path, io.BytesIO(b'garbage' * 10),
+                        io.BytesIO())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+from unittest import TestCase, main
+from diff_plan import DiffPlan, FileMatcher, is_indexed_file
+from util import FileEntry
+
+
+def entry(size, relative_path=None):
+    return FileEntry(None, relative_path,
+                     os.stat_result((0,) * 6 + (size, 0, 0, 0)))
+
+
+remote_files = {
+    'same.bin': {'sha256': 'aa', 'size': 10},
+    'changed.bin': {'sha256': 'bb', 'size': 20},
+    'resized.bin': {'sha256': 'cc', 'size': 30},
+    'missing.bin': {'sha256': 'dd', 'size': 40},
+}
+
+
+class DiffPlanTest(TestCase):
+
+    def setUp(self):
+        local_files = {'same.bin': entry(10), 'changed.bin': entry(20),
+                       'resized.bin': entry(3), 'extra.txt': entry(5),
+                       'missing.bin.part': entry(1),
+                       'other.bin.part': entry(2)}
+        local_hashes = {'same.bin': 'aa', 'changed.bin': 'old'}
+        self.plan = DiffPlan.compute(remote_files, local_files, local_hashes)
+
+    def test_diff_plan_sorts_files(self):
+        self.assertEqual(self.plan.missing, ['missing.bin'])
+        self.assertEqual(self.plan.changed, ['changed.bin', 'resized.bin'])
+        self.assertEqual(self.plan.extra, ['extra.txt', 'other.bin.part'])
+        self.assertEqual(self.plan.unchanged, ['same.bin'])
+        self.assertTrue(self.plan.needs_update)
+
+    def test_diff_plan_totals_sizes(self):
+        self.assertEqual(self.plan.total_size(self.plan.downloads), 90)
+        self.assertEqual(self.plan.total_size(self.plan.extra), 7)
+        self.assertEqual(self.plan.summary(),
+                         '1 missing (40 B), 2 changed (50 B), '
+                         '2 extra (7 B), 1 unchanged (10 B)')
+
+    def test_diff_plan_reports_every_file_to_touch(self):
+        self.assertEqual(self.plan.report().splitlines()[1:], [
+            '+ missing.bin (40 B)',
+            '~ changed.bin (20 B)',
+            '~ resized.bin (30 B)',
+            '- extra.txt (5 B)',
+            '- other.bin.part (2 B)',
+            'Download size: 90 B'])
+
+    def test_diff_plan_of_an_up_to_date_install(self):
+        plan = DiffPlan.compute({'a': {'sha256': 'aa', 'size': 1}},
+                                {'a': entry(1)}, {'a': 'aa'})
+        self.assertFalse(plan.needs_update)
+        self.assertEqual(plan.downloads, [])
+
+    def test_is_indexed_file_keeps_partial_downloads(self):
+        self.assertTrue(is_indexed_file('missing.bin.part', remote_files))
+        self.assertTrue(is_indexed_file('same.bin.delta.part',
+                                        remote_files))
+        self.assertTrue(is_indexed_file('same.bin.part.json', remote_files))
+        self.assertTrue(is_indexed_file('same.bin', remote_files))
+        self.assertFalse(is_indexed_file('other.bin.part.json',
+                                         remote_files))
+        self.assertFalse(is_indexed_file('other.bin.part', remote_files))
+        self.assertFalse(is_indexed_file('other.bin', remote_files))
+
+
+def should_not_be_run(*args):
+    raise AssertionError('nothing should have been matched')
+
+
+class FileMatcherTest(TestCase):
+
+    def setUp(self):
+        self.matched = []
+        self.missing = []
+        self.matcher = FileMatcher(
+            lambda *args: self.matched.append(args),
+            lambda *args: self.missing.append(args))
+
+    def test_file_matcher_matches_whichever_side_comes_last(self):
+        matcher = self.matcher
+        matcher.add_local(entry(1, 'early.bin'))
+        matcher.add_remote('early.bin', 'early data', True)
+        matcher.add_remote('late.bin', 'late data', False)
+        self.assertEqual(self.matched, [('early.bin', 'early data', True)])
+        matcher.add_local(entry(1, 'late.bin'))
+        self.assertEqual(self.matched[1:], [('late.bin', 'late data', False)])
+        matcher.finish_scan()
+        self.assertEqual(self.missing, [])
+
+    def test_file_matcher_reports_missing_files_of_listed_directories(self):
+        matcher = self.matcher
+        matcher.add_remote('sub/a.bin', 'a')
+        matcher.add_remote('sub/deeper/b.bin', 'b')
+        matcher.add_remote('gone/c.bin', 'c')
+        matcher.add_remote('root.bin', 'root')
+        self.assertEqual(self.missing, [])
+
+        matcher.directory_listed('', ['sub/'])
+        self.assertEqual(self.missing, [('gone/c.bin', 'c'),
+                                        ('root.bin', 'root')])
+        matcher.add_remote('other/d.bin', 'd')
+        self.assertEqual(self.missing[2:], [('other/d.bin', 'd')])
+
+        matcher.directory_listed('sub/', [])
+        self.assertEqual(sorted(self.missing[3:]),
+                         [('sub/a.bin', 'a'), ('sub/deeper/b.bin', 'b')])
+        self.assertEqual(self.matched, [])
+
+    def test_file_matcher_reports_the_rest_once_the_scan_finishes(self):
+        matcher = self.matcher
+        matcher.add_remote('sub/a.bin', 'a')
+        matcher.finish_scan()
+        self.assertTrue(matcher.scan_finished.is_set())
+        matcher.add_remote('b.bin', 'b')
+        self.assertEqual(self.missing, [('sub/a.bin', 'a'), ('b.bin', 'b')])
+
+    def test_file_matcher_replays_missing_files_to_new_watchers(self):
+        matcher = FileMatcher(should_not_be_run)
+        matcher.add_remote('a.bin', 'a', True)
+        matcher.finish_scan()
+        matcher.watch_missing(lambda *args: self.missing.append(args))
+        matcher.add_remote('b.bin', 'b', False)
+        self.assertEqual(self.missing, [('a.bin', 'a', True),
+                                        ('b.bin', 'b', False)])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,21 @@
 import asyncio
+import gzip
+import hashlib
+import io
+import os
 import requests
+import shutil
+import tempfile
+import threading
 import time
-from async_unittest import AsyncTestCase, async_patch, TestCase, mock, main
+from async_unittest import AsyncTestCase, async_patch, TestCase, mock,\
+     main, WakeupCountingLoop
 from concurrent import futures
-from download import download_file, Download, DownloadTracker
+from delta import make_delta
+from download import download_file, Download, DownloadTracker, PART_SUFFIX,\
+     PROGRESS_SUFFIX, download_segmented, SEGMENTED_MIN_SIZE
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 
 class ResponseMock(object):
@@ -11,10 +23,15 @@ class ResponseMock(object):
     _json = None
     _text = None
     status_code = requests.codes['ok']
+    headers = {}
 
     def __init__(self, data):
         self.data = data
 
+    @property
+    def content(self):
+        return self.data
+
     def iter_content(self, chunk_size):
         assert chunk_size > 0
         for i in range(0, len(self.data), chunk_size):
@@ -56,16 +73,6 @@ class SessionMock(object):
         pass
 
 
-class FutureMock(object):
-    mock_done = False
-    done_call_target_count = 3
-    done_call_count = 0
-
-    def done(self):
-        self.done_call_count += 1
-        return self.done_call_count >= self.done_call_target_count
-
-
 class ProgressBarMock(object):
     minimum = 0
     maximum = 0
@@ -81,6 +88,84 @@ class ProgressBarMock(object):
         self.value = val
 
 
+def assert_downloaded(test, path, data):
+    with open(path, 'rb') as downloaded_file:
+        test.assertEqual(downloaded_file.read(), data)
+    test.assertFalse(os.path.exists(path + PART_SUFFIX))
+    test.assertFalse(os.path.exists(path + PROGRESS_SUFFIX))
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """ Serves server.files, honouring single 'bytes=start-[end]' ranges.
+    server.drop_after cuts responses off after that many body bytes,
+    server.ignore_ranges makes it answer every request in full and
+    server.headers are sent with every response.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+        server.accept_encoding = self.headers.get('Accept-Encoding')
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+        if range_header and not server.ignore_ranges:
+            first, last = range_header.split('=')[1].split('-')
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' %
+                             (start, end, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in server.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if server.drop_after is not None:
+            body = body[:server.drop_after]
+            server.drop_after = None
+            self.wfile.write(body)
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RangeRequestHandler)
+        self.files = {}
+        self.requests = []
+        self.drop_after = None
+        self.ignore_ranges = False
+        self.headers = {}
+        self.accept_encoding = None
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server_address[1], path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
 class DownloadFileTest(TestCase):
     session_mock = None
     downloaded_bytes = 0
@@ -89,11 +174,13 @@ class DownloadFileTest(TestCase):
         self.session_mock = SessionMock()
         requests.real_get = requests.get
         requests.get = self.session_mock.get
+        self.temp_dir = tempfile.mkdtemp()
 
     def tearDown(self):
         requests.get = requests.real_get
         del requests.real_get
         del self.session_mock
+        shutil.rmtree(self.temp_dir)
         if hasattr(self, "downloaded_bytes"):
             self.downloaded_bytes = 0
 
@@ -103,15 +190,15 @@ class DownloadFileTest(TestCase):
     def _call_download(self, test_path, test_url,
                        test_data=b'', test_hash=None, session=None):
         self.session_mock.data = test_data
-        with mock.patch('download.open', mock.mock_open()) as m:
-            download_file(
-                test_url, test_path, self._download_inc, session, test_hash)
+        test_path = os.path.join(self.temp_dir, test_path)
+        download_file(
+            test_url, test_path, self._download_inc, session, test_hash)
 
         responses = self.session_mock.responses
         self.assertIn(test_url, responses)
         self.assertEqual(1, len(responses[test_url]))
         self.assertEqual(len(test_data), self.downloaded_bytes)
-        m.assert_called_once_with(test_path, 'wb+')
+        assert_downloaded(self, test_path, test_data)
 
     def test_download_file_4kb_of_0xff(self):
         test_path = "4kb_0xff_0.bin"
@@ -146,6 +233,257 @@ class DownloadFileTest(TestCase):
         self._call_download(test_path, test_url, test_data)
 
 
+class LocalServerTestCase(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'asset.bin')
+        self.data = os.urandom(5 * 1024**2 + 123)
+        self.filehash = hashlib.sha256(self.data).hexdigest()
+        self.server = RangeServer()
+        self.server.files['/asset.bin'] = self.data
+        self.server.__enter__()
+        self.url = self.server.url('/asset.bin')
+        patcher = mock.patch('download.CHECKPOINT_SIZE', 1024**2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.__exit__()
+        shutil.rmtree(self.temp_dir)
+
+    def _interrupted_download(self, drop_after):
+        self.server.drop_after = drop_after
+        with self.assertRaises(requests.exceptions.RequestException):
+            download_file(self.url, self.path, filehash=self.filehash)
+        self.assertTrue(os.path.exists(self.path + PART_SUFFIX))
+        self.assertTrue(os.path.exists(self.path + PROGRESS_SUFFIX))
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ResumableDownloadTest(LocalServerTestCase):
+
+    def test_download_file_from_server(self):
+        download_file(self.url, self.path, filehash=self.filehash)
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests, [('/asset.bin', None)])
+
+    def test_download_file_resumes_from_last_checkpoint(self):
+        self._interrupted_download(3 * 1024**2 + 100)
+        received = []
+        download_file(self.url, self.path,
+                      block_fun=lambda block: received.append(len(block)),
+                      filehash=self.filehash)
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests[-1],
+                         ('/asset.bin', 'bytes=%s-' % (3 * 1024**2)))
+        # the saved prefix is reported again as it is rehashed
+        self.assertEqual(sum(received), len(self.data))
+
+    def test_download_file_restarts_when_ranges_are_ignored(self):
+        self._interrupted_download(2 * 1024**2 + 100)
+        self.server.ignore_ranges = True
+        download_file(self.url, self.path, filehash=self.filehash)
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests[-1], ('/asset.bin', None))
+
+    def test_download_file_restarts_for_a_different_file(self):
+        self._interrupted_download(2 * 1024**2 + 100)
+        other = os.urandom(1024)
+        self.server.files['/other.bin'] = other
+        download_file(self.server.url('/other.bin'), self.path)
+
+        assert_downloaded(self, self.path, other)
+        self.assertEqual(self.server.requests[-1], ('/other.bin', None))
+
+    def test_download_file_without_progress_record_restarts(self):
+        self._interrupted_download(2 * 1024**2 + 100)
+        os.remove(self.path + PROGRESS_SUFFIX)
+        download_file(self.url, self.path, filehash=self.filehash)
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests[-1], ('/asset.bin', None))
+
+
+class SegmentedDownloadTest(LocalServerTestCase):
+
+    def _download(self, **kwargs):
+        kwargs.setdefault('filehash', self.filehash)
+        return download_segmented(self.url, self.path, len(self.data),
+                                  segment_size=256 * 1024, connections=4,
+                                  **kwargs)
+
+    def test_download_segmented_from_server(self):
+        received = []
+        self._download(block_fun=lambda block: received.append(len(block)))
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(sum(received), len(self.data))
+        ranges = sorted(range_header for _, range_header
+                        in self.server.requests)
+        self.assertEqual(len(ranges), 21)
+        self.assertIn('bytes=0-262143', ranges)
+        self.assertIn('bytes=5242880-%s' % (len(self.data) - 1), ranges)
+
+    def test_download_segmented_resumes_missing_segments(self):
+        self.server.drop_after = 1000
+        with self.assertRaises(requests.exceptions.RequestException):
+            self._download()
+        self.assertTrue(os.path.exists(self.path + PROGRESS_SUFFIX))
+        first_attempt = len(self.server.requests)
+
+        received = []
+        self._download(block_fun=lambda block: received.append(len(block)))
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(len(self.server.requests) - first_attempt, 1)
+        self.assertEqual(sum(received), len(self.data))
+
+    def test_download_segmented_falls_back_without_ranges(self):
+        self.server.ignore_ranges = True
+        self._download()
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests[-1], ('/asset.bin', None))
+
+    def test_download_segmented_reports_bad_hash(self):
+        with mock.patch('logging.error') as m:
+            self._download(filehash='bad hash')
+        self.assertEqual(m.call_count, 1)
+        assert_downloaded(self, self.path, self.data)
+
+    def test_download_is_only_segmented_when_large(self):
+        download = Download('path', 'url', SEGMENTED_MIN_SIZE)
+        self.assertTrue(download.is_segmented)
+        download.connections = 1
+        self.assertFalse(download.is_segmented)
+        self.assertFalse(
+            Download('path', 'url', SEGMENTED_MIN_SIZE - 1).is_segmented)
+
+
+class EncodedDownloadTest(LocalServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.payload = gzip.compress(self.data[:1024**2] * 5)
+        self.data = self.data[:1024**2] * 5
+        self.filehash = hashlib.sha256(self.data).hexdigest()
+        self.server.files['/asset.bin.gz'] = self.payload
+
+    def test_download_encoded_file(self):
+        download = Download(self.path, self.url, len(self.data),
+                            self.filehash, encoding='gzip',
+                            compressed_size=len(self.payload))
+        received = []
+        download.progress = mock.Mock(add=received.append)
+        with mock.patch('logging.error') as m:
+            download.download_file()
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual(self.server.requests, [('/asset.bin.gz', None)])
+        self.assertEqual(download.total_size, len(self.payload))
+        self.assertEqual(sum(received), len(self.payload))
+
+    def test_download_encoded_file_served_with_content_encoding(self):
+        self.server.headers['Content-Encoding'] = 'gzip'
+        download = Download(self.path, self.url, len(self.data),
+                            self.filehash, encoding='gzip',
+                            compressed_size=len(self.payload))
+        received = []
+        download.progress = mock.Mock(add=received.append)
+        with mock.patch('logging.error') as m:
+            download.download_file()
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual(self.server.accept_encoding, 'identity')
+        self.assertEqual(sum(received), len(self.payload))
+
+    def test_download_encoded_file_is_not_segmented(self):
+        download = Download(self.path, self.url, SEGMENTED_MIN_SIZE,
+                            encoding='gzip',
+                            compressed_size=SEGMENTED_MIN_SIZE)
+        self.assertFalse(download.is_segmented)
+
+    def test_download_encoded_file_rejects_truncated_payload(self):
+        self.server.files['/asset.bin.gz'] = self.payload[:-100]
+        download = Download(self.path, self.url, len(self.data),
+                            self.filehash, encoding='gzip',
+                            compressed_size=len(self.payload))
+        with self.assertRaises(ValueError):
+            download.download_file()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_download_encoded_file_rejects_payload_larger_than_the_file(self):
+        download = Download(self.path, self.url, 1024**2, self.filehash,
+                            encoding='gzip',
+                            compressed_size=len(self.payload))
+        with self.assertRaises(ValueError):
+            download.download_file()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertLessEqual(os.path.getsize(self.path + PART_SUFFIX),
+                             1024**2)
+
+
+class DeltaDownloadTest(LocalServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        old_data = self.data[:3 * 1024**2] + os.urandom(1000) + \
+            self.data[3 * 1024**2 + 500:]
+        self.old_hash = hashlib.sha256(old_data).hexdigest()
+        with open(self.path, 'wb') as old_file:
+            old_file.write(old_data)
+        with open(self.path + '.new', 'wb') as new_file:
+            new_file.write(self.data)
+        delta_file = io.BytesIO()
+        make_delta(self.path, self.path + '.new', delta_file)
+        self.patch = delta_file.getvalue()
+        os.remove(self.path + '.new')
+        self.server.files['/asset.bin.%s.delta' % self.old_hash] = self.patch
+
+    def _download(self):
+        tracker = DownloadTracker(None)
+        tracker.add_download(self.path, self.url, len(self.data),
+                             self.filehash, delta_from=self.old_hash,
+                             delta_size=len(self.patch))
+        download = tracker.downloads[0]
+        download.download_file()
+        return tracker, download
+
+    def test_download_applies_delta(self):
+        self.assertLess(len(self.patch), len(self.data) // 20)
+        tracker, download = self._download()
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests, [
+            ('/asset.bin.%s.delta' % self.old_hash, None)])
+        self.assertEqual(tracker.progress.snapshot(),
+                         (len(self.patch), len(self.patch)))
+        self.assertFalse(os.path.exists(self.path + '.delta'))
+
+    def test_download_falls_back_when_delta_is_missing(self):
+        self.server.files.clear()
+        self.server.files['/asset.bin'] = self.data
+        tracker, download = self._download()
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(self.server.requests[-1], ('/asset.bin', None))
+        self.assertEqual(tracker.progress.snapshot(),
+                         (len(self.data), len(self.data)))
+
+    def test_download_falls_back_when_patched_hash_mismatches(self):
+        self.filehash = 'bad hash'
+        with mock.patch('logging.error'):
+            self._download()
+
+        assert_downloaded(self, self.path, self.data)
+        self.assertEqual(len(self.server.requests), 2)
+
+
 class DownloadTest(TestCase):
     session_mock = None
 
@@ -155,17 +493,17 @@ class DownloadTest(TestCase):
 
     def _call_download(self, test_path, test_url,
                        test_data=b'', test_hash=None, session=None):
+        test_path = os.path.join(self.temp_dir, test_path)
         downloader = Download(test_path, test_url, len(test_data))
         self.session_mock.data = test_data
 
-        with mock.patch('download.open', mock.mock_open()) as m:
-            downloader.download_file(session)
+        downloader.download_file(session)
 
         responses = self.session_mock.responses
         self.assertIn(test_url, responses)
         self.assertEqual(1, len(responses[test_url]))
         self.assertEqual(len(test_data), downloader.downloaded_bytes)
-        m.assert_called_once_with(test_path, 'wb+')
+        assert_downloaded(self, test_path, test_data)
 
     test_download_4kb_of_0xff = DownloadFileTest.\
         test_download_file_4kb_of_0xff
@@ -224,11 +562,11 @@ class DownloadTrackerTest(AsyncTestCase):
         self.assertEqual(len(download_futures), 0)
 
     def test_download_tracker_updates_properly(self):
-        test_download_1 = Download('', '', 2048)
-        test_download_2 = Download('', '', 4096)
+        self.download_tracker.add_download('', '', 2048)
+        self.download_tracker.add_download('', '', 4096)
+        test_download_1, test_download_2 = self.download_tracker.downloads
         test_download_1.downloaded_bytes = 1337
         test_download_2.downloaded_bytes = 1412
-        self.download_tracker.downloads = (test_download_1, test_download_2)
         self.download_tracker.update()
 
         self.assertEqual(self.progress_bar.maximum, 2048+4096)
@@ -238,6 +576,45 @@ class DownloadTrackerTest(AsyncTestCase):
         self.download_tracker.progress_bar = None
         self.download_tracker.update()
 
+    def test_download_tracker_keeps_running_totals(self):
+        tracker = self.download_tracker
+        tracker.add_download('a', '', 100)
+        tracker.add_download('b', '', 50)
+        download = tracker.downloads[0]
+        download._inc_download(b'x' * 30)
+        download._inc_download(b'x' * 10)
+        self.assertEqual((tracker.downloaded_bytes, tracker.total_size),
+                         (40, 150))
+        # restarting a download takes back what it had counted
+        download.downloaded_bytes = 0
+        self.assertEqual(tracker.downloaded_bytes, 0)
+        tracker.clear()
+        self.assertEqual((tracker.downloaded_bytes, tracker.total_size),
+                         (0, 0))
+
+    def test_download_tracker_coalesces_progress_events(self):
+        tracker = self.download_tracker
+        events = []
+        tracker.add_listener(events.append)
+        tracker.add_download('a', '', 100)
+        tracker.update()
+        tracker.update()
+        tracker.downloads[0]._inc_download(b'x' * 25)
+        tracker.update()
+        tracker.update()
+        self.assertEqual([(event.downloaded, event.total)
+                          for event in events], [(0, 100), (25, 100)])
+
+    def test_download_tracker_scales_large_totals_for_qt(self):
+        tracker = self.download_tracker
+        tracker.add_download('a', '', 3 * 1024**3)
+        tracker.add_download('b', '', 3 * 1024**3)
+        tracker.downloads[0].downloaded_bytes = 3 * 1024**3
+        tracker.update()
+        self.assertLessEqual(self.progress_bar.maximum, 2**31 - 1)
+        self.assertEqual(self.progress_bar.value * 2,
+                         self.progress_bar.maximum)
+
     def test_download_tracker_can_execute_requests(self):
         tracker = self.download_tracker
         test_download_1 = Download('', '', 2048)
@@ -255,41 +632,105 @@ class DownloadTrackerTest(AsyncTestCase):
 
         self.assertEqual(m.call_count, 3)
 
-    def test_download_tracker_can_run(self):
+    def test_download_tracker_waits_for_started_downloads(self):
         tracker = self.download_tracker
-        future_mock = FutureMock()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def download_file(download, session=None):
+            calls.append(download.file_path)
+            if download.file_path == 'early':
+                started.set()
+                release.wait()
+
+        with mock.patch('download.Download.download_file', download_file):
+            tracker.start(Download('early', '', 2048), session=None)
+            self.assertTrue(started.wait(5))
+            tracker.add_download('late', '', 4096)
+            self.assertEqual(tracker.total_size, 2048 + 4096)
+            requests_done = tracker._execute_requests(self.loop)
+            self.loop.call_later(0.05, release.set)
+            self.loop.run_until_complete(requests_done)
+
+        # the started download was waited for, not downloaded again
+        self.assertTrue(release.is_set())
+        self.assertEqual(sorted(calls), ['early', 'late'])
 
-        async def run(*args, **kwargs):
-            tracker.run(*args, **kwargs)
+    def test_download_tracker_can_run(self):
+        tracker = self.download_tracker
+        future = self.loop.create_future()
 
         with mock.patch('asyncio.get_event_loop',
                         return_value=self.loop) as m1,\
                 mock.patch('download.DownloadTracker._execute_requests',
-                           return_value=future_mock) as m2:
+                           return_value=future) as m2:
             tracker.progress_bar = None
             mock_session = object()
 
-            self.run_async(run, mock_session)
+            worker = self.loop.run_in_executor(self.executor, tracker.run,
+                                               mock_session)
+            self.loop.call_later(0.05, future.set_result, None)
+            self.loop.run_until_complete(worker)
             m2.assert_called_with(self.loop, session=mock_session)
 
-        self.assertEqual(future_mock.done_call_count, 3)
+        self.assertTrue(future.done())
 
     def test_download_tracker_can_run_async(self):
         tracker = self.download_tracker
-        future_mock = FutureMock()
+        future = self.loop.create_future()
 
         with mock.patch('asyncio.get_event_loop',
                         return_value=self.loop) as m1,\
                 mock.patch('download.DownloadTracker._execute_requests',
-                           return_value=future_mock) as m2,\
-                async_patch('asyncio.sleep') as m3:
+                           return_value=future) as m2:
             tracker.progress_bar = None
             mock_session = object()
 
+            self.loop.call_later(0.05, future.set_result, None)
             self.run_async(tracker.run_async, mock_session)
             m2.assert_called_with(self.loop, session=mock_session)
 
-        self.assertEqual(future_mock.done_call_count, 3)
+        self.assertTrue(future.done())
+
+    def test_download_tracker_does_not_poll_while_waiting(self):
+        loop = WakeupCountingLoop()
+        self.addCleanup(loop.close)
+        tracker = self.download_tracker
+        future = loop.create_future()
+
+        with mock.patch('asyncio.get_event_loop', return_value=loop) as m1,\
+                mock.patch('download.DownloadTracker._execute_requests',
+                           return_value=future) as m2:
+            loop.call_later(0.5, future.set_result, None)
+            loop.run_until_complete(tracker.run_async())
+
+        # a handful of wakeups to start and finish, where polling every
+        # 100ms would have added at least two for each of its 5 sleeps
+        self.assertLessEqual(loop.wakeups, 6)
+
+    def test_download_tracker_updates_when_progress_is_made(self):
+        loop = WakeupCountingLoop()
+        self.addCleanup(loop.close)
+        tracker = self.download_tracker
+        tracker.add_download('a', '', 100)
+        events = []
+        tracker.add_listener(events.append)
+        future = loop.create_future()
+
+        def progress():
+            # several blocks in a row are drawn as one update
+            for _ in range(4):
+                tracker.downloads[0]._inc_download(b'x' * 10)
+
+        with mock.patch('asyncio.get_event_loop', return_value=loop) as m1,\
+                mock.patch('download.DownloadTracker._execute_requests',
+                           return_value=future) as m2:
+            loop.call_soon(loop.run_in_executor, self.executor, progress)
+            loop.call_later(0.5, future.set_result, None)
+            loop.run_until_complete(tracker.run_async())
+
+        self.assertEqual([event.downloaded for event in events], [40])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from hashing import HashingEngine, make_batches, BATCH_FILE_COUNT
+
+
+class HashingEngineTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.jobs = []
+        self.expected = {}
+        for i in range(100):
+            data = bytes([i % 256]) * (i * 1024)
+            relative = 'file_%s.bin' % i
+            full = os.path.join(self.temp_dir, relative)
+            with open(full, 'wb') as test_file:
+                test_file.write(data)
+            self.jobs.append((full, relative, len(data)))
+            self.expected[relative] = hashlib.sha256(data).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_make_batches_orders_largest_first(self):
+        batches = list(make_batches(self.jobs))
+        sizes = {relative: size for _, relative, size in self.jobs}
+        ordered = [sizes[relative] for batch in batches
+                   for _, relative in batch]
+        self.assertEqual(ordered, sorted(ordered, reverse=True))
+        self.assertEqual(len(ordered), len(self.jobs))
+        for batch in batches:
+            self.assertLessEqual(len(batch), BATCH_FILE_COUNT)
+
+    def test_make_batches_isolates_large_files(self):
+        jobs = [('big', 'big', 1024**3), ('small', 'small', 1)]
+        self.assertEqual(list(make_batches(jobs)),
+                         [[('big', 'big')], [('small', 'small')]])
+
+    def test_hashing_engine_with_threads(self):
+        engine = HashingEngine(workers=4)
+        self.assertEqual(dict(engine.hash_files(self.jobs)), self.expected)
+
+    def test_hashing_engine_with_processes(self):
+        engine = HashingEngine(workers=2, use_processes=True)
+        self.assertEqual(dict(engine.hash_files(self.jobs)), self.expected)
+
+    def test_hashing_engine_with_single_worker(self):
+        engine = HashingEngine(workers=1)
+        self.assertEqual(dict(engine.hash_files(self.jobs)), self.expected)
+
+    def test_hashing_engine_reports_unreadable_files(self):
+        engine = HashingEngine(workers=2)
+        missing = os.path.join(self.temp_dir, 'missing.bin')
+        results = dict(engine.hash_files([(missing, 'missing.bin', 0)]))
+        self.assertEqual(results, {'missing.bin': None})
+
+    def test_hashing_engine_with_no_jobs(self):
+        self.assertEqual(list(HashingEngine().hash_files([])), [])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import TestCase, main
+from http_client import HTTPClient, ConnectionStats
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server_address[1], path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class HTTPClientTest(TestCase):
+
+    def setUp(self):
+        self.server = KeepAliveServer()
+        self.addCleanup(self.server.close)
+
+    def test_http_client_starts_without_connections(self):
+        with HTTPClient() as client:
+            self.assertEqual(client.stats(), ConnectionStats(0, 0, 0))
+
+    def test_http_client_reuses_connections_sequentially(self):
+        with HTTPClient() as client:
+            for i in range(10):
+                self.assertEqual(
+                    client.get(self.server.url('/%s' % i)).content, b'ok')
+            self.assertEqual(client.stats(), ConnectionStats(10, 1, 9))
+
+    def test_http_client_pool_covers_concurrent_threads(self):
+        with HTTPClient(pool_size=8) as client, ThreadPoolExecutor(8) as pool:
+            for _ in range(5):
+                list(pool.map(lambda i: client.get(self.server.url('/')),
+                              range(8)))
+            stats = client.stats()
+        self.assertEqual(stats.requests, 40)
+        # never more connections than threads, however they interleave
+        self.assertLessEqual(stats.opened, 8)
+        self.assertEqual(stats.reused, 40 - stats.opened)
+
+    def test_http_client_undersized_pool_drops_connections(self):
+        with HTTPClient(pool_size=1) as client, ThreadPoolExecutor(8) as pool:
+            barrier = threading.Barrier(8)
+
+            def get(i):
+                # hold every thread until all of them need a connection
+                barrier.wait()
+                return client.get(self.server.url('/'))
+            for _ in range(3):
+                list(pool.map(get, range(8)))
+            stats = client.stats()
+        self.assertEqual(stats.requests, 24)
+        self.assertGreater(stats.opened, 8)
+
+    def test_http_client_counts_closed_pools(self):
+        client = HTTPClient()
+        client.get(self.server.url('/'))
+        client.get(self.server.url('/'))
+        client.close()
+        self.assertEqual(client.stats(), ConnectionStats(2, 1, 1))
+
+    def test_http_client_pool_size_defaults(self):
+        self.assertEqual(HTTPClient().pool_size, 10)
+        self.assertEqual(HTTPClient(0).pool_size, 10)
+        self.assertEqual(HTTPClient(64).pool_size, 64)
+
+
+if __name__ == "__main__":
+    main()
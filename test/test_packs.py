@@ -0,0 +1,117 @@
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase, main, mock
+from download import Download, DownloadTracker
+from packs import PackDownload
+
+
+def make_pack(files):
+    pack = io.BytesIO()
+    with tarfile.open(fileobj=pack, mode='w') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return pack.getvalue()
+
+
+class ResponseMock(object):
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        if self.data is None:
+            raise ValueError('404')
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), 1000):
+            yield self.data[i:i + 1000]
+
+
+class SessionMock(object):
+
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        return ResponseMock(self.files.get(url))
+
+
+class PackDownloadTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.files = {'a.txt': b'a' * 5000, 'sub/b.cfg': b'b' * 300,
+                      'sub/c.lua': os.urandom(2000)}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _download(self, pack_files, session_files=None, truncate=None):
+        pack = make_pack(pack_files)[:truncate]
+        session = SessionMock(dict(session_files or {}, pack=pack))
+        members = {}
+        for name, data in self.files.items():
+            path = os.path.join(self.temp_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            members[name] = Download(path, name, len(data),
+                                     hashlib.sha256(data).hexdigest())
+        tracker = DownloadTracker(None)
+        tracker.add(PackDownload(os.path.join(self.temp_dir, 'pack'), 'pack',
+                                 len(pack), hashlib.sha256(pack).hexdigest(),
+                                 members))
+        for download in tracker:
+            download.download_file(session)
+        for name, data in self.files.items():
+            with open(os.path.join(self.temp_dir, name), 'rb') as extracted:
+                self.assertEqual(extracted.read(), data)
+        return tracker, session, pack
+
+    def test_pack_download_extracts_members(self):
+        tracker, session, pack = self._download(
+            dict(self.files, **{'other.txt': b'not needed'}))
+
+        self.assertEqual(session.requests, ['pack'])
+        self.assertEqual(tracker.progress.snapshot(), (len(pack), len(pack)))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir,
+                                                     'other.txt')))
+
+    def test_pack_download_fetches_bad_members_on_their_own(self):
+        pack_files = dict(self.files, **{'sub/b.cfg': b'corrupt'})
+        del pack_files['a.txt']
+        with mock.patch('logging.warning') as m:
+            tracker, session, pack = self._download(pack_files, {
+                'a.txt': self.files['a.txt'],
+                'sub/b.cfg': self.files['sub/b.cfg']})
+
+        self.assertEqual(sorted(session.requests),
+                         ['a.txt', 'pack', 'sub/b.cfg'])
+        downloaded, total = tracker.progress.snapshot()
+        self.assertEqual(downloaded, total)
+        self.assertEqual(total, len(pack) + 5300)
+
+    def test_pack_download_falls_back_when_the_pack_is_broken(self):
+        with mock.patch('logging.warning') as m:
+            tracker, session, pack = self._download(self.files, self.files,
+                                                    truncate=700)
+        self.assertEqual(len(session.requests), 4)
+        self.assertEqual(m.call_count, 1)
+
+    def test_pack_download_writes_member_paths(self):
+        download = PackDownload('pack', 'url', 10, None, {
+            'a': Download('dir/a', 'a', 1), 'b': Download('dir/b', 'b', 1)})
+        self.assertEqual(sorted(download.file_paths), ['dir/a', 'dir/b'])
+        self.assertFalse(download.is_plain)
+
+
+if __name__ == "__main__":
+    main()
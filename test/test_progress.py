@@ -0,0 +1,74 @@
+from unittest import TestCase, main
+from progress import ProgressCounter, ThroughputMeter, scale_to_qt,\
+     QT_MAX_VALUE, format_size, format_duration
+
+
+class ProgressCounterTest(TestCase):
+
+    def test_progress_counter_tracks_totals(self):
+        counter = ProgressCounter()
+        counter.add_total(100)
+        counter.add(30)
+        counter.add(-10)
+        self.assertEqual(counter.snapshot(), (20, 100))
+        counter.reset()
+        self.assertEqual(counter.snapshot(), (0, 0))
+
+
+class ThroughputMeterTest(TestCase):
+
+    def test_throughput_meter_needs_two_samples(self):
+        meter = ThroughputMeter()
+        self.assertIsNone(meter.update(0, 0.0))
+        self.assertIsNone(meter.eta(100))
+        self.assertEqual(meter.update(100, 1.0), 100)
+        self.assertEqual(meter.eta(500), 5)
+        self.assertEqual(meter.eta(0), 0)
+
+    def test_throughput_meter_smooths_changes(self):
+        meter = ThroughputMeter(smoothing_time=1.0)
+        meter.update(0, 0.0)
+        meter.update(100, 1.0)
+        rate = meter.update(100, 2.0)
+        # a stalled second pulls the rate down, but not all the way to zero
+        self.assertGreater(rate, 0)
+        self.assertLess(rate, 100)
+
+    def test_throughput_meter_ignores_repeated_timestamps(self):
+        meter = ThroughputMeter()
+        meter.update(0, 0.0)
+        meter.update(100, 1.0)
+        self.assertEqual(meter.update(500, 1.0), 100)
+
+
+class ScaleToQtTest(TestCase):
+
+    def test_scale_to_qt_leaves_small_values(self):
+        self.assertEqual(scale_to_qt(1337, 4096), (1337, 4096))
+        self.assertEqual(scale_to_qt(5, QT_MAX_VALUE), (5, QT_MAX_VALUE))
+
+    def test_scale_to_qt_shrinks_large_values(self):
+        total = 50 * 1024**3
+        value, maximum = scale_to_qt(total // 4, total)
+        self.assertLessEqual(maximum, QT_MAX_VALUE)
+        self.assertAlmostEqual(value * 4, maximum, delta=4)
+        self.assertEqual(scale_to_qt(total, total)[0],
+                         scale_to_qt(total, total)[1])
+
+
+class FormatTest(TestCase):
+
+    def test_format_size(self):
+        self.assertEqual(format_size(512), '512 B')
+        self.assertEqual(format_size(1536), '1.5 KB')
+        self.assertEqual(format_size(12.3 * 1024**2), '12.3 MB')
+        self.assertEqual(format_size(5 * 1024**4), '5.0 TB')
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(0), '0:00')
+        self.assertEqual(format_duration(65.2), '1:06')
+        self.assertEqual(format_duration(3725), '1:02:05')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from remote_index import FileIndex, parse_index, load_index, save_index,\
+     apply_delta
+
+
+def blocks_of(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+test_index = {
+    'base_url': 'https://patch.houraiteahouse.net',
+    'url_format': '{base_url}/{project}/{filename}_{filehash}',
+    'last_updated': 1500000000,
+    'packs': {'pack_0000.tar': {'sha256': 'ff' * 32, 'size': 10240}},
+    'files': {
+        'fc.exe': {'sha256': hashlib.sha256(b'exe').hexdigest(),
+                   'size': 123456789},
+        'data/東方.assets': {
+            'sha256': hashlib.sha256(b'assets').hexdigest(), 'size': 7,
+            'encoding': 'gzip', 'compressed_size': 5},
+        'data/small.cfg': {'sha256': hashlib.sha256(b'cfg').hexdigest(),
+                           'size': 0, 'pack': 'pack_0000.tar'},
+    },
+    'project': 'fantasy-crescendo',
+}
+
+
+class ParseIndexTest(TestCase):
+
+    def test_parse_index_matches_json(self):
+        data = json.dumps(test_index, ensure_ascii=False).encode('utf8')
+        for size in (1, 2, 3, 7, 64, len(data)):
+            index = parse_index(blocks_of(data, size))
+            self.assertIsInstance(index['files'], FileIndex)
+            self.assertEqual(dict(index, files=dict(index['files'])),
+                             test_index)
+
+    def test_parse_index_reports_files_as_they_are_read(self):
+        data = json.dumps(test_index, indent=2).encode('utf8')
+        seen = []
+
+        def blocks():
+            for block in blocks_of(data, 16):
+                yield block
+                seen.append(None)
+
+        parsed = []
+        parse_index(blocks(), lambda name, filedata: parsed.append(
+            (name, len(seen))))
+        self.assertEqual([name for name, _ in parsed],
+                         list(test_index['files']))
+        # every file was handed over before the next one had been read
+        self.assertLess(parsed[0][1], parsed[1][1])
+        self.assertLess(parsed[1][1], parsed[2][1])
+        self.assertLess(parsed[0][1], len(seen) * 2 // 3)
+
+    def test_parse_index_handles_empty_objects(self):
+        self.assertEqual(parse_index([b' { } ']), {})
+        self.assertEqual(len(parse_index([b'{"files": {}}'])['files']), 0)
+
+    def test_parse_index_rejects_truncated_bodies(self):
+        data = json.dumps(test_index).encode('utf8')
+        for end in (0, 1, 20, len(data) // 2, len(data) - 1):
+            with self.assertRaises(ValueError):
+                parse_index(blocks_of(data[:end], 5))
+
+
+class FileIndexTest(TestCase):
+
+    def test_file_index_stores_digests_compactly(self):
+        files = FileIndex()
+        filehash = hashlib.sha256(b'a').hexdigest()
+        files.add('a', {'sha256': filehash, 'size': 1})
+        files.add('b', {'sha256': 'not a hash', 'size': 2, 'pack': 'p'})
+        self.assertEqual(bytes(files._digests[:32]),
+                         hashlib.sha256(b'a').digest())
+        self.assertEqual(files._extras, {
+            1: {'sha256': 'not a hash', 'pack': 'p'}})
+        self.assertEqual(files['a'], {'sha256': filehash, 'size': 1})
+        self.assertEqual(files['b'],
+                         {'sha256': 'not a hash', 'size': 2, 'pack': 'p'})
+
+    def test_file_index_replaces_entries(self):
+        files = FileIndex()
+        files.add('a', {'sha256': 'x', 'size': 1})
+        files.add('a', {'sha256': '00' * 32, 'size': 3})
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files['a'], {'sha256': '00' * 32, 'size': 3})
+        self.assertIn('a', files)
+        self.assertNotIn('b', files)
+
+    def test_file_index_discards_entries(self):
+        files = FileIndex()
+        files.add('a', {'sha256': 'x', 'size': 1})
+        files.add('b', {'sha256': 'y', 'size': 2})
+        files.discard('a')
+        files.discard('missing')
+        self.assertEqual(dict(files), {'b': {'sha256': 'y', 'size': 2}})
+
+
+class IndexDeltaTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = json.dumps(test_index).encode('utf8')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_saved_index_loads_back(self):
+        path = os.path.join(self.temp_dir, 'index.json')
+        save_index(path, parse_index([self.data]))
+        index = load_index(path)
+        self.assertEqual(dict(index, files=dict(index['files'])), test_index)
+        self.assertEqual(os.listdir(self.temp_dir), ['index.json'])
+
+    def test_apply_delta_updates_files_and_metadata(self):
+        index = parse_index([self.data])
+        new_exe = {'sha256': hashlib.sha256(b'new').hexdigest(), 'size': 3}
+        changed = apply_delta(index, {
+            'since': 1500000000, 'last_updated': 1500000100,
+            'added': {'mods/x.lua': {'sha256': '11' * 32, 'size': 1}},
+            'modified': {'fc.exe': new_exe},
+            'removed': ['data/small.cfg']})
+
+        self.assertEqual(changed, {'mods/x.lua', 'fc.exe'})
+        self.assertEqual(index['last_updated'], 1500000100)
+        self.assertNotIn('since', index)
+        self.assertEqual(sorted(index['files']),
+                         ['data/東方.assets', 'fc.exe', 'mods/x.lua'])
+        self.assertEqual(index['files']['fc.exe'], new_exe)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, main, mock
+from download import Download, DownloadError, DownloadTracker
+from scheduler import DownloadQueue, is_critical, LARGEST_FIRST,\
+     SMALLEST_FIRST, CRITICAL_FIRST
+
+
+def drain(queue):
+    paths = []
+    download = queue.pop()
+    while download is not None:
+        paths.append(download.file_path)
+        download = queue.pop()
+    return paths
+
+
+class DownloadQueueTest(TestCase):
+
+    def setUp(self):
+        self.downloads = [Download('game/data/%s' % name, '', size)
+                          for name, size in (('a', 10), ('b', 3000),
+                                             ('c', 20), ('fc.exe', 5),
+                                             ('d', 3000))]
+
+    def queue(self, policy, critical_files=()):
+        queue = DownloadQueue(policy, critical_files)
+        for download in self.downloads:
+            queue.push(download)
+        return queue
+
+    def test_queue_largest_first(self):
+        self.assertEqual(drain(self.queue(LARGEST_FIRST)), [
+            'game/data/b', 'game/data/d', 'game/data/c', 'game/data/a',
+            'game/data/fc.exe'])
+
+    def test_queue_defaults_to_largest_first(self):
+        self.assertEqual(drain(self.queue(None)),
+                         drain(self.queue(LARGEST_FIRST)))
+
+    def test_queue_smallest_first(self):
+        self.assertEqual(drain(self.queue(SMALLEST_FIRST)), [
+            'game/data/fc.exe', 'game/data/a', 'game/data/c', 'game/data/b',
+            'game/data/d'])
+
+    def test_queue_critical_first(self):
+        queue = self.queue(CRITICAL_FIRST, ['fc.exe', 'data/a'])
+        self.assertEqual(drain(queue), [
+            'game/data/a', 'game/data/fc.exe', 'game/data/b', 'game/data/d',
+            'game/data/c'])
+
+    def test_queue_accepts_late_additions(self):
+        queue = self.queue(LARGEST_FIRST)
+        self.assertEqual(queue.pop().file_path, 'game/data/b')
+        queue.push(Download('late', '', 5000))
+        self.assertEqual(queue.pop().file_path, 'late')
+        self.assertEqual(len(queue), 4)
+
+    def test_queue_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            DownloadQueue('random')
+
+    def test_is_critical_matches_path_suffixes(self):
+        self.assertTrue(is_critical('/games/fc/fc.exe', ['fc.exe']))
+        self.assertTrue(is_critical('/games/fc/fc_Data/Managed/a.dll',
+                                    ['fc_Data/Managed/*']))
+        self.assertFalse(is_critical('/games/fc/xfc.exe', ['fc.exe']))
+
+
+class ScheduledDownloadTrackerTest(TestCase):
+
+    def test_tracker_falls_back_to_default_order_for_unknown_policy(self):
+        with mock.patch('logging.warning') as m:
+            tracker = DownloadTracker(None, policy='random')
+        m.assert_called_once_with(
+            'Unknown download order random, using largest_first')
+        self.assertIsNone(tracker.policy)
+        self.assertEqual(DownloadTracker(None, policy=SMALLEST_FIRST).policy,
+                         SMALLEST_FIRST)
+
+    def test_tracker_bounds_active_downloads_in_policy_order(self):
+        started = []
+        active = [0, 0]
+        lock = threading.Lock()
+
+        def download_file(download, session=None):
+            with lock:
+                started.append(download.total_size)
+                active[0] += 1
+                active[1] = max(active)
+            # staggered, so the slots free up in a predictable order
+            time.sleep(download.total_size / 1000)
+            with lock:
+                active[0] -= 1
+
+        tracker = DownloadTracker(None, ThreadPoolExecutor(8),
+                                  max_downloads=3, policy=SMALLEST_FIRST)
+        for size in (50, 10, 40, 20, 30, 60, 70):
+            tracker.add_download('file_%s' % size, '', size)
+        loop = asyncio.new_event_loop()
+        with mock.patch('download.Download.download_file', download_file):
+            loop.run_until_complete(tracker._execute_requests(loop))
+        loop.close()
+
+        # the first three start together, then in order as slots free up
+        self.assertEqual(sorted(started[:3]), [10, 20, 30])
+        self.assertEqual(started[3:], [40, 50, 60, 70])
+        self.assertEqual(active[1], 3)
+
+    def test_tracker_tries_every_download_before_reporting_failures(self):
+        attempts = []
+
+        def download_file(download, session=None):
+            attempts.append(download.file_path)
+            if download.file_path.startswith('bad') and \
+                    attempts.count(download.file_path) == 1:
+                raise OSError('disk full')
+
+        tracker = DownloadTracker(None, ThreadPoolExecutor(8),
+                                  max_downloads=2, policy=SMALLEST_FIRST)
+        for name, size in (('bad_1', 1), ('bad_2', 2), ('a', 3), ('b', 4),
+                           ('c', 5), ('d', 6)):
+            tracker.add_download(name, '', size)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch('download.Download.download_file', download_file),\
+                mock.patch('logging.error') as m:
+            with self.assertRaises(DownloadError) as raised:
+                loop.run_until_complete(tracker.run_async())
+            self.assertEqual(sorted(attempts),
+                             ['a', 'b', 'bad_1', 'bad_2', 'c', 'd'])
+            self.assertEqual(
+                sorted(download.file_path
+                       for download, _ in raised.exception.failures),
+                ['bad_1', 'bad_2'])
+            # running again only retries the failed ones
+            loop.run_until_complete(tracker.run_async())
+        self.assertEqual(sorted(attempts[6:]), ['bad_1', 'bad_2'])
+        self.assertEqual(m.call_count, 2)
+
+    def test_tracker_bounds_started_and_run_downloads_together(self):
+        active = [0, 0]
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def download_file(download, session=None):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            if download.file_path.startswith('early'):
+                release.wait()
+            else:
+                time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+
+        tracker = DownloadTracker(None, ThreadPoolExecutor(8),
+                                  max_downloads=2)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch('download.Download.download_file', download_file):
+            tracker.start(Download('early_1', '', 10))
+            tracker.start(Download('early_2', '', 10))
+            for size in range(4):
+                tracker.add_download('late_%s' % size, '', size)
+            requests_done = tracker._execute_requests(loop)
+            loop.call_later(0.05, release.set)
+            loop.run_until_complete(requests_done)
+
+        self.assertEqual(active[1], 2)
+        self.assertEqual(len(tracker._completed), 6)
+
+
+if __name__ == "__main__":
+    main()
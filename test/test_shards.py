@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from shards import ShardStore, encode_shard, hash_shard, load_sharded_files
+
+
+def make_shards(tree, served):
+    """ Encodes a tree of {'name': filedata or subtree} into served,
+    returning the root hash. """
+    files, dirs = {}, {}
+    for name, value in tree.items():
+        if 'sha256' in value:
+            files[name] = value
+        else:
+            dirs[name] = make_shards(value, served)
+    data = encode_shard(files, dirs)
+    served[hash_shard(data)] = data
+    return hash_shard(data)
+
+
+def entry(text):
+    return {'sha256': hash_shard(text.encode('utf8')), 'size': len(text)}
+
+
+class ShardTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = ShardStore(os.path.join(self.temp_dir, 'shards'))
+        self.served = {}
+        self.fetched = []
+        self.tree = {
+            'fc.exe': entry('exe'),
+            'data': {'a.assets': entry('a'), 'music': {'b.ogg': entry('b')}},
+            'mods': {'c.lua': entry('c')},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def fetch(self, shard_hash):
+        self.fetched.append(shard_hash)
+        return self.served[shard_hash]
+
+    def test_load_sharded_files_flattens_the_tree(self):
+        root = make_shards(self.tree, self.served)
+        files, reachable = load_sharded_files(root, self.fetch, self.store)
+
+        self.assertEqual(dict(files), {
+            'fc.exe': entry('exe'), 'data/a.assets': entry('a'),
+            'data/music/b.ogg': entry('b'), 'mods/c.lua': entry('c')})
+        self.assertEqual(reachable, set(self.served))
+        self.assertEqual(sorted(self.fetched), sorted(self.served))
+
+    def test_load_sharded_files_fetches_only_changed_shards(self):
+        old_root = make_shards(self.tree, self.served)
+        load_sharded_files(old_root, self.fetch, self.store)
+        self.fetched = []
+        self.tree['data']['music']['b.ogg'] = entry('new b')
+        root = make_shards(self.tree, self.served)
+
+        files, reachable = load_sharded_files(root, self.fetch, self.store)
+
+        # root, data and data/music changed; mods did not
+        self.assertEqual(len(self.fetched), 3)
+        self.assertEqual(files['mods/c.lua'], entry('c'))
+        self.assertEqual(files['data/music/b.ogg'], entry('new b'))
+
+        self.store.prune(reachable)
+        self.assertEqual(sorted(os.listdir(self.store.directory)),
+                         sorted(shard + '.json' for shard in reachable))
+
+    def test_shard_store_checks_hashes(self):
+        data = encode_shard({'a': entry('a')}, {})
+        with self.assertRaises(ValueError):
+            self.store.put('0' * 64, data)
+        self.store.put(hash_shard(data), data)
+        with open(os.path.join(self.store.directory,
+                               hash_shard(data) + '.json'), 'wb') as damaged:
+            damaged.write(data[:-1])
+        self.assertIsNone(self.store.get(hash_shard(data)))
+        self.assertEqual(os.listdir(self.store.directory), [])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import datetime
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, main
+from download import download_file
+from test_download import RangeServer, assert_downloaded
+from throttle import BandwidthSchedule, TokenBucket, MIN_BLOCK_SIZE
+
+
+def at(hour, minute=0):
+    return datetime.datetime(2020, 1, 1, hour, minute)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+class BandwidthScheduleTest(TestCase):
+
+    def test_schedule_without_profiles_uses_default(self):
+        self.assertEqual(BandwidthSchedule(1000).limit_at(at(12)), 1000)
+        self.assertIsNone(BandwidthSchedule().limit_at(at(12)))
+        self.assertIsNone(BandwidthSchedule(0).limit_at(at(12)))
+
+    def test_schedule_profiles_override_default(self):
+        schedule = BandwidthSchedule(1000, [
+            {'start': '09:00', 'end': '17:30', 'limit': 10},
+            {'start': '22:00', 'end': '06:00', 'limit': 0},
+        ])
+        self.assertEqual(schedule.limit_at(at(9)), 10)
+        self.assertEqual(schedule.limit_at(at(17, 29)), 10)
+        self.assertEqual(schedule.limit_at(at(17, 30)), 1000)
+        self.assertEqual(schedule.limit_at(at(8, 59)), 1000)
+        # wraps around midnight
+        self.assertIsNone(schedule.limit_at(at(23)))
+        self.assertIsNone(schedule.limit_at(at(3)))
+        self.assertEqual(schedule.limit_at(at(6)), 1000)
+
+
+class TokenBucketTest(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def bucket(self, limit, **kwargs):
+        return TokenBucket(BandwidthSchedule(limit), clock=self.clock,
+                           **kwargs)
+
+    def test_token_bucket_unlimited_never_waits(self):
+        bucket = self.bucket(None)
+        self.assertEqual(bucket.reserve(10**9), 0)
+        self.assertEqual(bucket.block_size(1024**2), 1024**2)
+
+    def test_token_bucket_waits_for_debt(self):
+        bucket = self.bucket(1000)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5)
+        self.clock.time = 0.5
+        self.assertAlmostEqual(bucket.reserve(1000), 1.0)
+        self.clock.time = 1.5
+        self.assertAlmostEqual(bucket.reserve(250), 0.25)
+
+    def test_token_bucket_queues_concurrent_callers_in_order(self):
+        bucket = self.bucket(1000)
+        delays = [bucket.reserve(100) for _ in range(5)]
+        for expected, delay in zip((0.1, 0.2, 0.3, 0.4, 0.5), delays):
+            self.assertAlmostEqual(delay, expected)
+
+    def test_token_bucket_caps_idle_credit_at_burst(self):
+        bucket = self.bucket(1000, burst=200)
+        self.clock.time = 60
+        self.assertEqual(bucket.reserve(200), 0)
+        self.assertAlmostEqual(bucket.reserve(100), 0.1)
+
+    def test_token_bucket_follows_schedule(self):
+        now = [at(12)]
+        bucket = TokenBucket(BandwidthSchedule(1000, [
+            {'start': '18:00', 'end': '23:00', 'limit': 100}]),
+            clock=self.clock, now=lambda: now[0])
+        self.assertAlmostEqual(bucket.reserve(100), 0.1)
+        self.clock.time = 0.1
+        now[0] = at(19)
+        self.assertAlmostEqual(bucket.reserve(100), 1.0)
+
+    def test_token_bucket_block_size_tracks_rate(self):
+        self.assertEqual(self.bucket(10**9).block_size(1024**2), 1024**2)
+        self.assertEqual(self.bucket(10**6).block_size(1024**2), 10**5)
+        self.assertEqual(self.bucket(10).block_size(1024**2), MIN_BLOCK_SIZE)
+
+
+class ThrottledDownloadTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.server = RangeServer()
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        shutil.rmtree(self.temp_dir)
+
+    def test_throttled_downloads_share_the_limit(self):
+        limit = 4 * 1024**2
+        bucket = TokenBucket(BandwidthSchedule(limit))
+        files = {}
+        for i in range(4):
+            data = os.urandom(512 * 1024)
+            self.server.files['/file_%s' % i] = data
+            files[os.path.join(self.temp_dir, 'file_%s' % i)] = \
+                (self.server.url('/file_%s' % i), data)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(
+                lambda path: download_file(files[path][0], path,
+                                           throttle=bucket), files))
+        elapsed = time.perf_counter() - start
+
+        for path, (_, data) in files.items():
+            assert_downloaded(self, path, data)
+        expected = 2 * 1024**2 / limit
+        self.assertGreaterEqual(elapsed, expected * 0.95)
+        self.assertLess(elapsed, expected * 1.3)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import asyncio
 import config
+import hashing
+import hashlib
+import json
 import common
 import download
 import ui
@@ -7,13 +10,20 @@ import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 from concurrent import futures
+from cache import CachedResponse
 from common import GLOBAL_CONTEXT
+from shards import encode_shard, hash_shard
+from requests.exceptions import HTTPError
 from test_download import SessionMock, ResponseMock
-from async_unittest import AsyncTestCase, async_patch, TestCase, mock, main
+from async_unittest import AsyncTestCase, async_patch, TestCase, mock,\
+     main, WakeupCountingLoop
 from PyQt5 import QtWidgets
-from util import namedtuple_from_mapping, get_platform, tupperware
+from util import namedtuple_from_mapping, get_platform, tupperware,\
+     FileEntry
 
 
 test_rss_data = tupperware(dict(
@@ -105,6 +115,10 @@ class DownloadMock(object):
         self.total_size = download_size
         self.downloaded_bytes = 0
 
+    @property
+    def file_paths(self):
+        return [self.file_path]
+
     def download_file(self, session=None, filehash=None):
         return self.status_code
 
@@ -120,10 +134,15 @@ class DownloadTrackerMock(object):
         self.downloads_mock_info = {}
         self.run_called_with = []
 
-    def add_download(self, filepath, url, filesize):
+    def add_download(self, filepath, url, filesize, filehash=None,
+                     **kwargs):
         self.downloads_mock_info[filepath] = filesize
         self.downloads.append(DownloadMock(filepath, url, filesize))
 
+    def add(self, download):
+        self.downloads_mock_info[download.file_path] = download.total_size
+        self.downloads.append(download)
+
     def run(self, session=None):
         self.run_called_with.append(session)
 
@@ -135,10 +154,21 @@ class StopLoopException(Exception):
     pass
 
 
+def use_temp_config_dir(test):
+    """ Keeps the launcher data written by a test (journals, caches,
+    data.json) out of the working tree. """
+    temp_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, temp_dir)
+    patcher = mock.patch('ui.CONFIG_DIR', temp_dir)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
 class BranchTest(AsyncTestCase):
     branch = None
 
     def setUp(self):
+        use_temp_config_dir(self)
         self.branch = ui.Branch("Development", "develop", testing_config)
 
     def test_branch_can_create_branch(self):
@@ -155,22 +185,99 @@ class BranchTest(AsyncTestCase):
 
     def test_branch_can_index_directory(self):
         branch = self.branch
-        test_paths = (("full_1", "rel_1"), ("full_2", "rel_2"))
+        test_entries = (FileEntry("full_1", "rel_1", None),
+                        FileEntry("full_2", "rel_2", None))
         with mock.patch('os.path.exists', lambda dir: True) as m1,\
-                mock.patch('ui.list_files', lambda dir: test_paths) as m2,\
-                mock.patch('ui.sha256_hash', lambda p: "HASH%s" % p) as m3:
+                mock.patch('ui.scan_files',
+                           lambda dir, workers, **kwargs: test_entries) as m2,\
+                mock.patch('hashing.sha256_hash', should_not_be_run) as m3:
             branch.index_directory()
 
-        files = branch.files
-        self.assertIn("rel_1", files)
-        self.assertIn("rel_2", files)
+        local_files = branch.local_files
+        self.assertIn("rel_1", local_files)
+        self.assertIn("rel_2", local_files)
+        self.assertTrue(branch.is_indexed)
+
+    def _make_install(self, contents):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.branch.directory = os.path.join(temp_dir, 'install')
+        self.branch.hash_cache.path = os.path.join(temp_dir, 'hashes.json')
+        remote_files = {}
+        for relative, data in contents.items():
+            path = os.path.join(self.branch.directory, relative)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as test_file:
+                test_file.write(data)
+            os.utime(path, (0, 0))
+            remote_files[relative] = dict(
+                sha256=hashlib.sha256(data).hexdigest(), size=len(data))
+        self.branch.remote_index = dict(testing_index, files=remote_files)
+        return remote_files
+
+    def test_branch_verify_files_reuses_cached_hashes(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a',
+                                           'sub/b.bin': b'bb'})
+
+        branch.index_directory()
+        branch.verify_files()
+        self.assertEqual(branch.hash_cache.misses, 2)
+        self.assertEqual(branch.files, {
+            name: data['sha256'] for name, data in remote_files.items()})
+        cold_files = dict(branch.files)
+
+        branch.index_directory()
+        with mock.patch('hashing.sha256_hash', should_not_be_run) as m:
+            branch.verify_files()
+        self.assertEqual(branch.hash_cache.hits, 2)
+        self.assertEqual(branch.hash_cache.misses, 0)
+        self.assertEqual(branch.files, cold_files)
+
+    def test_branch_verify_files_skips_size_mismatches(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a', 'extra.bin': b''})
+        remote_files['a.bin']['size'] = 1234
+        del remote_files['extra.bin']
+        remote_files['missing.bin'] = dict(sha256='hash', size=1)
+
+        branch.index_directory()
+        with mock.patch('hashing.sha256_hash', should_not_be_run) as m:
+            branch.verify_files()
+        self.assertEqual(branch.files, {})
+
+        download_tracker = DownloadTrackerMock()
+        branch.set_download_tracker(download_tracker)
+        branch._diff_files(dict(GLOBAL_CONTEXT))
+        self.assertEqual(
+            set(download_tracker.downloads_mock_info),
+            set(os.path.join(branch.directory, name)
+                for name in ('a.bin', 'missing.bin')))
+
+    def test_branch_verify_files_full_mode_rehashes(self):
+        branch = self.branch
+        self._make_install({'a.bin': b'a'})
+
+        branch.index_directory()
+        branch.verify_files()
+        branch.index_directory()
+        branch.verify_files(ui.VERIFY_FULL)
+        self.assertEqual(branch.hash_cache.hits, 0)
+        self.assertIn('a.bin', branch.files)
+
+    def test_branch_verify_mode_can_be_forced_from_command_line(self):
+        self.assertEqual(self.branch.verify_mode, ui.VERIFY_QUICK)
+        with mock.patch('sys.argv', ['--full-verify']):
+            self.assertEqual(self.branch.verify_mode, ui.VERIFY_FULL)
 
     def test_branch_cannot_index_nonexistant_directory(self):
         branch = self.branch
         old_files = branch.files
         test_paths = (("full_1", "rel_1"), ("full_2", "rel_2"))
         with mock.patch('os.path.exists', lambda dir: False) as m1,\
-                mock.patch('ui.list_files', lambda dir: test_paths) as m2:
+                mock.patch('ui.scan_files',
+                           lambda dir, workers: test_paths) as m2:
             branch.index_directory()
 
         self.assertTrue(branch.is_indexed)
@@ -203,6 +310,419 @@ class BranchTest(AsyncTestCase):
         self.assertEqual(downloads["test_file2"], 0xbadf00d)
         self.assertEqual(downloads["test_file3"], 0xc001d00d)
 
+    def test_branch_patches_files_with_a_delta(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'old', 'b.bin': b'b'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        old_hash = remote_files['a.bin']['sha256']
+        # both files grew, so only their hashes can pick a delta
+        remote_files['a.bin'] = dict(sha256='new hash', size=5,
+                                     deltas={old_hash: dict(size=20)})
+        remote_files['b.bin'] = dict(sha256='new hash', size=2,
+                                     deltas={'other hash': dict(size=20)})
+        index = json.dumps(dict(branch.remote_index, files=remote_files))
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', index.encode('utf8'))
+        download_tracker = DownloadTrackerMock()
+        branch.set_download_tracker(download_tracker)
+        branch.index_directory()
+
+        with mock.patch('ui.get_loop', return_value=self.loop),\
+                mock.patch.object(download_tracker, 'add_download') as m:
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+        options = {args[0]: kwargs for args, kwargs in m.call_args_list}
+        self.assertEqual(options[os.path.join(branch.directory, 'a.bin')],
+                         dict(delta_from=old_hash, delta_size=20))
+        self.assertEqual(options[os.path.join(branch.directory, 'b.bin')],
+                         {})
+
+    def test_branch_rebuilds_chunked_files(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'old', 'b.bin': b'b'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        branch.chunk_store.directory = os.path.join(temp_dir, 'chunks')
+        old_chunk = remote_files['a.bin']['sha256']
+        branch.chunk_store.set_installed('a.bin', old_chunk,
+                                         [[old_chunk, 3]])
+        branch.chunk_store.save()
+        # a.bin grew by a chunk, so only its hash shows the old one is kept
+        remote_files['a.bin'] = dict(sha256='new hash', size=6,
+                                     chunks=[[old_chunk, 3],
+                                             ['new chunk', 3]])
+        remote_files['b.bin'] = dict(sha256='b hash', size=2,
+                                     chunks=[['b chunk', 2]])
+        index = json.dumps(dict(
+            branch.remote_index, files=remote_files,
+            chunk_url_format='{base_url}/chunks/{chunkhash}'))
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', index.encode('utf8'))
+        download_tracker = DownloadTrackerMock()
+        branch.set_download_tracker(download_tracker)
+        branch.index_directory()
+
+        with mock.patch('ui.get_loop', return_value=self.loop):
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+        downloads = {os.path.basename(download.file_path): download
+                     for download in download_tracker.downloads}
+        self.assertIsInstance(downloads['a.bin'], ui.ChunkedDownload)
+        self.assertEqual(downloads['a.bin'].url, '%s/chunks/{chunkhash}' %
+                         testing_index['base_url'])
+        self.assertEqual(downloads['a.bin'].total_size, 3)
+
+        # b.bin failed to download, so its chunks aren't in place
+        downloads['a.bin'].rebuilt = True
+        branch._record_chunked_files()
+        branch.chunk_store.load()
+        self.assertEqual(branch.chunk_store.installed, {
+            'a.bin': {'sha256': 'new hash',
+                      'chunks': [[old_chunk, 3], ['new chunk', 3]]}})
+
+    def test_branch_groups_packed_files(self):
+        branch = self.branch
+        remote_files = self._make_install({})
+        for name in ('a.cfg', 'b.cfg', 'c.cfg', 'big.bin'):
+            remote_files[name] = dict(sha256='hash_' + name, size=10)
+        remote_files['a.cfg']['pack'] = remote_files['b.cfg']['pack'] = \
+            'pack_0.tar'
+        remote_files['c.cfg']['pack'] = 'pack_1.tar'
+        branch.remote_index['packs'] = {
+            'pack_0.tar': dict(sha256='pack_hash', size=30),
+            'pack_1.tar': dict(sha256='pack_hash_1', size=20)}
+        branch.index_directory()
+        branch.verify_files()
+
+        download_tracker = DownloadTrackerMock()
+        branch.set_download_tracker(download_tracker)
+        branch._diff_files(dict(GLOBAL_CONTEXT))
+        downloads = {os.path.basename(download.file_path): download
+                     for download in download_tracker.downloads}
+        self.assertEqual(sorted(downloads),
+                         ['big.bin', 'c.cfg', 'pack_0.tar'])
+        pack = downloads['pack_0.tar']
+        self.assertIsInstance(pack, ui.PackDownload)
+        self.assertEqual(sorted(pack.members), ['a.cfg', 'b.cfg'])
+        self.assertEqual(pack.total_size, 30)
+        self.assertTrue(pack.url.endswith('pack_0.tar_pack_hash'))
+
+    def test_branch_downloads_members_of_oversized_packs_on_their_own(self):
+        branch = self.branch
+        remote_files = self._make_install({})
+        for name in ('a.cfg', 'b.cfg', 'c.cfg'):
+            remote_files[name] = dict(sha256='hash_' + name, size=10)
+        remote_files['a.cfg']['pack'] = remote_files['b.cfg']['pack'] = \
+            'pack_0.tar'
+        remote_files['c.cfg'].update(pack='pack_1.tar', encoding='gzip',
+                                     compressed_size=4)
+        branch.remote_index['packs'] = {
+            'pack_0.tar': dict(sha256='pack_hash', size=41),
+            'pack_1.tar': dict(sha256='pack_hash_1', size=20)}
+        branch.index_directory()
+        branch.verify_files()
+
+        download_tracker = DownloadTrackerMock()
+        branch.set_download_tracker(download_tracker)
+        branch._diff_files(dict(GLOBAL_CONTEXT))
+        downloads = {os.path.basename(download.file_path): download
+                     for download in download_tracker.downloads}
+        self.assertEqual(sorted(downloads), ['a.cfg', 'b.cfg', 'c.cfg'])
+        self.assertFalse(any(isinstance(download, ui.PackDownload)
+                             for download in downloads.values()))
+        self.assertEqual(downloads['c.cfg'].encoding, 'gzip')
+        self.assertEqual(downloads['c.cfg'].total_size, 4)
+
+    def test_branch_skips_diff_when_index_and_install_are_unchanged(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        index = json.dumps(dict(branch.remote_index, files=remote_files))
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', index.encode('utf8'))
+        branch.set_download_tracker(DownloadTrackerMock())
+        branch.index_directory()
+
+        with mock.patch('ui.get_loop', return_value=self.loop):
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+            self.assertFalse(branch.needs_update)
+            with mock.patch('ui.Branch._finish_verify', should_not_be_run):
+                branch.fetch_remote_index(GLOBAL_CONTEXT)
+
+            # an edit that keeps the size is hashed again
+            a_path = os.path.join(branch.directory, 'a.bin')
+            with open(a_path, 'wb') as a_file:
+                a_file.write(b'A')
+            os.utime(a_path, (1, 1))
+            branch.index_directory()
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+            self.assertTrue(branch.needs_update)
+
+            # a deleted file is noticed without rehashing anything
+            os.remove(a_path)
+            branch.index_directory()
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+        self.assertTrue(branch.needs_update)
+
+    def test_branch_checks_files_in_unchanged_index_shards_for_edits(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a', 'sub/b.bin': b'bb'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        branch.shard_store.directory = os.path.join(temp_dir, 'shards')
+        served = {}
+
+        def serve(files, dirs):
+            data = encode_shard(files, dirs)
+            served[hash_shard(data)] = data
+            return hash_shard(data)
+
+        def publish():
+            sub = serve({'b.bin': remote_files['sub/b.bin']}, {})
+            index = dict(testing_index, shard_url_format='{shardhash}',
+                         shard_root=serve({'a.bin': remote_files['a.bin']},
+                                          {'sub': sub}))
+            del index['files']
+            branch.metadata_cache.get.return_value = CachedResponse(
+                'index.json', json.dumps(index).encode('utf8'))
+
+        branch.metadata_cache = mock.Mock()
+        branch.http_client = mock.Mock()
+        branch.http_client.get.side_effect = \
+            lambda url, **kwargs: CachedResponse(url, served[url])
+        branch.set_download_tracker(DownloadTrackerMock())
+        branch.index_directory()
+        publish()
+        with mock.patch('ui.get_loop', return_value=self.loop):
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+            self.assertFalse(branch.needs_update)
+
+            remote_files['sub/b.bin'] = dict(
+                sha256=hashlib.sha256(b'cc').hexdigest(), size=2)
+            publish()
+            # edited in place: same size, in a shard that didn't change
+            a_path = os.path.join(branch.directory, 'a.bin')
+            with open(a_path, 'wb') as a_file:
+                a_file.write(b'z')
+            os.utime(a_path, (1, 1))
+            branch.index_directory()
+            with mock.patch('hashing.sha256_hash',
+                            wraps=hashing.sha256_hash) as m:
+                branch.fetch_remote_index(GLOBAL_CONTEXT)
+
+        m.assert_called_once_with(a_path)
+        self.assertTrue(branch.needs_update)
+        self.assertEqual(
+            sorted(branch.download_tracker.downloads_mock_info),
+            [a_path, os.path.join(branch.directory, 'sub/b.bin')])
+
+    def test_branch_applies_index_changes_since_last_verified(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a', 'sub/b.bin': b'bb'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        branch.index_snapshot = os.path.join(temp_dir, 'index.json')
+        branch.config = namedtuple_from_mapping(dict(
+            testing_config._asdict(), index_delta_endpoint='changes/{since}'))
+        index = dict(testing_index, files=remote_files, last_updated=1)
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', json.dumps(index).encode('utf8'))
+        new_b = dict(sha256=hashlib.sha256(b'cc').hexdigest(), size=2)
+        delta = dict(since=1, last_updated=2, modified={'sub/b.bin': new_b},
+                     removed=['a.bin'])
+        branch.http_client = mock.Mock()
+        branch.http_client.get.side_effect = [
+            CachedResponse('changes/1', json.dumps(delta).encode('utf8'))]
+        branch.set_download_tracker(DownloadTrackerMock())
+        branch.index_directory()
+
+        with mock.patch('ui.get_loop', return_value=self.loop):
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+            self.assertFalse(branch.needs_update)
+            os.remove(branch.hash_cache.path)
+            with mock.patch('hashing.sha256_hash',
+                            wraps=hashing.sha256_hash) as m:
+                branch.fetch_remote_index(GLOBAL_CONTEXT)
+
+        branch.http_client.get.assert_called_once_with('changes/1')
+        self.assertEqual(branch.metadata_cache.get.call_count, 1)
+        m.assert_called_once_with(
+            os.path.join(branch.directory, 'sub', 'b.bin'))
+        self.assertEqual(dict(branch.remote_index['files']),
+                         {'sub/b.bin': new_b})
+        self.assertEqual(branch.remote_index['last_updated'], 2)
+        self.assertTrue(branch.needs_update)
+
+    def test_branch_checks_files_outside_index_changes_for_edits(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a', 'sub/b.bin': b'bb'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        branch.index_snapshot = os.path.join(temp_dir, 'index.json')
+        branch.config = namedtuple_from_mapping(dict(
+            testing_config._asdict(), index_delta_endpoint='changes/{since}'))
+        index = dict(testing_index, files=remote_files, last_updated=1)
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', json.dumps(index).encode('utf8'))
+        new_b = dict(sha256=hashlib.sha256(b'cc').hexdigest(), size=2)
+        delta = dict(since=1, last_updated=2, modified={'sub/b.bin': new_b})
+        branch.http_client = mock.Mock()
+        branch.http_client.get.side_effect = [
+            CachedResponse('changes/1', json.dumps(delta).encode('utf8'))]
+        branch.set_download_tracker(DownloadTrackerMock())
+        branch.index_directory()
+
+        with mock.patch('ui.get_loop', return_value=self.loop):
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+            # edited in place: same size, and not in the changes
+            a_path = os.path.join(branch.directory, 'a.bin')
+            with open(a_path, 'wb') as a_file:
+                a_file.write(b'z')
+            os.utime(a_path, (1, 1))
+            branch.index_directory()
+            with mock.patch('hashing.sha256_hash',
+                            wraps=hashing.sha256_hash) as m:
+                branch.fetch_remote_index(GLOBAL_CONTEXT)
+
+        m.assert_called_once_with(a_path)
+        self.assertEqual(
+            sorted(branch.download_tracker.downloads_mock_info),
+            [a_path, os.path.join(branch.directory, 'sub/b.bin')])
+
+    def test_branch_keeps_the_full_index_identity_without_changes(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        branch.index_snapshot = os.path.join(temp_dir, 'index.json')
+        branch.config = namedtuple_from_mapping(dict(
+            testing_config._asdict(), index_delta_endpoint='changes/{since}'))
+        index = dict(testing_index, files=remote_files, last_updated=1)
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', json.dumps(index).encode('utf8'))
+        too_old = ResponseMock(b'')
+        too_old.raise_for_status = mock.Mock(side_effect=HTTPError('410'))
+        branch.http_client = mock.Mock()
+        branch.http_client.get.side_effect = [
+            CachedResponse('changes/1', b'{"since": 1, "last_updated": 1}'),
+            too_old]
+        branch.set_download_tracker(DownloadTrackerMock())
+        branch.index_directory()
+
+        with mock.patch('ui.get_loop', return_value=self.loop):
+            branch.fetch_remote_index(GLOBAL_CONTEXT)
+            full_hash = branch.index_hash
+            with mock.patch('ui.Branch._finish_verify', should_not_be_run):
+                branch.fetch_remote_index(GLOBAL_CONTEXT)
+                self.assertEqual(branch.index_hash, full_hash)
+                # the full index is still known to match the installation
+                branch.fetch_remote_index(GLOBAL_CONTEXT)
+
+        self.assertEqual(branch.http_client.get.call_count, 2)
+        self.assertEqual(branch.metadata_cache.get.call_count, 2)
+        self.assertFalse(branch.needs_update)
+
+    def test_branch_fetches_full_index_without_index_changes(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a'})
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        branch.index_snapshot = os.path.join(temp_dir, 'index.json')
+        branch.config = namedtuple_from_mapping(dict(
+            testing_config._asdict(), index_delta_endpoint='changes/{since}'))
+        index = dict(testing_index, files=remote_files, last_updated=1)
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', json.dumps(index).encode('utf8'))
+        too_old = ResponseMock(b'')
+        too_old.raise_for_status = mock.Mock(side_effect=HTTPError('410'))
+        branch.http_client = mock.Mock()
+        branch.http_client.get.side_effect = [
+            too_old, CachedResponse('changes/1', b'{"since": 0}')]
+        branch.set_download_tracker(DownloadTrackerMock())
+        branch.index_directory()
+
+        with mock.patch('ui.get_loop', return_value=self.loop):
+            for _ in range(3):
+                branch.fetch_remote_index(GLOBAL_CONTEXT)
+
+        self.assertEqual(branch.http_client.get.call_count, 2)
+        self.assertEqual(branch.metadata_cache.get.call_count, 3)
+        self.assertFalse(branch.needs_update)
+
+    def test_branch_prefetches_missing_files_while_scanning(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a', 'sub/b.bin': b'bb'})
+        remote_files['new/c.bin'] = dict(sha256='c hash', size=3)
+        temp_dir = os.path.dirname(branch.directory)
+        branch.journal.path = os.path.join(temp_dir, 'journal.json')
+        index = json.dumps(dict(branch.remote_index, files=remote_files))
+        branch.metadata_cache = mock.Mock()
+        branch.metadata_cache.get.return_value = CachedResponse(
+            'index.json', index.encode('utf8'))
+        download_tracker = DownloadTrackerMock()
+        branch.set_download_tracker(download_tracker)
+        branch.prefetch = True
+        prefetched = threading.Event()
+        download_tracker.start = mock.Mock(
+            side_effect=lambda *args, **kwargs: prefetched.set())
+        real_scan_files = ui.scan_files
+
+        def slow_scan_files(directory, **kwargs):
+            for entry in real_scan_files(directory, **kwargs):
+                if entry.relative_path.startswith('sub/'):
+                    # the root is listed: new/ doesn't exist
+                    self.assertTrue(prefetched.wait(5))
+                yield entry
+
+        branch.begin_scan()
+        with mock.patch('ui.get_loop', return_value=self.loop),\
+                mock.patch('ui.scan_files', slow_scan_files),\
+                futures.ThreadPoolExecutor(1) as executor:
+            fetch = executor.submit(branch.fetch_remote_index,
+                                    GLOBAL_CONTEXT)
+            branch.index_directory()
+            fetch.result()
+
+        download, = download_tracker.start.call_args[0]
+        self.assertEqual(download.file_path,
+                         os.path.join(branch.directory, 'new/c.bin'))
+        self.assertEqual(branch.prefetched, set(['new/c.bin']))
+        self.assertEqual(branch.plan.missing, ['new/c.bin'])
+        self.assertEqual(branch.plan.unchanged, ['a.bin', 'sub/b.bin'])
+        # left for update_game to wait for, not downloaded again
+        self.assertEqual(download_tracker.downloads, [])
+        self.assertTrue(branch.needs_update)
+
+    def test_branch_update_removes_extra_files_of_the_plan(self):
+        branch = self.branch
+        remote_files = self._make_install({'a.bin': b'a', 'b.bin': b'b',
+                                           'c.bin.part': b'c',
+                                           'extra.txt': b'x'})
+        del remote_files['extra.txt'], remote_files['c.bin.part']
+        remote_files['b.bin'] = dict(sha256='new hash', size=1)
+        branch.index_directory()
+        branch.verify_files()
+        branch.set_download_tracker(DownloadTrackerMock())
+        branch._diff_files(dict(GLOBAL_CONTEXT))
+        self.assertEqual(branch.plan.changed, ['b.bin'])
+        self.assertEqual(branch.plan.extra, ['c.bin.part', 'extra.txt'])
+        self.assertEqual(branch.plan.unchanged, ['a.bin'])
+
+        with mock.patch('ui.get_loop', return_value=self.loop),\
+                mock.patch('ui.scan_files') as m:
+            branch.update_game()
+        m.assert_not_called()
+        self.assertEqual(sorted(os.listdir(branch.directory)),
+                         ['a.bin', 'b.bin'])
+        self.assertFalse(branch.needs_update)
+
     def test_branch_can_preclean_branch_directory(self):
         branch = self.branch
         download_tracker = DownloadTrackerMock()
@@ -325,14 +845,11 @@ class BranchTest(AsyncTestCase):
         index_session = ResponseMock(b'')
         index_session._json = testing_index
         session = SessionMock()
-        existing_files = [('root\\extra_file1', 'extra_file1'),
-                          ('root\\asdf\\extra_file1', 'asdf\\extra_file2')]
 
         with mock.patch('ui.get_loop', return_value=self.loop) as m1,\
                 mock.patch('ui.Branch._preclean_branch_directory') as m2,\
                 mock.patch('ui.Branch._diff_files') as m5,\
-                mock.patch('os.remove') as m6,\
-                mock.patch('ui.list_files', return_value=existing_files) as m7:
+                mock.patch('os.remove') as m6:
             branch.fetch_remote_index(GLOBAL_CONTEXT)
 
         # TODO(james7123): add proper checks here
@@ -342,6 +859,7 @@ class UiTest(AsyncTestCase):
     executor = futures.ThreadPoolExecutor()
 
     def setUp(self):
+        use_temp_config_dir(self)
         common.get_app()
         common.get_loop()
 
@@ -355,6 +873,22 @@ class UiTest(AsyncTestCase):
         self.assertTrue(hasattr(main_window, "config"))
         self.assertIn("Development", main_window.branches)
 
+    def test_main_window_shares_one_sized_http_client(self):
+        with mock.patch('ui.MainWindow.init_ui', lambda self: None) as m:
+            main_window = ui.MainWindow(testing_config)
+
+        self.assertEqual(main_window.http_client.pool_size,
+                         download.MAX_CONCURRENT_DOWNLOADS)
+        for branch in main_window.branches.values():
+            self.assertIs(branch.http_client, main_window.http_client)
+
+        cfg = namedtuple_from_mapping(dict(testing_config._asdict(),
+                                           download_connections=4,
+                                           max_concurrent_downloads=3))
+        with mock.patch('ui.MainWindow.init_ui', lambda self: None) as m:
+            main_window = ui.MainWindow(cfg)
+        self.assertEqual(main_window.http_client.pool_size, 12)
+
     def test_main_window_can_initialize_ui(self):
         main_window = ui.MainWindow(testing_config)
         self.assertTrue(hasattr(main_window, "launch_game_btn"))
@@ -422,6 +956,9 @@ class UiTest(AsyncTestCase):
                            launch_game_button_show_mock) as m2,\
                 mock.patch('PyQt5.QtWidgets.QProgressBar.hide',
                            progress_bar_hide_mock) as m3:
+            # ready waits for the next state before returning
+            self.loop.call_later(0.05, setattr, main_window, 'client_state',
+                                 ui.ClientState.GAME_UPDATE)
             self.run_async(main_window.ready)
 
         self.assertTrue(mock_data['launch_game_button_enabled'])
@@ -450,6 +987,176 @@ class UiTest(AsyncTestCase):
 
         m2.assert_called_once_with(main_window.context)
         self.assertEqual(main_window.client_state, ui.ClientState.READY)
+        self.assertGreater(main_window.time_to_ready, 0)
+
+    def test_main_window_keeps_failed_updates_pending(self):
+        main_window = ui.MainWindow(testing_config)
+        main_window.executor = self.executor
+        main_window.branch.needs_update = True
+        news_rows = main_window.news_row_count
+
+        with mock.patch('ui.get_loop', return_value=self.loop) as m1,\
+                mock.patch('ui.Branch.update_game',
+                           side_effect=download.DownloadError([])) as m2,\
+                mock.patch('logging.error') as m3:
+            m2._is_coroutine = False
+            self.run_async(main_window.game_update)
+
+        self.assertEqual(main_window.client_state,
+                         ui.ClientState.PENDING_GAME_UPDATE)
+        self.assertEqual(main_window.news_row_count, news_rows + 1)
+
+    def test_main_window_checks_other_branches_after_the_selected_one(self):
+        main_window = ui.MainWindow(namedtuple_from_mapping(dict(
+            testing_config._asdict(),
+            branches=dict(develop="Development", master="Stable"))))
+        main_window.executor = self.executor
+        selected = main_window.branch
+        other, = [branch for branch in main_window.branches.values()
+                  if branch is not selected]
+        scanned = []
+        fetched = []
+
+        def index_directory(branch):
+            scanned.append((branch.name, branch.low_priority))
+
+        def fetch_remote_index(branch, context):
+            fetched.append(branch.name)
+            branch.last_fetched = time.time()
+
+        with mock.patch('ui.get_loop', return_value=self.loop) as m1,\
+                mock.patch('ui.Branch.index_directory', index_directory),\
+                mock.patch('ui.Branch.fetch_remote_index',
+                           fetch_remote_index),\
+                mock.patch('ui.MainWindow.save_persistent_data') as m2:
+            self.run_async(main_window.game_status_check)
+            self.assertEqual(scanned, [(selected.name, False)])
+            self.run_async(main_window.game_update_check)
+            self.assertEqual(fetched[0], selected.name)
+
+            self.loop.run_until_complete(main_window.background_checks)
+            self.assertEqual(scanned, [(selected.name, False),
+                                       (other.name, True)])
+            self.assertEqual(fetched, [selected.name, other.name])
+            self.assertFalse(other.low_priority)
+
+            # switching is instant in both directions
+            main_window.on_branch_change(other.name)
+            self.assertIs(main_window.branch, other)
+            self.assertEqual(main_window.client_state,
+                             ui.ClientState.READY)
+            main_window.on_branch_change(selected.name)
+            self.assertEqual(main_window.client_state,
+                             ui.ClientState.READY)
+        self.assertEqual(len(scanned), 2)
+
+    def test_main_window_waits_for_background_checks_of_selected_branch(self):
+        main_window = ui.MainWindow(namedtuple_from_mapping(dict(
+            testing_config._asdict(),
+            branches=dict(develop="Development", master="Stable"))))
+        main_window.executor = self.executor
+        other, = [branch for branch in main_window.branches.values()
+                  if branch is not main_window.branch]
+        scan = self.loop.create_future()
+        fetch = self.loop.create_future()
+        scan.set_result(None)
+        main_window.checks[other.name] = (scan, fetch)
+        main_window.checks[main_window.branch.name] = (scan, scan)
+        main_window.client_state = ui.ClientState.READY
+
+        with mock.patch('ui.get_loop', return_value=self.loop) as m1,\
+                mock.patch('ui.MainWindow.save_persistent_data') as m2:
+            # still fetching and hashing in the background
+            main_window.on_branch_change(other.name)
+            self.assertEqual(main_window.client_state,
+                             ui.ClientState.GAME_STATUS_CHECK)
+            self.run_async(main_window.game_status_check)
+            other.needs_update = True
+            self.loop.call_later(0.01, fetch.set_result, None)
+            self.run_async(main_window.game_update_check)
+
+        self.assertEqual(main_window.client_state,
+                         ui.ClientState.PENDING_GAME_UPDATE)
+
+    def test_main_window_background_checks_go_on_after_a_failure(self):
+        main_window = ui.MainWindow(namedtuple_from_mapping(dict(
+            testing_config._asdict(),
+            branches=dict(develop="Development", master="Stable"))))
+        main_window.executor = self.executor
+        fetched = []
+
+        def fetch_remote_index(branch, context):
+            if not fetched:
+                fetched.append(branch.name)
+                raise KeyError('base_url')
+            fetched.append(branch.name)
+
+        with mock.patch('ui.get_loop', return_value=self.loop) as m1,\
+                mock.patch('ui.Branch.index_directory') as m2,\
+                mock.patch('ui.Branch.fetch_remote_index',
+                           fetch_remote_index):
+            m2._is_coroutine = False
+            self.run_async(main_window.check_in_background,
+                           list(main_window.branches.values()))
+
+        self.assertEqual(len(fetched), 2)
+        failed, checked = [main_window.branches[name] for name in fetched]
+        self.assertFalse(main_window.branch_checked(failed))
+        self.assertTrue(main_window.branch_checked(checked))
+
+    def test_main_window_checks_unchecked_branches_when_selected(self):
+        main_window = ui.MainWindow(testing_config)
+        main_window.client_state = ui.ClientState.READY
+        with mock.patch('ui.MainWindow.save_persistent_data') as m:
+            main_window.on_branch_change(main_window.branch.name)
+        self.assertEqual(main_window.client_state,
+                         ui.ClientState.GAME_STATUS_CHECK)
+
+    def test_main_window_game_checks_leave_launcher_updates_alone(self):
+        main_window = ui.MainWindow(testing_config)
+        main_window.client_state = ui.ClientState.LAUNCHER_UPDATE
+        main_window.set_idle_state()
+        self.assertEqual(main_window.client_state,
+                         ui.ClientState.LAUNCHER_UPDATE)
+        self.assertIsNone(main_window.time_to_ready)
+
+        # clicks and branch changes can't interrupt the self-update
+        with mock.patch('ui.MainWindow.save_persistent_data') as m:
+            main_window.button_clicked()
+            main_window.on_branch_change(main_window.branch.name)
+        self.assertEqual(main_window.client_state,
+                         ui.ClientState.LAUNCHER_UPDATE)
+
+    def test_main_window_locks_the_ui_while_updating_the_launcher(self):
+        main_window = ui.MainWindow(testing_config)
+        main_window.executor = self.executor
+        main_window.launch_game_btn.setEnabled(True)
+        main_window.branch_box.setEnabled(True)
+        main_window.metadata_cache = mock.Mock()
+        main_window.metadata_cache.get.return_value = CachedResponse(
+            'launcher.hash', b'new hash')
+        states = []
+
+        async def run_async(session=None):
+            states.append((main_window.client_state,
+                           main_window.launch_game_btn.isEnabled(),
+                           main_window.branch_box.isEnabled()))
+            raise download.DownloadError([])
+
+        with mock.patch.object(sys, 'frozen', True, create=True) as m1,\
+                mock.patch('sys.argv', ['launcher']) as m2,\
+                mock.patch('ui.get_loop', return_value=self.loop) as m3,\
+                mock.patch('ui.sha256_hash', return_value='old hash') as m4,\
+                mock.patch.object(main_window.download_tracker, 'run_async',
+                                  run_async) as m5,\
+                mock.patch('logging.error') as m6:
+            self.run_async(main_window.launcher_update_check)
+
+        self.assertEqual(states,
+                         [(ui.ClientState.LAUNCHER_UPDATE, False, False)])
+        # a failed self-update hands back to the game checks
+        self.assertEqual(main_window.client_state,
+                         ui.ClientState.GAME_STATUS_CHECK)
 
     def test_main_window_game_status_check_can_succeed(self):
         main_window = ui.MainWindow(testing_config)
@@ -466,14 +1173,20 @@ class UiTest(AsyncTestCase):
                         launch_game_button_enable_mock) as m1,\
                 mock.patch('PyQt5.QtWidgets.QPushButton.setText') as m2,\
                 mock.patch('ui.get_loop', return_value=self.loop) as m3,\
-                mock.patch('ui.Branch.index_directory') as m4:
+                mock.patch('ui.Branch.index_directory') as m4,\
+                mock.patch('ui.Branch.fetch_remote_index') as m5:
             m4._is_coroutine = False
+            m5._is_coroutine = False
             self.run_async(main_window.game_status_check)
+            self.assertEqual(main_window.client_state,
+                             ui.ClientState.GAME_UPDATE_CHECK)
+            # the remote indexes are fetched along with the scans
+            self.run_async(main_window.game_update_check)
 
-        self.assertEqual(m4.call_count, len(main_window.branches))
+        m4.assert_called_once_with()
+        m5.assert_called_once_with(main_window.context)
+        self.assertIsNone(main_window.index_fetches)
         self.assertFalse(mock_data['launch_game_button_enabled'])
-        self.assertEqual(main_window.client_state,
-                         ui.ClientState.GAME_UPDATE_CHECK)
 
     def test_main_window_main_loop_increments_successfully(self):
         main_window = ui.MainWindow(testing_config)
@@ -523,16 +1236,54 @@ class UiTest(AsyncTestCase):
                          ui.ClientState.GAME_UPDATE_CHECK)
         self.assertEqual(mock_data.get('ready'), ui.ClientState.READY)
 
+    def test_main_window_idles_without_waking_up(self):
+        main_window = ui.MainWindow(testing_config)
+        main_window.client_state = ui.ClientState.READY
+        loop = WakeupCountingLoop()
+        self.addCleanup(loop.close)
+
+        with mock.patch('ui.QThreadExecutor') as m1,\
+                async_patch('ui.MainWindow.fetch_news') as m2:
+            task = loop.create_task(main_window.main_loop())
+            loop.run_until_complete(asyncio.sleep(0.05))
+            self.assertEqual(main_window.launch_game_btn.text(),
+                             'Launch Game')
+
+            loop.wakeups = 0
+            loop.run_until_complete(asyncio.sleep(0.01))
+            baseline = loop.wakeups
+            loop.wakeups = 0
+            loop.run_until_complete(asyncio.sleep(0.5))
+            # idling 50 times as long costs no extra wakeups, where polling
+            # every 100ms would add at least 5
+            self.assertLessEqual(loop.wakeups, baseline)
+
+            # a state change is acted on right away
+            loop.call_soon(setattr, main_window, 'client_state',
+                           ui.ClientState.PENDING_GAME_UPDATE)
+            loop.wakeups = 0
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.run_until_complete(asyncio.sleep(0))
+            self.assertEqual(main_window.launch_game_btn.text(),
+                             'Update Game')
+            self.assertLessEqual(loop.wakeups, 6)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                loop.run_until_complete(task)
+
     def test_main_window_fetch_news_can_succeed(self):
         main_window = ui.MainWindow(testing_config)
+        main_window.executor = self.executor
         rows = []
         rss_data = test_rss_data
 
         def add_row_mock(self, date_label, link_label):
             rows.append((date_label, link_label))
 
-        with mock.patch('ui.feedparser.parse', return_value=rss_data) as m1,\
-                mock.patch('requests.get') as m2,\
+        with mock.patch('ui.get_loop', return_value=self.loop) as m0,\
+                mock.patch('ui.feedparser.parse',
+                           return_value=rss_data) as m1,\
+                mock.patch('http_client.HTTPClient.get') as m2,\
                 mock.patch('ui.QLabel') as m3,\
                 mock.patch('ui.QFormLayout.addRow', add_row_mock) as m4:
             self.run_async(main_window.fetch_news)
@@ -549,7 +1300,7 @@ class UiTest(AsyncTestCase):
             rows.append((date_label, link_label))
 
         with mock.patch('ui.feedparser.parse', return_value=rss_data) as m1,\
-                mock.patch('requests.get') as m2,\
+                mock.patch('http_client.HTTPClient.get') as m2,\
                 mock.patch('ui.QLabel') as m3,\
                 mock.patch('ui.QFormLayout.addRow', add_row_mock) as m4:
             self.run_async(main_window.fetch_news)
@@ -636,7 +1387,8 @@ class UiTest(AsyncTestCase):
         remote_hash = 'qwerty'
 
         with mock.patch('ui.sha256_hash', return_value=launcher_hash) as m1,\
-                mock.patch('requests.get', return_value=response) as m2,\
+                mock.patch('http_client.HTTPClient.get',
+                           return_value=response) as m2,\
                 mock.patch('download.DownloadTracker.clear',
                            should_not_be_run) as m3:
             response._text = remote_hash
@@ -670,7 +1422,8 @@ class UiTest(AsyncTestCase):
         remote_hash = 'asdf'
 
         with mock.patch('ui.sha256_hash', return_value=launcher_hash) as m1,\
-                mock.patch('requests.get', return_value=response) as m2,\
+                mock.patch('http_client.HTTPClient.get',
+                           return_value=response) as m2,\
                 async_patch('download.DownloadTracker.run_async') as m3,\
                 mock.patch('os.path.getsize', return_value=0) as m4,\
                 mock.patch('os.path.exists', return_value=True) as m5,\
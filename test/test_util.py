@@ -1,31 +1,65 @@
+import hashlib
 import os
 import platform
+import shutil
+import tempfile
 from unittest import TestCase, main, mock
 from util import get_platform, list_files, namedtuple_from_mapping,\
-     ProtectedDict, sha256_hash, tupperware
+     ProtectedDict, sha256_hash, tupperware, pick_block_size, CHUNK_SIZE,\
+     LARGE_FILE_SIZE, LARGE_FILE_BLOCK_SIZE, scan_files
 
 
 class UtilTest(TestCase):
 
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_temp_file(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as temp_file:
+            temp_file.write(data)
+        return path
+
     def test_sha256_hash_empty_file(self):
-        with mock.patch('util.open', mock.mock_open(read_data=b'')) as m:
-            result_hash = sha256_hash('mockfile_empty')
+        path = self._write_temp_file('mockfile_empty', b'')
+        result_hash = sha256_hash(path)
 
-        m.assert_called_once_with('mockfile_empty', 'rb')
         self.assertEqual(
             result_hash,
             "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855")
 
     def test_sha256_hash_4kb_of_0xff(self):
-        with mock.patch('util.open',
-                        mock.mock_open(read_data=b'\xFF'*4*(1024**2))) as m:
-            result_hash = sha256_hash('mockfile_4kb_0xff')
+        path = self._write_temp_file('mockfile_4kb_0xff', b'\xFF'*4*(1024**2))
+        result_hash = sha256_hash(path)
 
-        m.assert_called_once_with('mockfile_4kb_0xff', 'rb')
         self.assertEqual(
             result_hash,
             "cd3517473707d59c3d915b52a3e16213cadce80d9ffb2b4371958fb7acb51a08")
 
+    def test_sha256_hash_without_file_digest(self):
+        data = os.urandom(3 * CHUNK_SIZE + 17)
+        path = self._write_temp_file('random', data)
+        with mock.patch('util._file_digest', None):
+            for block_size in (None, 1, 4096, CHUNK_SIZE, 8 * CHUNK_SIZE):
+                self.assertEqual(sha256_hash(path, block_size),
+                                 hashlib.sha256(data).hexdigest())
+
+    def test_sha256_hash_rejects_bad_block_size(self):
+        path = self._write_temp_file('mockfile_empty', b'')
+        self.assertRaises(AssertionError, sha256_hash, path, 0)
+
+    def test_pick_block_size(self):
+        self.assertEqual(pick_block_size(0, 4096), 4096)
+        self.assertEqual(pick_block_size(4095, 4096), 4096)
+        self.assertEqual(pick_block_size(4096, 4096), 8192)
+        self.assertEqual(pick_block_size(10000, None), 12288)
+        self.assertEqual(pick_block_size(CHUNK_SIZE * 10), CHUNK_SIZE)
+        self.assertEqual(pick_block_size(LARGE_FILE_SIZE),
+                         LARGE_FILE_BLOCK_SIZE)
+
     def test_list_files_in_test_directory(self):
         splitext = os.path.splitext
         this_dir = os.path.dirname(__file__)
@@ -40,6 +74,62 @@ class UtilTest(TestCase):
         self.assertTrue(filenames)
         self.assertIn(module_name, filenames)
 
+    def test_scan_files_reports_relative_paths_and_sizes(self):
+        self._write_temp_file('top.bin', b'1')
+        os.makedirs(os.path.join(self.temp_dir, 'sub', 'deeper'))
+        self._write_temp_file(os.path.join('sub', 'deeper', 'low.bin'), b'22')
+        entries = {entry.relative_path: entry
+                   for entry in scan_files(self.temp_dir)}
+
+        self.assertEqual(set(entries), {'top.bin', 'sub/deeper/low.bin'})
+        low = entries['sub/deeper/low.bin']
+        self.assertEqual(low.stat.st_size, 2)
+        self.assertEqual(
+            low.full_path,
+            os.path.join(self.temp_dir, 'sub', 'deeper', 'low.bin'))
+
+    def test_scan_files_in_parallel_matches_serial_scan(self):
+        for top in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.temp_dir, top, 'nested'))
+            for name in ('1.bin', os.path.join('nested', '2.bin')):
+                self._write_temp_file(os.path.join(top, name), top.encode())
+        self._write_temp_file('root.bin', b'root')
+
+        def scan(**kwargs):
+            return {entry.relative_path: entry.stat.st_size
+                    for entry in scan_files(self.temp_dir, **kwargs)}
+
+        serial = scan()
+        self.assertEqual(len(serial), 7)
+        self.assertEqual(scan(workers=4), serial)
+
+    def test_scan_files_reports_directories_after_their_files(self):
+        os.makedirs(os.path.join(self.temp_dir, 'a', 'nested'))
+        os.makedirs(os.path.join(self.temp_dir, 'b'))
+        self._write_temp_file(os.path.join('a', 'nested', '1.bin'), b'1')
+        self._write_temp_file(os.path.join('b', '2.bin'), b'2')
+        self._write_temp_file('root.bin', b'root')
+
+        for workers in (None, 4):
+            listed = {}
+
+            def on_directory(prefix, subdirectories):
+                listed[prefix] = sorted(subdirectories)
+
+            for entry in scan_files(self.temp_dir, workers=workers,
+                                    on_directory=on_directory):
+                path = entry.relative_path
+                # no file turns up after its directory was reported
+                self.assertNotIn(path[:path.rfind('/') + 1], listed)
+            self.assertEqual(listed, {'': ['a/', 'b/'], 'a/': ['a/nested/'],
+                                      'a/nested/': [], 'b/': []})
+
+    def test_scan_files_without_stat(self):
+        self._write_temp_file('top.bin', b'1')
+        entries = list(scan_files(self.temp_dir, with_stat=False))
+        self.assertEqual(len(entries), 1)
+        self.assertIsNone(entries[0].stat)
+
     def test_namedtuple_from_mapping_can_succeed(self):
         test_tupp = namedtuple_from_mapping({'attr': 'qwer'})
         self.assertEqual(test_tupp.attr, 'qwer')